@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Persistent index of every tube scanned into a plate, used to catch a tube that was already scanned into
+an earlier plate (or a plate on another bench sharing the records directory).
+
+The index is a SQLite database in the records directory, with one row per used well of every record:
+tube barcode, plate barcode, well, timestamp and status, plus an index on the tube barcode so a lookup is
+a single b-tree search however many plates have been recorded. The records directory is often a network
+share used by several benches, so the database keeps SQLite's default rollback journal: WAL mode needs
+shared memory between the processes using it and does not work on network filesystems. While a plate is in progress
+TubeToWell.writeTransferRecordFiles queues its changed transfers to the index through the record
+writer thread (see IndexFeed), next to the record journal appends.
+
+Records written elsewhere (another bench, or before the index existed) are added with the backfill
+command, which parses the record csvs and journals in parallel and skips files it has already indexed.
+A new index is backfilled on a background thread (see open_index), so starting a plate never waits for it:
+
+
+	python BarcodeIndex.py backfill [records_dir] [--workers 4]
+	python BarcodeIndex.py lookup <tube barcode> [records_dir]
+"""
+
+import argparse, glob, logging, os, sqlite3, sys, threading
+from concurrent.futures import ProcessPoolExecutor
+from TransferRecords import JOURNAL_EXTENSION, read_transfer_journal
+
+INDEX_FILENAME = "barcode_index.sqlite"
+# tubes with this status are in the well; discarded and skipped wells are kept for reference only
+PLACED_STATUSES = ("started", "completed")
+INDEXED_STATUSES = PLACED_STATUSES + ("discarded",)
+# tube barcode of a skipped well, see TubeToWell.EMPTY_FLAG
+EMPTY_FLAG = "EMPTY"
+# below this many changed records the backfill parses them in this process
+PARALLEL_THRESHOLD = 32
+# barcodes per query of lookupMany, well below SQLite's limit on query parameters
+LOOKUP_CHUNK = 500
+# records per backfill transaction, so lookups on the scan loop never wait long for the write lock
+BACKFILL_CHUNK = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tubes (
+	record TEXT NOT NULL,
+	well TEXT NOT NULL,
+	barcode TEXT NOT NULL,
+	plate TEXT,
+	timestamp TEXT,
+	status TEXT,
+	PRIMARY KEY (record, well)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tubes_by_barcode ON tubes (barcode);
+CREATE TABLE IF NOT EXISTS records (
+	record TEXT PRIMARY KEY,
+	signature TEXT
+);
+"""
+
+
+def index_path(records_dir):
+	return os.path.join(records_dir, INDEX_FILENAME)
+
+
+def record_name(record_path):
+	"""Returns the name a record is indexed under: its csv file name without the extension."""
+	name = os.path.basename(str(record_path))
+	if name.endswith(JOURNAL_EXTENSION):
+		name = name[: -len(JOURNAL_EXTENSION)]
+	return name[:-4] if name.endswith(".csv") else name
+
+
+class BarcodeIndex:
+	"""
+	The tube index of one records directory. Each thread gets its own SQLite connection, so lookups on
+	the scan loop, updates on the record writer thread and a background backfill never share one.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._local = threading.local()
+		self._backfill = None
+		self.connection().executescript(SCHEMA)
+
+	def connection(self):
+		connection = getattr(self._local, "connection", None)
+		if connection is None:
+			connection = sqlite3.connect(self.path, timeout=10)
+			self._local.connection = connection
+		return connection
+
+	def close(self):
+		connection = getattr(self._local, "connection", None)
+		if connection is not None:
+			connection.close()
+			self._local.connection = None
+
+	def lookup(self, barcode, exclude_record=None):
+		"""
+		Returns (plate, well, timestamp, record) of the most recent plate the tube is in, ignoring the
+		record exclude_record (i.e the plate being scanned), or None.
+		"""
+		return (
+			self.connection()
+			.execute(
+				"SELECT plate, well, timestamp, record FROM tubes"
+				" WHERE barcode = ? AND record != ? AND status IN (?, ?)"
+				" ORDER BY timestamp DESC LIMIT 1",
+				(barcode, exclude_record or "") + PLACED_STATUSES,
+			)
+			.fetchone()
+		)
+
+	def lookupMany(self, barcodes, exclude_record=None):
+		"""
+		lookup for a batch of tubes with one query per LOOKUP_CHUNK barcodes: returns {barcode: (plate, well,
+		timestamp, record)} of the tubes found.
+		"""
+		barcodes = list(dict.fromkeys(barcodes))
+		found = {}
+		connection = self.connection()
+		for first in range(0, len(barcodes), LOOKUP_CHUNK):
+			chunk = barcodes[first : first + LOOKUP_CHUNK]
+			rows = connection.execute(
+				"SELECT barcode, plate, well, timestamp, record FROM tubes"
+				" WHERE barcode IN (%s) AND record != ? AND status IN (?, ?)" % ",".join("?" * len(chunk)),
+				tuple(chunk) + (exclude_record or "",) + PLACED_STATUSES,
+			)
+			for barcode, plate, well, timestamp, record in rows:
+				if barcode not in found or (timestamp or "") > (found[barcode][2] or ""):
+					found[barcode] = (plate, well, timestamp, record)
+		return found
+
+	def _apply(self, connection, record, plate, rows):
+		removed, placed = [], []
+		for timestamp, barcode, well, status in rows:
+			if status in INDEXED_STATUSES and barcode and barcode != EMPTY_FLAG:
+				placed.append((record, well, barcode, plate, timestamp, status))
+			else:
+				removed.append((record, well))
+		if removed:
+			connection.executemany("DELETE FROM tubes WHERE record = ? AND well = ?", removed)
+		if placed:
+			connection.executemany("INSERT OR REPLACE INTO tubes VALUES (?, ?, ?, ?, ?, ?)", placed)
+
+	def update(self, record, plate, rows):
+		"""Applies journal rows ([timestamp, tube barcode, well, status]) of a record to the index."""
+		connection = self.connection()
+		with connection:
+			self._apply(connection, record, plate, rows)
+
+	def replaceRecords(self, parsed):
+		"""Replaces every row of the given records with [(record, plate, rows, signature), ...] in one transaction."""
+		connection = self.connection()
+		with connection:
+			for record, plate, rows, signature in parsed:
+				connection.execute("DELETE FROM tubes WHERE record = ?", (record,))
+				self._apply(connection, record, plate, rows)
+				connection.execute("INSERT OR REPLACE INTO records VALUES (?, ?)", (record, signature))
+
+	def startBackfill(self, records_dir, workers=None):
+		"""
+		Backfills the records of records_dir on a background thread. Until it is done, lookups only find
+		the tubes of the records indexed so far.
+		"""
+		self._backfill = threading.Thread(
+			target=self._runBackfill, args=(records_dir, workers), name="BarcodeIndexBackfill", daemon=True
+		)
+		self._backfill.start()
+
+	def _runBackfill(self, records_dir, workers):
+		try:
+			count = backfill(records_dir, self, workers=workers)
+			logging.info("Indexed %s record(s) of %s in %s" % (count, records_dir, self.path))
+		except (sqlite3.Error, OSError) as err:
+			logging.error("Cannot backfill the barcode index %s: %s" % (self.path, err))
+		finally:
+			self.close()
+
+	def backfilling(self):
+		return self._backfill is not None and self._backfill.is_alive()
+
+	def waitForBackfill(self, timeout=None):
+		"""Blocks until a background backfill is done; returns False if it is still running after timeout."""
+		if self._backfill is not None:
+			self._backfill.join(timeout)
+		return not self.backfilling()
+
+	def signatures(self):
+		return dict(self.connection().execute("SELECT record, signature FROM records"))
+
+	def __len__(self):
+		return self.connection().execute("SELECT COUNT(*) FROM tubes").fetchone()[0]
+
+
+class IndexFeed:
+	"""
+	Queues a record's journal rows to the index on the record writer thread: it has the interface of a
+	TransferJournal (path, record_path, append, compact), so RecordWriter coalesces and writes it like one.
+	Index failures are logged, never raised; a missed update is repaired by the next backfill.
+	"""
+
+	def __init__(self, index, record_path, plate_barcode):
+		self.index = index
+		self.record_path = str(record_path)
+		self.path = self.record_path + "#" + INDEX_FILENAME
+		self.record = record_name(record_path)
+		self.plate_barcode = plate_barcode
+
+	def append(self, rows):
+		try:
+			self.index.update(self.record, self.plate_barcode, rows)
+		except sqlite3.Error as err:
+			logging.error("Cannot update the barcode index %s: %s" % (self.index.path, err))
+
+	def compact(self, rows):
+		# the index is kept up to date by append; compacted record rows carry no status to index
+		pass
+
+
+def record_signature(record_path):
+	"""Size and modification time of a record csv and its journal, to tell whether it changed since it was indexed."""
+	parts = []
+	for path in (str(record_path), str(record_path) + JOURNAL_EXTENSION):
+		try:
+			stat = os.stat(path)
+			parts.append("%s:%s" % (stat.st_size, stat.st_mtime_ns))
+		except OSError:
+			parts.append("-")
+	return "|".join(parts)
+
+
+def parse_record(record_path):
+	"""Returns (record, plate, rows, signature) for a record csv and/or journal, or None if it isn't a record."""
+	signature = record_signature(record_path)
+	try:
+		metadata, rows = read_transfer_journal(record_path)
+	except (OSError, UnicodeDecodeError, ValueError) as err:
+		logging.warning("Skipping %s: %s" % (record_path, err))
+		return None
+	if len(metadata) < 3 or not metadata[0] or not metadata[0][0].startswith("%Plate Timestamp"):
+		return None
+	plate = metadata[2][1] if len(metadata[2]) > 1 else ""
+	return record_name(record_path), plate, rows, signature
+
+
+def find_records(records_dir):
+	"""Returns the record csv paths (existing or only journaled) in a records directory."""
+	paths = set()
+	for path in glob.glob(os.path.join(glob.escape(records_dir), "*.csv")):
+		if not path.endswith("_WARNING.csv"):
+			paths.add(path)
+	for path in glob.glob(os.path.join(glob.escape(records_dir), "*.csv" + JOURNAL_EXTENSION)):
+		paths.add(path[: -len(JOURNAL_EXTENSION)])
+	return sorted(paths)
+
+
+def backfill(records_dir, index=None, workers=None):
+	"""
+	Indexes every record in records_dir that is new or changed since it was last indexed, parsing them
+	on a process pool. Returns the number of records (re)indexed.
+	"""
+	if index is None:
+		index = BarcodeIndex(index_path(records_dir))
+	known = index.signatures()
+	changed = [path for path in find_records(records_dir) if known.get(record_name(path)) != record_signature(path)]
+	if not changed:
+		return 0
+	if len(changed) < PARALLEL_THRESHOLD or workers == 1:
+		parsed = [parse_record(path) for path in changed]
+	else:
+		chunksize = max(1, len(changed) // (4 * (workers or os.cpu_count() or 1)))
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			parsed = list(executor.map(parse_record, changed, chunksize=chunksize))
+	parsed = [result for result in parsed if result is not None]
+	for first in range(0, len(parsed), BACKFILL_CHUNK):
+		index.replaceRecords(parsed[first : first + BACKFILL_CHUNK])
+	return len(changed)
+
+
+def open_index(records_dir):
+	"""
+	Opens the index of a records directory. A new index is built from the records already there on a
+	background thread (see BarcodeIndex.startBackfill), so this returns at once.
+	"""
+	path = index_path(records_dir)
+	is_new = not os.path.isfile(path)
+	index = BarcodeIndex(path)
+	if is_new:
+		index.startBackfill(records_dir)
+	return index
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	backfill_parser = subparsers.add_parser("backfill", help="index the records in a records directory")
+	backfill_parser.add_argument("records_dir", nargs="?", default="records")
+	backfill_parser.add_argument("--workers", type=int, default=None, help="parser processes (default: one per cpu)")
+	lookup_parser = subparsers.add_parser("lookup", help="show the plate a tube was scanned into")
+	lookup_parser.add_argument("barcode")
+	lookup_parser.add_argument("records_dir", nargs="?", default="records")
+	args = parser.parse_args(argv)
+
+	index = BarcodeIndex(index_path(args.records_dir))
+	if args.command == "backfill":
+		count = backfill(args.records_dir, index, workers=args.workers)
+		print("Indexed %s new or changed record(s); %s tubes in %s" % (count, len(index), index.path))
+	else:
+		found = index.lookup(args.barcode)
+		if found is None:
+			print("%s is not in any indexed plate" % args.barcode)
+			return 1
+		plate, well, timestamp, record = found
+		print("%s: plate %s, well %s, %s (%s)" % (args.barcode, plate, well, timestamp, record))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Barcode validation rules for tubes, plates and user names.
+
+TubeToWell.isPlate, TubeToWell.isName and TTWTransferProtocol.isTube accepted anything, so truncated
+reads and two barcodes run together by the scanner went straight into the records. The optional
+"barcode_rules" configuration entry describes what a valid "tube", "plate" and "name" looks like:
+
+	"barcode_rules": {
+		"tube": {
+			"min_length": 8,
+			"max_length": 12,
+			"pattern": "[A-Z0-9]+",
+			"reject_doubled": true,
+			"vendors": {
+				"Azenta": {"prefixes": ["FR", "FD"], "length": 10},
+				"Thermo": {"prefixes": ["FG"], "checksum": "mod103", "check_character_sent": true}
+			}
+		},
+		"plate": {"pattern": "P[0-9]{6}", "checksum": "luhn"},
+		"name": {"pattern": "[^0-9]+"}
+	}
+
+Every entry is optional and a kind without rules accepts everything, so configurations without the
+entry behave as before. A rule may give:
+
+- "length", or "min_length" and/or "max_length";
+- "pattern", a regular expression the whole barcode must match;
+- "checksum": "luhn" (all digits, the last one a Luhn check digit) or "mod103" (the last character is
+  the Code 128 (code set B) mod 103 check character of the others). Scanners strip the Code 128 check
+  character unless they are set up to send it, so "mod103" also needs "check_character_sent": true,
+  and is only for barcodes known to carry it. A check value of 95 to 102 is a function character with
+  no text form, so a barcode whose check value is one of those is taken as sent without it;
+- "reject_doubled": rejects a barcode made of the same text twice (a tube scanned twice without Enter);
+- "vendors": a prefix table. The barcode must start with a prefix of one of the vendors (the longest
+  prefix wins), and that vendor's own length, pattern and checksum entries apply as well.
+
+compile_rules turns the entry into BarcodeRules once, when the configuration is loaded: the regular
+expressions are compiled and every rule becomes a short list of checks, so checking a scan costs a few
+microseconds. Rejections are counted by kind and reason for the Prometheus endpoint of Metrics.py.
+"""
+
+import re
+
+KINDS = ("tube", "plate", "name")
+RULE_KEYS = (
+	"length", "min_length", "max_length", "pattern", "checksum", "check_character_sent", "reject_doubled", "vendors"
+)
+VENDOR_KEYS = ("prefixes", "length", "min_length", "max_length", "pattern", "checksum", "check_character_sent")
+# Code 128 values 95 to 102 are function and code set characters, with no character of their own in code set B
+MOD103_PRINTABLE = 95
+
+# rejected barcodes, (kind, reason) -> count, over every rule compiled in the process
+rejections = {}
+
+
+def luhn_valid(barcode):
+	"""True if barcode is all digits and its last digit is the Luhn check digit of the others."""
+	if len(barcode) < 2 or not barcode.isdigit() or not barcode.isascii():
+		return False
+	total = 0
+	for i, char in enumerate(reversed(barcode)):
+		digit = ord(char) - 48
+		if i % 2:
+			digit *= 2
+			if digit > 9:
+				digit -= 9
+		total += digit
+	return total % 10 == 0
+
+
+def mod103_valid(barcode):
+	"""
+	True if the last character of barcode is the Code 128 (code set B) mod 103 check character of the
+	others. Only meaningful for barcodes read by a scanner that sends the check character, which most
+	don't by default. A symbol whose check value is 95 to 102 can't send it as text, so a barcode that
+	is its own data with such a check value is valid too.
+	"""
+	if len(barcode) < 2:
+		return False
+	total = 104
+	for position, char in enumerate(barcode, start=1):
+		value = ord(char) - 32
+		if not 0 <= value < MOD103_PRINTABLE:
+			return False
+		if position == len(barcode) and value == total % 103:
+			return True
+		total += position * value
+	return total % 103 >= MOD103_PRINTABLE
+
+
+CHECKSUMS = {"luhn": luhn_valid, "mod103": mod103_valid}
+
+
+def is_doubled(barcode):
+	half, odd = divmod(len(barcode), 2)
+	return not odd and half > 0 and barcode[:half] == barcode[half:]
+
+
+def compile_checks(spec, where):
+	"""
+	Returns [(reason, message, check)] for the length, pattern and checksum entries of a rule (or
+	vendor) spec, check being a function of the barcode that returns False to reject it. Raises
+	ValueError for entries that make no sense, naming where they are.
+	"""
+	checks = []
+	min_length = spec.get("min_length")
+	max_length = spec.get("max_length")
+	if spec.get("length") is not None:
+		min_length = max_length = spec["length"]
+	for value in (min_length, max_length):
+		if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+			raise ValueError("%s: lengths must be whole numbers, got %r" % (where, value))
+	if min_length is not None and max_length is not None:
+		if min_length > max_length:
+			raise ValueError("%s: min_length %s is more than max_length %s" % (where, min_length, max_length))
+		if min_length == max_length:
+			message = "must be %s characters long" % min_length
+		else:
+			message = "must be %s to %s characters long" % (min_length, max_length)
+		checks.append(("length", message, lambda barcode: min_length <= len(barcode) <= max_length))
+	elif min_length is not None:
+		checks.append(("length", "must be at least %s characters long" % min_length, lambda barcode: len(barcode) >= min_length))
+	elif max_length is not None:
+		checks.append(("length", "must be at most %s characters long" % max_length, lambda barcode: len(barcode) <= max_length))
+
+	if spec.get("pattern") is not None:
+		try:
+			fullmatch = re.compile(spec["pattern"]).fullmatch
+		except (re.error, TypeError) as err:
+			raise ValueError("%s: invalid pattern %r (%s)" % (where, spec["pattern"], err))
+		checks.append(("pattern", "does not match %s" % spec["pattern"], lambda barcode: fullmatch(barcode) is not None))
+
+	if spec.get("checksum") is not None:
+		checksum = CHECKSUMS.get(spec["checksum"])
+		if checksum is None:
+			raise ValueError(
+				"%s: unknown checksum %r (expected one of %s)" % (where, spec["checksum"], ", ".join(sorted(CHECKSUMS)))
+			)
+		if spec["checksum"] == "mod103" and spec.get("check_character_sent") is not True:
+			raise ValueError(
+				"%s: mod103 needs \"check_character_sent\": true, as scanners strip the Code 128 check character "
+				"unless set up to send it" % where
+			)
+		checks.append(("checksum", "%s check character is wrong" % spec["checksum"], checksum))
+	return checks
+
+
+class BarcodeRule:
+	"""The compiled rules for one kind of barcode. A rule with no checks accepts everything."""
+
+	def __init__(self, kind, checks=(), vendors=None):
+		self.kind = kind
+		self.checks = tuple(checks)
+		# prefix -> (vendor name, checks), and the prefix lengths to try, longest first
+		self.vendors = vendors or {}
+		self.prefix_lengths = sorted({len(prefix) for prefix in self.vendors}, reverse=True)
+
+	def __bool__(self):
+		return bool(self.checks or self.vendors)
+
+	def vendor(self, barcode):
+		"""Returns (vendor name, checks) for the longest vendor prefix barcode starts with, or None."""
+		for length in self.prefix_lengths:
+			vendor = self.vendors.get(barcode[:length])
+			if vendor is not None:
+				return vendor
+		return None
+
+	def check(self, barcode):
+		"""Returns (reason, message) for the first rule barcode breaks, or None if it is valid."""
+		for reason, message, check in self.checks:
+			if not check(barcode):
+				return reason, message
+		if self.vendors:
+			vendor = self.vendor(barcode)
+			if vendor is None:
+				return "vendor", "does not start with a known vendor prefix"
+			name, checks = vendor
+			for reason, message, check in checks:
+				if not check(barcode):
+					return reason, "%s (%s)" % (message, name)
+		return None
+
+	def accepts(self, barcode):
+		"""True if barcode is valid; otherwise counts the rejection and returns False."""
+		if not self.checks and not self.vendors:
+			return True
+		failure = self.check(barcode)
+		if failure is None:
+			return True
+		key = (self.kind, failure[0])
+		rejections[key] = rejections.get(key, 0) + 1
+		return False
+
+	def explain(self, barcode):
+		"""Returns why barcode is not valid, e.g. "must be 10 characters long", or "" if it is."""
+		failure = self.check(barcode)
+		return "" if failure is None else failure[1]
+
+
+class BarcodeRules:
+	"""The compiled tube, plate and name rules of a configuration."""
+
+	def __init__(self, tube=None, plate=None, name=None):
+		self.tube = tube or BarcodeRule("tube")
+		self.plate = plate or BarcodeRule("plate")
+		self.name = name or BarcodeRule("name")
+
+
+def compile_rule(kind, spec):
+	where = "barcode_rules.%s" % kind
+	if not isinstance(spec, dict):
+		raise ValueError("%s must be an object" % where)
+	unknown = sorted(set(spec) - set(RULE_KEYS))
+	if unknown:
+		raise ValueError("%s: unknown entries %s" % (where, ", ".join(unknown)))
+	checks = compile_checks(spec, where)
+	if spec.get("reject_doubled"):
+		checks.append(("doubled", "looks like the same barcode scanned twice", lambda barcode: not is_doubled(barcode)))
+	vendors = {}
+	for vendor, vendor_spec in (spec.get("vendors") or {}).items():
+		vendor_where = "%s.vendors.%s" % (where, vendor)
+		if not isinstance(vendor_spec, dict) or not vendor_spec.get("prefixes"):
+			raise ValueError("%s needs a list of prefixes" % vendor_where)
+		unknown = sorted(set(vendor_spec) - set(VENDOR_KEYS))
+		if unknown:
+			raise ValueError("%s: unknown entries %s" % (vendor_where, ", ".join(unknown)))
+		vendor_checks = tuple(compile_checks(vendor_spec, vendor_where))
+		for prefix in vendor_spec["prefixes"]:
+			if not isinstance(prefix, str) or prefix in vendors:
+				raise ValueError("%s: prefix %r is not text or belongs to two vendors" % (vendor_where, prefix))
+			vendors[prefix] = (vendor, vendor_checks)
+	return BarcodeRule(kind, checks, vendors)
+
+
+def compile_rules(spec):
+	"""
+	Compiles the "barcode_rules" configuration entry (None for none) into BarcodeRules. Raises
+	ValueError, naming the offending entry, if it can't be compiled.
+	"""
+	if not spec:
+		return BarcodeRules()
+	if not isinstance(spec, dict):
+		raise ValueError("barcode_rules must be an object with tube, plate and name entries")
+	unknown = sorted(set(spec) - set(KINDS))
+	if unknown:
+		raise ValueError("barcode_rules: unknown entries %s" % ", ".join(unknown))
+	return BarcodeRules(**{kind: compile_rule(kind, spec[kind]) for kind in KINDS if spec.get(kind)})
+
+
+def metric_samples():
+	"""Returns the rejection counts as Metrics collector samples: [(name, type, description, value)]."""
+	return [
+		(
+			"%s_barcode_rejected_%s_total" % (kind, reason),
+			"counter",
+			"%s barcodes rejected by the %s rule." % (kind.capitalize(), reason),
+			count,
+		)
+		for (kind, reason), count in sorted(rejections.items())
+	]
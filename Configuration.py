@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Typed, validated configuration files.
+
+A configuration file (configs/*.json, see the README) used to be read with json.load wherever it was
+needed, and its entries copied onto TubeToWell one by one, so a typo only surfaced as a KeyError (or a
+wrong plate) later on. load_config reads a file into a Configuration instead:
+
+- every entry is checked once, and all the problems of a file are reported together (ConfigError);
+  entries that are only suspicious, e.g. an unknown key, are kept as warnings;
+- the per-plate-type lighting blocks ("96", "384", ...) become LightingConfigs;
+- "barcode_rules" is compiled (see BarcodeRules.py) and the "scanner_input" sources are checked (see
+  ScannerInput.py);
+- parsed files are cached by path, size and modification time, so loading an unchanged file again
+  (every new TubeToWell loads DEFAULT_CONFIG.json) costs a stat call.
+
+ConfigWatcher polls a configuration file from a background thread and hands every valid new version
+to a callback; TubeToWell applies it between plates (see TubeToWell.watchConfiguration). Polling is
+used rather than inotify because the stations run Windows.
+
+migrate_config brings an older configuration file up to date with the DEFAULT_CONFIG.json of a new
+release (see update.py): the user's values are kept, new entries are added from the defaults, and the
+MIGRATIONS fix up files written for older CONFIG_VERSIONs.
+"""
+
+import copy, json, logging, os, threading
+
+from BarcodeRules import compile_rules
+from PlateGeometry import FILL_ORDERS, STANDARD_LAYOUTS
+from ScannerInput import parse_source
+
+CONFIG_VERSION = 1
+# how often ConfigWatcher looks at the file, in seconds
+POLL_INTERVAL = 2.0
+KNOWN_KEYS = (
+	"config_version",
+	"num_wells",
+	"records_dir",
+	"samples_dir",
+	"templates_dir",
+	"controls",
+	"enable_scan_out",
+	"fill_order",
+	"custom_layout",
+	"check_previous_plates",
+	"metrics_file",
+	"metrics_port",
+	"barcode_rules",
+	"scanner_input",
+)
+LIGHTING_KEYS = ("A1_X_dest", "A1_Y_dest", "size_param", "well_spacing")
+
+
+class ConfigError(ValueError):
+	"""A configuration that can't be used. problems lists everything wrong with it."""
+
+	def __init__(self, path, problems):
+		self.path = path
+		self.problems = list(problems)
+		super().__init__("%s: %s" % (path or "configuration", "; ".join(self.problems)))
+
+
+class LightingConfig:
+	"""Where the wells of one plate type are on the screen, as fractions of the screen size."""
+
+	__slots__ = ("a1_x", "a1_y", "size_param", "well_spacing")
+
+	def __init__(self, a1_x, a1_y, size_param, well_spacing):
+		self.a1_x = a1_x
+		self.a1_y = a1_y
+		self.size_param = size_param
+		self.well_spacing = well_spacing
+
+	def asDict(self):
+		return {
+			"A1_X_dest": self.a1_x,
+			"A1_Y_dest": self.a1_y,
+			"size_param": dict(self.size_param),
+			"well_spacing": self.well_spacing,
+		}
+
+
+class Configuration:
+	"""
+	One parsed configuration file. data is the file's json, for code that still reads entries itself
+	(the WellLit plate display reads the lighting blocks from the file).
+	"""
+
+	def __init__(self, path=None, data=None):
+		self.path = path
+		self.data = data if data is not None else {}
+		self.version = CONFIG_VERSION
+		self.num_wells = "96"
+		self.records_dir = ""
+		self.samples_dir = ""
+		self.templates_dir = ""
+		self.controls = []
+		self.enable_scan_out = True
+		self.fill_order = "column"
+		self.custom_layout = None
+		self.check_previous_plates = False
+		self.metrics_file = None
+		self.metrics_port = None
+		# whether the file has metrics entries at all (without them the metrics are left as they are)
+		self.metrics_configured = False
+		self.barcode_rules = compile_rules(None)
+		# ScannerInput source specs, e.g. ["tcp:5555"]; empty when scans only come through the textbox
+		self.scanner_input = []
+		self.lighting = {}
+		self.warnings = []
+
+	def geometry(self):
+		"""The entries that decide the plate layout: (num_wells, fill_order, custom_layout)."""
+		return (self.num_wells, self.fill_order, self.custom_layout)
+
+
+def is_number(value):
+	return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_whole(value):
+	return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_lighting(block, where, problems):
+	if not isinstance(block, dict):
+		problems.append("%s must be an object" % where)
+		return None
+	missing = [key for key in LIGHTING_KEYS if key not in block]
+	if missing:
+		problems.append("%s is missing %s" % (where, ", ".join(missing)))
+		return None
+	for key in ("A1_X_dest", "A1_Y_dest"):
+		if not is_number(block[key]) or not 0 <= block[key] <= 1:
+			problems.append("%s.%s must be a fraction of the screen between 0 and 1" % (where, key))
+	if not is_number(block["well_spacing"]) or block["well_spacing"] <= 0:
+		problems.append("%s.well_spacing must be a positive number" % where)
+	size_param = block["size_param"]
+	if not isinstance(size_param, dict) or not all(is_number(size) and size > 0 for size in size_param.values()):
+		problems.append("%s.size_param must map each shape to a positive size" % where)
+		return None
+	return LightingConfig(block["A1_X_dest"], block["A1_Y_dest"], dict(size_param), block["well_spacing"])
+
+
+def parse_config(data, path=None):
+	"""Returns the Configuration of a configuration file's json. Raises ConfigError listing every problem found."""
+	config = Configuration(path, data)
+	if not isinstance(data, dict):
+		raise ConfigError(path, ["the file must contain a json object"])
+	problems = []
+	warnings = config.warnings
+
+	version = data.get("config_version", 0)
+	if not is_whole(version) or version > CONFIG_VERSION:
+		problems.append("config_version %r is not supported by this version of the software" % (version,))
+	config.version = version
+
+	num_wells = data.get("num_wells")
+	if num_wells is None:
+		problems.append("num_wells is missing")
+	elif not is_whole(num_wells) and not isinstance(num_wells, str):
+		problems.append("num_wells must be a number of wells, e.g. \"96\"")
+	else:
+		config.num_wells = str(num_wells)
+		if config.num_wells not in STANDARD_LAYOUTS and not data.get("custom_layout"):
+			warnings.append("num_wells %s is not a standard plate, using 96 wells" % config.num_wells)
+
+	for key in ("records_dir", "samples_dir", "templates_dir"):
+		value = data.get(key, "")
+		if not isinstance(value, str):
+			problems.append("%s must be a folder path" % key)
+		else:
+			setattr(config, key, value)
+
+	controls = data.get("controls", [])
+	if controls == "":
+		# the README used to ask for empty quotation marks when there are no controls
+		controls = []
+	if not isinstance(controls, list) or not all(isinstance(well, str) for well in controls):
+		problems.append("controls must be a list of well names, e.g. [\"A1\", \"H12\"]")
+	else:
+		config.controls = list(controls)
+
+	for key in ("enable_scan_out", "check_previous_plates"):
+		if key in data:
+			if not isinstance(data[key], bool):
+				problems.append("%s must be true or false" % key)
+			else:
+				setattr(config, key, data[key])
+
+	fill_order = data.get("fill_order", "column")
+	if fill_order not in FILL_ORDERS:
+		problems.append("fill_order must be one of %s" % ", ".join(FILL_ORDERS))
+	else:
+		config.fill_order = fill_order
+
+	custom_layout = data.get("custom_layout")
+	if custom_layout:
+		if (
+			not isinstance(custom_layout, dict)
+			or not all(is_whole(custom_layout.get(key)) and custom_layout[key] > 0 for key in ("rows", "columns"))
+		):
+			problems.append("custom_layout must give whole numbers of rows and columns, e.g. {\"rows\": 8, \"columns\": 12}")
+		else:
+			config.custom_layout = custom_layout
+
+	config.metrics_configured = "metrics_file" in data or "metrics_port" in data
+	metrics_file = data.get("metrics_file")
+	if metrics_file is not None and not isinstance(metrics_file, str):
+		problems.append("metrics_file must be a file path")
+	else:
+		config.metrics_file = metrics_file or None
+	metrics_port = data.get("metrics_port")
+	if metrics_port not in (None, "", 0):
+		if not is_whole(metrics_port) or not 0 < metrics_port < 65536:
+			problems.append("metrics_port must be a port number")
+		else:
+			config.metrics_port = metrics_port
+
+	try:
+		config.barcode_rules = compile_rules(data.get("barcode_rules"))
+	except ValueError as err:
+		problems.append(str(err))
+
+	scanner_input = data.get("scanner_input") or []
+	if isinstance(scanner_input, str):
+		scanner_input = [scanner_input]
+	if not isinstance(scanner_input, list):
+		problems.append("scanner_input must be a list of scanner sources, e.g. [\"tcp:5555\"]")
+	else:
+		for spec in scanner_input:
+			try:
+				parse_source(spec)
+			except ValueError as err:
+				problems.append(str(err))
+		config.scanner_input = list(scanner_input)
+
+	for key, value in data.items():
+		if key in STANDARD_LAYOUTS:
+			lighting = parse_lighting(value, key, problems)
+			if lighting is not None:
+				config.lighting[key] = lighting
+		elif key not in KNOWN_KEYS:
+			warnings.append("unknown entry %s" % key)
+
+	if problems:
+		raise ConfigError(path, problems)
+	return config
+
+
+# path -> ((size, modification time), Configuration)
+_parsed = {}
+_parsed_lock = threading.Lock()
+
+
+def file_stamp(path):
+	stat = os.stat(path)
+	return (stat.st_size, stat.st_mtime_ns)
+
+
+def load_config(path):
+	"""
+	Returns the Configuration of a configuration file, parsed again only if the file changed since it
+	was last loaded. Raises OSError if it can't be read and ConfigError (a ValueError) if it isn't valid.
+	"""
+	key = os.path.abspath(path)
+	stamp = file_stamp(path)
+	with _parsed_lock:
+		cached = _parsed.get(key)
+	if cached is not None and cached[0] == stamp:
+		return cached[1]
+	with open(path, encoding="utf-8") as json_file:
+		try:
+			data = json.load(json_file)
+		except ValueError as err:
+			raise ConfigError(path, ["not valid json (%s)" % err])
+	config = parse_config(data, path)
+	for warning in config.warnings:
+		logging.warning("%s: %s", path, warning)
+	with _parsed_lock:
+		_parsed[key] = (stamp, config)
+	return config
+
+
+def clear_config_cache():
+	with _parsed_lock:
+		_parsed.clear()
+
+
+class ConfigWatcher:
+	"""
+	Polls a configuration file every interval seconds from a daemon thread and calls callback with the
+	new Configuration whenever the file changes and is still valid. Invalid edits are logged and skipped.
+	"""
+
+	def __init__(self, path, callback, interval=POLL_INTERVAL):
+		self.path = path
+		self.callback = callback
+		self.interval = interval
+		self.stopped = threading.Event()
+		try:
+			self.stamp = file_stamp(path)
+		except OSError:
+			self.stamp = None
+		self.thread = threading.Thread(target=self._run, name="ConfigWatcher", daemon=True)
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread.is_alive() and self.thread is not threading.current_thread():
+			self.thread.join()
+
+	def poll(self):
+		"""Checks the file once; returns the new Configuration if it changed and is valid, else None."""
+		try:
+			stamp = file_stamp(self.path)
+		except OSError:
+			return None
+		if stamp == self.stamp:
+			return None
+		self.stamp = stamp
+		try:
+			config = load_config(self.path)
+		except (OSError, ValueError) as err:
+			logging.warning("Ignoring the edited configuration file: %s", err)
+			return None
+		self.callback(config)
+		return config
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			self.poll()
+
+
+# fixes for files written before each CONFIG_VERSION: version -> function(config dict) -> notes
+def _migrate_to_1(config):
+	notes = []
+	if config.get("controls") == "":
+		config["controls"] = []
+		notes.append('controls "" -> []')
+	if is_whole(config.get("num_wells")):
+		config["num_wells"] = str(config["num_wells"])
+		notes.append("num_wells written as text")
+	return notes
+
+
+MIGRATIONS = {1: _migrate_to_1}
+
+
+def merge_defaults(defaults, config):
+	"""
+	Adds the entries of defaults missing from config to it, recursively, keeping the values config has.
+	An entry that is an object in one and not the other takes the default.
+	"""
+	for key, default in defaults.items():
+		if key not in config:
+			config[key] = copy.deepcopy(default)
+		elif isinstance(default, dict) and isinstance(config[key], dict):
+			merge_defaults(default, config[key])
+		elif isinstance(default, dict) != isinstance(config[key], dict):
+			config[key] = copy.deepcopy(default)
+	return config
+
+
+def migrate_config(config, defaults):
+	"""
+	Returns (config brought up to CONFIG_VERSION and merged with the defaults of a new release, notes
+	on what changed). config is not modified.
+	"""
+	config = copy.deepcopy(config)
+	notes = []
+	version = config.get("config_version", 0)
+	if not is_whole(version):
+		version = 0
+	for target in range(version + 1, CONFIG_VERSION + 1):
+		notes += MIGRATIONS[target](config)
+	added = [key for key in defaults if key not in config]
+	merge_defaults(defaults, config)
+	if added:
+		notes.append("added %s" % ", ".join(added))
+	config["config_version"] = CONFIG_VERSION
+	return config, notes
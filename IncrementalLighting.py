@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Diff-based updates of the plate lighting.
+
+TubeToWellWidget.updateLights used to empty every well and re-mark every completed, started, discarded
+and control well after each action, then redraw the whole matplotlib canvas. IncrementalLighting keeps
+the state it last rendered for each well, pushes only the wells whose state changed to the plate
+lighting layer, and redraws just those wells' artists (blitting them onto the canvas) instead of the
+whole figure. PlateLayer adapts WellLit's plate lighting layer to this; for a layer that can't be
+updated well by well, a warning names what it lacks and every update is the original full redraw.
+"""
+
+import logging
+from matplotlib.artist import Artist
+from matplotlib.figure import Figure
+from matplotlib.transforms import Bbox
+
+# well states, in the order updateLights has always applied them: a later state wins
+FILLED = "filled"
+TARGET = "target"
+DISCARDED = "discarded"
+CONTROL = "control"
+RESCAN = "rescan"
+
+MARKERS = {
+	FILLED: "markFilled",
+	TARGET: "markTarget",
+	DISCARDED: "markDiscarded",
+	CONTROL: "markControl",
+	RESCAN: "markRescan",
+}
+
+
+def well_states(ttw):
+	"""Returns {well name: state} for every well that isn't empty."""
+	tp = ttw.tp
+	states = {}
+	for status, state in (("completed", FILLED), ("started", TARGET), ("discarded", DISCARDED)):
+		for tf_id in tp.lists[status]:
+			states[tp.transfers[tf_id]["dest_well"]] = state
+	for control_well in ttw.controls:
+		states[control_well] = CONTROL
+	if tp.lightup_well is not None:
+		states[tp.lightup_well] = RESCAN
+	return states
+
+
+class PlateLayer:
+	"""
+	Adapter between IncrementalLighting and a plate lighting layer (the object behind dest_plate.pl).
+
+	The original updateLights only used emptyWells, markFilled/markTarget/markDiscarded/markControl/
+	markRescan(well) and show on the layer, and the full redraw sticks to those. Updating well by well
+	also needs the layer's matplotlib figure in fig and a wells dict of Well objects, each with its own
+	markEmpty and its matplotlib patch in marker, as WellLit's PlateLighting is believed to have. This
+	repository doesn't pin a WellLit revision to check those names against, so the adapter checks them
+	on the layer itself: missing lists what it lacks, and verify tries them on one well. With anything
+	missing every update is a full redraw, so a wrong guess costs speed, not a wrongly lit well. A
+	layer's own markEmpty(well), if it has one, is used instead of the Well's.
+	"""
+
+	def __init__(self, pl):
+		self.pl = pl
+		self.wells = getattr(pl, "wells", None) or {}
+		self.figure = getattr(pl, "fig", None)
+		self.missing = []
+		self.verified = False
+		if not callable(getattr(pl, "markEmpty", None)) and not (
+			self.wells and all(callable(getattr(well, "markEmpty", None)) for well in self.wells.values())
+		):
+			self.missing.append("a way to empty a single well (markEmpty)")
+		if not isinstance(self.figure, Figure):
+			self.missing.append("its matplotlib figure (fig)")
+		elif not (
+			self.wells
+			and all(
+				isinstance(getattr(well, "marker", None), Artist) and well.marker.figure is self.figure
+				for well in self.wells.values()
+			)
+		):
+			self.missing.append("the matplotlib patch of each well on its figure (Well.marker)")
+
+	def verify(self):
+		"""
+		Checks, on the first well, that marking it and emptying it through the adapter changes the colour
+		of its patch and back; adds to missing if not. Leaves every well empty.
+		"""
+		self.verified = True
+		if self.missing:
+			return
+		well, well_obj = next(iter(self.wells.items()))
+		get_facecolor = getattr(well_obj.marker, "get_facecolor", None)
+		if get_facecolor is None:
+			self.missing.append("a fill colour on each well's patch (Well.marker)")
+			return
+		self.pl.emptyWells()
+		empty = tuple(get_facecolor())
+		self.pl.markFilled(well)
+		filled = tuple(get_facecolor())
+		self.markEmpty(well)
+		emptied = tuple(get_facecolor())
+		self.pl.emptyWells()
+		if filled == empty or emptied != empty:
+			self.missing.append("single well updates that reach the well's patch (markEmpty, Well.marker)")
+
+	@property
+	def incremental(self):
+		return not self.missing
+
+	def markEmpty(self, well):
+		if callable(getattr(self.pl, "markEmpty", None)):
+			self.pl.markEmpty(well)
+		else:
+			self.wells[well].markEmpty()
+
+	def artists(self, well):
+		well_obj = self.wells.get(well)
+		return [] if well_obj is None else [well_obj.marker]
+
+	def allArtists(self):
+		return [well.marker for well in self.wells.values()]
+
+
+class IncrementalLighting:
+	"""
+	Applies well state changes to a plate lighting layer through a PlateLayer. If the layer can't be
+	updated well by well, a warning says why and every update is a full redraw.
+	"""
+
+	def __init__(self, pl):
+		self.pl = pl
+		self.layer = PlateLayer(pl)
+		if not self.layer.incremental:
+			self.warnFullRedraws()
+		self.rendered = None
+		self.background = None
+		self.background_size = None
+		self.full_redraws = 0
+		self.partial_redraws = 0
+
+	def warnFullRedraws(self):
+		logging.warning(
+			"Plate lighting %s has no %s: every update redraws the whole plate"
+			% (type(self.pl).__name__, " or ".join(self.layer.missing))
+		)
+
+	def invalidate(self):
+		"""Forgets what was rendered, so the next update is a full redraw."""
+		self.rendered = None
+		self.background = None
+
+	def update(self, ttw):
+		states = well_states(ttw)
+		if not self.layer.verified and self.layer.incremental:
+			self.layer.verify()
+			if not self.layer.incremental:
+				self.warnFullRedraws()
+		if self.rendered is None or not self.layer.incremental:
+			self.redrawAll(states)
+			return
+
+		changed = [
+			well
+			for well in set(states) | set(self.rendered)
+			if states.get(well) != self.rendered.get(well)
+		]
+		if not changed:
+			return
+		for well in changed:
+			self.mark(well, states.get(well))
+		self.rendered = states
+		if self.blit(changed):
+			self.partial_redraws += 1
+		else:
+			self.pl.show()
+			self.full_redraws += 1
+
+	def mark(self, well, state):
+		if state is None:
+			self.layer.markEmpty(well)
+		else:
+			getattr(self.pl, MARKERS[state])(well)
+
+	def redrawAll(self, states):
+		"""The original updateLights: empty every well, re-mark everything and redraw the canvas."""
+		self.pl.emptyWells()
+		for well, state in states.items():
+			self.mark(well, state)
+		self.pl.show()
+		self.rendered = states
+		self.full_redraws += 1
+
+	def captureBackground(self, fig):
+		"""Snapshots the canvas with every well hidden, to clear wells with before they are redrawn."""
+		artists = self.layer.allArtists()
+		visible = [artist.get_visible() for artist in artists]
+		for artist in artists:
+			artist.set_visible(False)
+		try:
+			fig.canvas.draw()
+			self.background = fig.canvas.copy_from_bbox(fig.bbox)
+		finally:
+			for artist, was_visible in zip(artists, visible):
+				artist.set_visible(was_visible)
+		fig.canvas.draw()
+
+	def blit(self, wells):
+		"""Redraws just the artists of the given wells onto the canvas. Returns False if that isn't possible."""
+		fig = self.layer.figure
+		if not getattr(fig.canvas, "supports_blit", False):
+			return False
+		artists = []
+		for well in wells:
+			well_artists = self.layer.artists(well)
+			if not well_artists:
+				return False
+			artists.extend(well_artists)
+		try:
+			if self.background is None or self.background_size != fig.bbox.size.tolist():
+				self.captureBackground(fig)
+				self.background_size = fig.bbox.size.tolist()
+			# clear each well (the artist's extent, plus its edge) back to the background first, otherwise
+			# anti-aliased edges darken with every redraw
+			regions = []
+			height = fig.bbox.height
+			for artist in artists:
+				extent = artist.get_window_extent(fig.canvas.get_renderer())
+				pad = getattr(artist, "get_linewidth", lambda: 0)() * fig.dpi / 72 + 2
+				region = Bbox.intersection(extent.padded(pad), fig.bbox)
+				# Agg addresses saved regions in pixel rows counted from the top of the canvas
+				fig.canvas.restore_region(
+					self.background,
+					bbox=(region.x0, height - region.y1, region.x1 + 1, height - region.y0 + 1),
+					xy=(0, 0),
+				)
+				regions.append(region)
+			for artist in artists:
+				artist.axes.draw_artist(artist)
+			for region in regions:
+				fig.canvas.blit(region)
+		except Exception as err:
+			# e.g. the canvas has not been drawn once yet
+			logging.debug("Falling back to a full plate redraw: %s" % err)
+			self.background = None
+			return False
+		return True
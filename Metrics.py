@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Per-operation timing and counters for the scan path.
+
+The hot operations (TubeToWell.next, checkSampleList, TTWTransferProtocol.next, writeTransferRecordFiles
+and the GUI's updateLights) are wrapped with @instrument("<operation>"). While metrics are disabled (the
+default) the wrapper only checks a flag before calling through. Once enabled, every call records:
+
+- a counter per operation and outcome ("ok", or the exception class that ended it, e.g. "TError");
+- a latency histogram per operation, with Prometheus-style cumulative buckets;
+- the wall clock time of the operation's last call.
+
+Two outputs can be enabled, independently, with the "metrics_file" and "metrics_port" configuration
+entries (see TubeToWell.configureMetrics):
+
+- a JSON-lines file with one line per call, {"ts": <unix time>, "op": ..., "ms": ..., "outcome": ...},
+  rotated at ROTATE_BYTES and written by a background thread (EventWriter), so the scan loop never waits on it;
+- a Prometheus text endpoint, http://127.0.0.1:<port>/metrics, served from a daemon thread.
+
+Other modules add their own counters and gauges to the Prometheus output with addCollector (e.g. the template cache counts).
+"""
+
+import atexit, functools, json, logging, os, queue, threading, time
+
+# upper bounds (seconds) of the latency histogram buckets; a scan normally takes well under a millisecond
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+ROTATE_BYTES = 10 * 1024 * 1024
+ROTATE_BACKUPS = 5
+METRIC_PREFIX = "ttw_"
+
+
+class OperationStats:
+	"""Counts, latency histogram and last call time of one operation."""
+
+	__slots__ = ("outcomes", "buckets", "count", "total", "last_call")
+
+	def __init__(self):
+		self.outcomes = {}
+		self.buckets = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.last_call = None
+
+	def observe(self, seconds, outcome, timestamp):
+		self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+		i = 0
+		while i < len(BUCKETS) and seconds > BUCKETS[i]:
+			i += 1
+		self.buckets[i] += 1
+		self.count += 1
+		self.total += seconds
+		self.last_call = timestamp
+
+
+class EventWriter:
+	"""
+	Appends one JSON line per call to a metrics file from a background thread: the scan thread only puts a
+	tuple on a queue. The file is rotated (metrics.jsonl -> metrics.jsonl.1 -> ...) when it would grow past
+	max_bytes, keeping backups old files.
+	"""
+
+	def __init__(self, path, max_bytes=ROTATE_BYTES, backups=ROTATE_BACKUPS):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.file = open(path, "a", encoding="utf-8")
+		self.queue = queue.SimpleQueue()
+		self.thread = threading.Thread(target=self._run, name="MetricsWriter", daemon=True)
+		self.thread.start()
+
+	def put(self, event):
+		self.queue.put(event)
+
+	def close(self):
+		"""Writes every queued event, then closes the file."""
+		self.queue.put(None)
+		self.thread.join()
+		self.file.close()
+
+	def rotate(self):
+		self.file.close()
+		for i in range(self.backups - 1, 0, -1):
+			if os.path.exists("%s.%s" % (self.path, i)):
+				os.replace("%s.%s" % (self.path, i), "%s.%s" % (self.path, i + 1))
+		if self.backups > 0:
+			os.replace(self.path, self.path + ".1")
+		self.file = open(self.path, "w", encoding="utf-8")
+
+	def _run(self):
+		while True:
+			events = [self.queue.get()]
+			while not self.queue.empty():
+				events.append(self.queue.get())
+			lines = []
+			for event in events:
+				if event is None:
+					break
+				timestamp, operation, seconds, outcome = event
+				lines.append(
+					json.dumps({"ts": round(timestamp, 6), "op": operation, "ms": round(seconds * 1000, 4), "outcome": outcome})
+				)
+			try:
+				if lines:
+					text = "\n".join(lines) + "\n"
+					if self.file.tell() and self.file.tell() + len(text) > self.max_bytes:
+						self.rotate()
+					self.file.write(text)
+					self.file.flush()
+			except (OSError, ValueError) as error:
+				logging.warning("Failed to write metrics to %s: %s", self.path, error)
+			if event is None:
+				return
+
+
+class Metrics:
+	"""
+	Registry of OperationStats by operation name plus the optional JSON-lines file and Prometheus endpoint.
+	There is one per process, METRICS; observe is called from the scan thread, the exports from others.
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self.operations = {}
+		self.collectors = []
+		self.lock = threading.Lock()
+		self.events = None
+		self.metrics_file = None
+		self.server = None
+		self.port = None
+
+	def configure(self, metrics_file=None, port=None, counters=False):
+		"""
+		Enables (or, with no arguments, disables) metrics. metrics_file is the JSON-lines file to write
+		and port the local port to serve Prometheus text on; either may be left out. counters keeps the
+		counts in memory only (for snapshot/prometheusText) without either output. Counts collected so far
+		are kept.
+		"""
+		metrics_file = metrics_file or None
+		port = int(port) if port else None
+		if metrics_file != self.metrics_file:
+			self.closeFile()
+			if metrics_file is not None:
+				self.openFile(metrics_file)
+		if port != self.port:
+			self.closeServer()
+			if port is not None:
+				self.serve(port)
+		self.enabled = counters or metrics_file is not None or port is not None
+
+	def openFile(self, metrics_file):
+		self.events = EventWriter(metrics_file)
+		self.metrics_file = metrics_file
+
+	def closeFile(self):
+		"""Writes out the queued JSON lines and closes the metrics file."""
+		if self.events is not None:
+			self.events.close()
+		self.events = None
+		self.metrics_file = None
+
+	def serve(self, port):
+		# http.server is only needed for the Prometheus endpoint
+		from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+		metrics = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] not in ("/", "/metrics"):
+					self.send_error(404)
+					return
+				body = metrics.prometheusText().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+		self.port = self.server.server_address[1]
+
+	def closeServer(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+		self.server = None
+		self.port = None
+
+	def close(self):
+		self.enabled = False
+		self.closeFile()
+		self.closeServer()
+
+	def observe(self, operation, seconds, outcome="ok"):
+		"""Records one call of an operation that took seconds and ended with outcome."""
+		timestamp = time.time()
+		with self.lock:
+			stats = self.operations.get(operation)
+			if stats is None:
+				stats = self.operations[operation] = OperationStats()
+			stats.observe(seconds, outcome, timestamp)
+		events = self.events
+		if events is not None:
+			events.put((timestamp, operation, seconds, outcome))
+
+	def addCollector(self, collector):
+		"""
+		Adds a function returning [(name, type, description, value)] (type "gauge" or "counter") whose samples are
+		added to the Prometheus output.
+		"""
+		self.collectors.append(collector)
+
+	def snapshot(self):
+		"""Returns {operation: {"count", "total_s", "outcomes", "buckets", "last_call"}}, a consistent copy of the counts."""
+		with self.lock:
+			return {
+				operation: {
+					"count": stats.count,
+					"total_s": stats.total,
+					"outcomes": dict(stats.outcomes),
+					"buckets": list(stats.buckets),
+					"last_call": stats.last_call,
+				}
+				for operation, stats in self.operations.items()
+			}
+
+	def prometheusText(self):
+		"""Returns every metric in the Prometheus text exposition format."""
+		calls = METRIC_PREFIX + "operation_calls_total"
+		duration = METRIC_PREFIX + "operation_duration_seconds"
+		last_call = METRIC_PREFIX + "operation_last_call_timestamp_seconds"
+		snapshot = sorted(self.snapshot().items())
+		lines = ["# HELP %s Calls of each instrumented operation, by outcome." % calls, "# TYPE %s counter" % calls]
+		for operation, stats in snapshot:
+			for outcome, count in sorted(stats["outcomes"].items()):
+				lines.append('%s{operation="%s",outcome="%s"} %s' % (calls, operation, outcome, count))
+		lines += ["# HELP %s Duration of each instrumented operation." % duration, "# TYPE %s histogram" % duration]
+		for operation, stats in snapshot:
+			cumulative = 0
+			for bound, count in zip(BUCKETS + ("+Inf",), stats["buckets"]):
+				cumulative += count
+				lines.append('%s_bucket{operation="%s",le="%s"} %s' % (duration, operation, bound, cumulative))
+			lines.append('%s_sum{operation="%s"} %r' % (duration, operation, stats["total_s"]))
+			lines.append('%s_count{operation="%s"} %s' % (duration, operation, stats["count"]))
+		lines += ["# HELP %s Unix time of the last call of each operation." % last_call, "# TYPE %s gauge" % last_call]
+		for operation, stats in snapshot:
+			lines.append('%s{operation="%s"} %r' % (last_call, operation, stats["last_call"]))
+		for collector in self.collectors:
+			for name, kind, description, value in collector():
+				lines += ["# HELP %s%s %s" % (METRIC_PREFIX, name, description), "# TYPE %s%s %s" % (METRIC_PREFIX, name, kind)]
+				lines.append("%s%s %r" % (METRIC_PREFIX, name, value))
+		return "\n".join(lines) + "\n"
+
+	def reset(self):
+		with self.lock:
+			self.operations = {}
+
+
+METRICS = Metrics()
+atexit.register(METRICS.close)
+
+
+def instrument(operation):
+	"""Decorator that records every call of the wrapped function as operation, while metrics are enabled."""
+
+	def decorate(func):
+		@functools.wraps(func)
+		def instrumented(*args, **kwargs):
+			if not METRICS.enabled:
+				return func(*args, **kwargs)
+			start = time.perf_counter()
+			outcome = "ok"
+			try:
+				return func(*args, **kwargs)
+			except BaseException as error:
+				outcome = type(error).__name__
+				raise
+			finally:
+				METRICS.observe(operation, time.perf_counter() - start, outcome)
+
+		return instrumented
+
+	return decorate
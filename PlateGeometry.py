@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Plate geometries (rows x columns) and the order wells are filled in.
+
+Well names and the name <-> index tables are computed once per (layout, fill order) and cached,
+so protocol builds and template validation never regenerate them.
+"""
+
+from functools import lru_cache
+
+# standard plate formats: number of wells -> (rows, columns)
+STANDARD_LAYOUTS = {
+	"6": (2, 3),
+	"24": (4, 6),
+	"48": (6, 8),
+	"96": (8, 12),
+	"384": (16, 24),
+	"1536": (32, 48),
+}
+DEFAULT_LAYOUT = "96"
+
+FILL_ORDERS = ("column", "row", "serpentine")
+DEFAULT_FILL_ORDER = "column"
+
+
+def row_label(row):
+	"""Returns the letter label of a 0-based row index: A..Z, then AA, AB, ..."""
+	label = ""
+	row += 1
+	while row:
+		row, remainder = divmod(row - 1, 26)
+		label = chr(ord("A") + remainder) + label
+	return label
+
+
+class PlateGeometry:
+	"""
+	Well layout of a plate. well_names lists every well in fill order, and well_index maps a well name
+	back to its position in that order.
+
+	Fill orders:
+		column - A1, B1, C1 ... then A2, B2 ... (the original TubeToWell order)
+		row - A1, A2, A3 ... then B1, B2 ...
+		serpentine - down column 1, up column 2, down column 3 ...
+	"""
+
+	def __init__(self, num_rows, num_cols, fill_order=DEFAULT_FILL_ORDER):
+		if fill_order not in FILL_ORDERS:
+			raise ValueError(
+				"Invalid fill order %s, expected one of %s" % (fill_order, ", ".join(FILL_ORDERS))
+			)
+		if num_rows < 1 or num_cols < 1:
+			raise ValueError("A plate needs at least one row and one column")
+		self.num_rows = num_rows
+		self.num_cols = num_cols
+		self.fill_order = fill_order
+		self.rows = tuple(row_label(row) for row in range(num_rows))
+		self.cols = tuple(range(1, num_cols + 1))
+
+		if fill_order == "row":
+			names = [row + str(col) for row in self.rows for col in self.cols]
+		else:
+			names = []
+			for i, col in enumerate(self.cols):
+				rows = self.rows
+				if fill_order == "serpentine" and i % 2:
+					rows = reversed(rows)
+				names.extend(row + str(col) for row in rows)
+
+		self.well_names = tuple(names)
+		self.well_index = {name: i for i, name in enumerate(self.well_names)}
+
+	@property
+	def num_wells(self):
+		return self.num_rows * self.num_cols
+
+	def __contains__(self, well_name):
+		return well_name in self.well_index
+
+	def __len__(self):
+		return len(self.well_names)
+
+	def __repr__(self):
+		return "PlateGeometry(%s x %s, %s)" % (self.num_rows, self.num_cols, self.fill_order)
+
+
+@lru_cache(maxsize=None)
+def _cached_geometry(num_rows, num_cols, fill_order):
+	return PlateGeometry(num_rows, num_cols, fill_order)
+
+
+def plate_geometry(num_wells=DEFAULT_LAYOUT, fill_order=DEFAULT_FILL_ORDER, custom_layout=None):
+	"""
+	Returns the (cached) PlateGeometry for a plate format.
+
+	num_wells is one of the standard formats ("6", "24", "48", "96", "384", "1536") - anything else
+	falls back to 96 wells, as TubeToWell always has. custom_layout, a dict with "rows" and "columns",
+	overrides num_wells for non-standard plates.
+	"""
+	if custom_layout:
+		num_rows, num_cols = int(custom_layout["rows"]), int(custom_layout["columns"])
+	else:
+		num_rows, num_cols = STANDARD_LAYOUTS.get(str(num_wells), STANDARD_LAYOUTS[DEFAULT_LAYOUT])
+	return _cached_geometry(num_rows, num_cols, fill_order or DEFAULT_FILL_ORDER)
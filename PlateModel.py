@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Compact, array-backed storage for the transfers of a single plate.
+
+Instead of one Transfer dict (keyed by a uuid) per well, a PlateModel keeps one column per field
+(status, source tube, timestamp and well index) and hands out lightweight TTWTransfer row views.
+Transfer ids are plain row numbers. The views support the same access patterns as WellLit's
+Transfer (transfer["status"], transfer.status, updateStatus, resetTransfer), so the rest of the
+code does not need to know how transfers are stored.
+
+The plate also keeps one bucket of transfer ids per status, updated on every status change, so the
+protocol never has to re-sort its transfers to know which are completed, started or still to do.
+"""
+
+import time
+from array import array
+from WellLit.Transfer import TStatus
+
+# transfer timestamps, as written to the records and read back by RecordReader
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+STATUSES = list(TStatus)
+UNCOMPLETED = STATUSES.index(TStatus.uncompleted)
+
+# map every spelling of a status (member, name, value) to its code in STATUSES
+STATUS_CODES = {}
+for _code, _status in enumerate(STATUSES):
+	STATUS_CODES[_status] = _code
+	STATUS_CODES[_status.name] = _code
+	STATUS_CODES[_status.value] = _code
+
+
+class PlateModel:
+	"""
+	Struct-of-arrays table of transfers for one plate, indexed by transfer id.
+	"""
+
+	__slots__ = (
+		"protocol",
+		"undo_history",
+		"dest_plate",
+		"well_names",
+		"well_lookup",
+		"well_index",
+		"status_codes",
+		"source_tubes",
+		"timestamps",
+		"buckets",
+	)
+
+	def __init__(self, well_names, dest_plate=None, protocol=None):
+		self.protocol = protocol
+		# the ProtocolHistory recording the action in progress, told about every row before it changes
+		self.undo_history = None
+		self.dest_plate = dest_plate
+		# names of every well on the plate, indexed by well_index
+		self.well_names = list(well_names)
+		self.well_lookup = {name: i for i, name in enumerate(self.well_names)}
+		self.well_index = array("H")
+		self.status_codes = array("b")
+		self.source_tubes = []
+		self.timestamps = []
+		# one insertion-ordered dict of transfer ids per status code
+		self.buckets = [{} for _ in STATUSES]
+
+	def copy(self, protocol=None, dest_plate=None):
+		"""Returns an independent copy of the table, owned by another protocol and destination plate."""
+		plate = PlateModel.__new__(PlateModel)
+		plate.protocol = protocol
+		plate.undo_history = None
+		plate.dest_plate = dest_plate
+		plate.well_names = list(self.well_names)
+		plate.well_lookup = dict(self.well_lookup)
+		plate.well_index = array("H", self.well_index)
+		plate.status_codes = array("b", self.status_codes)
+		plate.source_tubes = list(self.source_tubes)
+		plate.timestamps = list(self.timestamps)
+		plate.buckets = [dict(bucket) for bucket in self.buckets]
+		return plate
+
+	def setStatus(self, tf_id, status):
+		"""Sets a transfer's status, moving it to the matching status bucket."""
+		code = STATUS_CODES[status]
+		old_code = self.status_codes[tf_id]
+		if code != old_code:
+			del self.buckets[old_code][tf_id]
+			self.buckets[code][tf_id] = None
+			self.status_codes[tf_id] = code
+
+	def idsWithStatus(self, status):
+		"""Returns the ids of every transfer with a status, in the order they reached it."""
+		return list(self.buckets[STATUS_CODES[status]])
+
+	def countWithStatus(self, status):
+		return len(self.buckets[STATUS_CODES[status]])
+
+	def addRows(self, wells, source_tubes=None):
+		"""Appends one uncompleted transfer per well, returning the new transfer ids."""
+		lookup = self.well_lookup
+		first_id = len(self.status_codes)
+		for well in wells:
+			if well not in lookup:
+				lookup[well] = len(self.well_names)
+				self.well_names.append(well)
+			self.well_index.append(lookup[well])
+		count = len(self.well_index) - first_id
+		tubes = list(source_tubes) if source_tubes is not None else [None] * count
+		self.status_codes.extend(array("b", [UNCOMPLETED]) * count)
+		self.source_tubes.extend(tubes)
+		self.timestamps.extend([None] * count)
+		new_ids = range(first_id, first_id + count)
+		self.buckets[UNCOMPLETED].update(dict.fromkeys(new_ids))
+		return new_ids
+
+	# mapping interface, so protocol.transfers[tf_id] keeps working
+	def __getitem__(self, tf_id):
+		if not 0 <= tf_id < len(self.status_codes):
+			raise KeyError(tf_id)
+		return TTWTransfer(self, tf_id)
+
+	def __contains__(self, tf_id):
+		return isinstance(tf_id, int) and 0 <= tf_id < len(self.status_codes)
+
+	def __iter__(self):
+		return iter(range(len(self.status_codes)))
+
+	def __len__(self):
+		return len(self.status_codes)
+
+	def keys(self):
+		return range(len(self.status_codes))
+
+	def values(self):
+		return (TTWTransfer(self, tf_id) for tf_id in range(len(self.status_codes)))
+
+	def items(self):
+		return ((tf_id, TTWTransfer(self, tf_id)) for tf_id in range(len(self.status_codes)))
+
+	def get(self, tf_id, default=None):
+		return self[tf_id] if tf_id in self else default
+
+
+class StatusLists:
+	"""
+	Read-only stand-in for TransferProtocol.lists backed by a PlateModel's status buckets:
+	lists["completed"] etc. return the ids with that status without re-sorting the protocol.
+	"""
+
+	__slots__ = ("plate",)
+
+	def __init__(self, plate):
+		self.plate = plate
+
+	def __getitem__(self, status):
+		return self.plate.idsWithStatus(status)
+
+	def __contains__(self, status):
+		return status in STATUS_CODES
+
+	def __iter__(self):
+		return (status.value for status in STATUSES)
+
+	def __len__(self):
+		return len(STATUSES)
+
+	def keys(self):
+		return list(self)
+
+	def values(self):
+		return [self[status] for status in self]
+
+	def items(self):
+		return [(status, self[status]) for status in self]
+
+	def get(self, status, default=None):
+		return self[status] if status in self else default
+
+
+class TTWTransfer:
+	"""
+	Row view onto a PlateModel with the interface of WellLit's Transfer.
+
+	updateStatus and resetTransfer write the plate's columns directly, with the same effect as
+	Transfer's own methods: a status change stamps the current time, a reset clears the status,
+	timestamp and source tube. Changes to the source tube or status are reported back to the owning
+	protocol so its lookup indexes never go stale.
+	"""
+
+	__slots__ = ("plate", "id")
+
+	def __init__(self, plate, tf_id):
+		self.plate = plate
+		self.id = tf_id
+
+	@property
+	def status(self):
+		return STATUSES[self.plate.status_codes[self.id]]
+
+	@status.setter
+	def status(self, status):
+		if self.plate.undo_history is not None:
+			self.plate.undo_history.noteRow(self.id)
+		self.plate.setStatus(self.id, status)
+
+	def __getitem__(self, key):
+		plate = self.plate
+		if key == "status":
+			return STATUSES[plate.status_codes[self.id]].name
+		elif key == "source_tube":
+			return plate.source_tubes[self.id]
+		elif key == "timestamp":
+			return plate.timestamps[self.id]
+		elif key == "dest_well":
+			return plate.well_names[plate.well_index[self.id]]
+		elif key == "dest_plate":
+			return plate.dest_plate
+		elif key == "id":
+			return self.id
+		elif key in ("source_plate", "source_well"):
+			return None
+		raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		plate = self.plate
+		if plate.undo_history is not None:
+			plate.undo_history.noteRow(self.id)
+		if key == "status":
+			plate.setStatus(self.id, value)
+		elif key == "source_tube":
+			plate.source_tubes[self.id] = value
+		elif key == "timestamp":
+			plate.timestamps[self.id] = value
+		elif key == "dest_plate":
+			plate.dest_plate = value
+		elif key not in ("id", "dest_well", "source_plate", "source_well"):
+			raise KeyError(key)
+		if key in ("source_tube", "status") and plate.protocol is not None:
+			plate.protocol.reindexTransfer(self)
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def keys(self):
+		return ["id", "source_plate", "dest_plate", "source_well", "dest_well", "source_tube", "status", "timestamp"]
+
+	def updateStatus(self, status):
+		"""Sets the status (a TStatus) and stamps the transfer with the current time."""
+		plate = self.plate
+		if plate.undo_history is not None:
+			plate.undo_history.noteRow(self.id)
+		plate.setStatus(self.id, status)
+		plate.timestamps[self.id] = time.strftime(TIMESTAMP_FORMAT)
+		if plate.protocol is not None:
+			plate.protocol.reindexTransfer(self)
+
+	def resetTransfer(self):
+		"""Puts the transfer back to uncompleted, with no timestamp or source tube."""
+		plate = self.plate
+		if plate.undo_history is not None:
+			plate.undo_history.noteRow(self.id)
+		plate.setStatus(self.id, TStatus.uncompleted)
+		plate.timestamps[self.id] = None
+		plate.source_tubes[self.id] = None
+		if plate.protocol is not None:
+			plate.protocol.reindexTransfer(self)
+
+	def __eq__(self, other):
+		return isinstance(other, TTWTransfer) and other.plate is self.plate and other.id == self.id
+
+	def __hash__(self):
+		return hash((id(self.plate), self.id))
+
+	def __repr__(self):
+		return repr({key: self[key] for key in self.keys()})
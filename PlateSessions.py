@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Several destination plates in progress at once from one TubeToWell.
+
+TubeToWell works on a single plate: its tp, plate_barcode, csv, session journal, template
+(barcode_to_well, controls) and so on. PlateSessionManager keeps those per-plate attributes for every
+plate in progress, keyed by plate barcode, and switches the active plate by swapping them in and out of
+the TubeToWell. Switching never rebuilds a protocol or re-reads a template, and all of TubeToWell's
+existing logic (next, undo, records, session journal) keeps working on whichever plate is active.
+
+The sample list is shared by every plate. A TubeIndex of the tubes placed in every plate in progress lets
+TubeToWell.next reject a tube already scanned into another plate with a single dict lookup.
+"""
+
+from WellLit.Transfer import TError
+from TubeToWell import EMPTY_FLAG
+from SessionJournal import read_session_header
+
+# TubeToWell attributes that belong to a single plate; everything else (configuration, sample list,
+# record writer) is shared
+PLATE_FIELDS = (
+	"tp",
+	"timestamp",
+	"user",
+	"plate_barcode",
+	"csv",
+	"metadata",
+	"controls",
+	"barcode_to_well",
+	"scanned_out",
+	"warningsMade",
+	"warning_file_path",
+	"record_journals",
+	"session",
+	"batch",
+	"batch_position",
+)
+
+# statuses of a transfer whose tube is in the well
+PLACED_STATUSES = ("started", "completed")
+
+
+class TubeIndex:
+	"""
+	tube barcode -> {plate barcode: well} for every tube in a started or completed well of a plate in
+	progress. Kept live by the protocols it is attached to (see TTWTransferProtocol.reindexTransfer).
+	"""
+
+	def __init__(self):
+		self.tubes = {}
+
+	def platesWith(self, barcode):
+		"""Returns {plate barcode: well} of the plates holding this tube."""
+		return self.tubes.get(barcode, {})
+
+	def refresh(self, tp, *barcodes):
+		"""Re-reads where the given tubes are in a protocol's plate after one of its transfers changed."""
+		for barcode in barcodes:
+			if barcode is None or barcode == EMPTY_FLAG:
+				continue
+			well = None
+			for tf_id, status in tp.transfersWithBarcode(barcode).items():
+				if status in PLACED_STATUSES:
+					well = tp.transfers[tf_id]["dest_well"]
+					break
+			if well is not None:
+				self.tubes.setdefault(barcode, {})[tp.index_key] = well
+			else:
+				plates = self.tubes.get(barcode)
+				if plates is not None and tp.index_key in plates:
+					del plates[tp.index_key]
+					if not plates:
+						del self.tubes[barcode]
+
+	def attach(self, plate_barcode, tp):
+		"""Starts tracking the tubes of a plate's protocol."""
+		tp.tube_index = self
+		tp.index_key = plate_barcode
+		self.refresh(tp, *list(tp.barcode_index))
+
+	def detach(self, tp):
+		"""Stops tracking a protocol, forgetting its tubes."""
+		for barcode in list(tp.barcode_index):
+			plates = self.tubes.get(barcode)
+			if plates is not None and tp.index_key in plates:
+				del plates[tp.index_key]
+				if not plates:
+					del self.tubes[barcode]
+		tp.tube_index = None
+		tp.index_key = None
+
+
+class PlateSessionManager:
+	"""
+	Holds the plates in progress on a TubeToWell, keyed by plate barcode. The TubeToWell always works on
+	the active plate; the others are kept as {field: value} dicts of their PLATE_FIELDS.
+
+	Starting the first plate adopts the TubeToWell's current protocol, so a single plate runs exactly as
+	it did without the manager.
+	"""
+
+	def __init__(self, ttw):
+		self.ttw = ttw
+		self.plates = {}
+		self.active = None
+		self.tubes = TubeIndex()
+		ttw.tube_index = self.tubes
+
+	def __len__(self):
+		return len(self.plates)
+
+	def __contains__(self, plate_barcode):
+		return plate_barcode in self.plates
+
+	def fail(self, msg):
+		self.ttw.log(msg)
+		raise TError(self.ttw.msg)
+
+	def store(self):
+		"""Saves the active plate's fields from the TubeToWell."""
+		ttw = self.ttw
+		self.plates[self.active] = {field: getattr(ttw, field) for field in PLATE_FIELDS}
+
+	def restore(self, plate_barcode):
+		"""Makes a stored plate the active one."""
+		ttw = self.ttw
+		for field, value in self.plates[plate_barcode].items():
+			setattr(ttw, field, value)
+		self.active = plate_barcode
+
+	def clearPlate(self):
+		"""Gives the TubeToWell a fresh protocol for a new plate, with the template of the last active plate."""
+		ttw = self.ttw
+		ttw.session = None
+		ttw.timestamp = ""
+		ttw.plate_barcode = ""
+		ttw.metadata = ""
+		ttw.user = ""
+		ttw.csv = ""
+		ttw.scanned_out = True
+		ttw.warningsMade = False
+		ttw.warning_file_path = ""
+		ttw.record_journals = {}
+		ttw.batch = None
+		ttw.batch_position = 0
+		ttw.tp = ttw.buildProtocol()
+		self.active = None
+
+	def startPlate(self, plate_barcode, user, template=None):
+		"""
+		Starts a new plate and makes it the active one. template, if given, is loaded for the new plate
+		only; otherwise it uses the template of the plate that was active.
+		"""
+		if plate_barcode in self.plates:
+			self.fail("Plate %s is already in progress" % plate_barcode)
+		previous = self.active
+		if previous is not None:
+			self.store()
+			self.clearPlate()
+		if template is not None:
+			try:
+				self.ttw.loadWellConfigurationCSV(template)
+			except TError:
+				if previous is not None:
+					self.restore(previous)
+				raise
+		self.ttw.setMetaData(plate_barcode=plate_barcode, user=user)
+		self.tubes.attach(plate_barcode, self.ttw.tp)
+		self.plates[plate_barcode] = None
+		self.active = plate_barcode
+
+	def resumePlate(self, path):
+		"""Resumes an unfinished plate from its session journal and makes it the active one."""
+		try:
+			plate_barcode = read_session_header(path)["plate_barcode"]
+		except (OSError, ValueError, KeyError) as err:
+			self.fail("Cannot resume the plate from %s: %s" % (path, err))
+		if plate_barcode in self.plates:
+			self.fail("Plate %s is already in progress" % plate_barcode)
+		previous = self.active
+		if previous is not None:
+			self.store()
+			self.clearPlate()
+		try:
+			self.ttw.resumeSession(path)
+		except TError:
+			if previous is not None:
+				self.restore(previous)
+			raise
+		self.tubes.attach(plate_barcode, self.ttw.tp)
+		self.plates[plate_barcode] = None
+		self.active = plate_barcode
+
+	def switchPlate(self, plate_barcode):
+		"""Makes another plate in progress the active one."""
+		if plate_barcode == self.active:
+			return
+		if plate_barcode not in self.plates:
+			self.fail("Plate %s is not in progress" % plate_barcode)
+		if self.active is not None:
+			self.store()
+		self.restore(plate_barcode)
+
+	def finishPlate(self, plate_barcode=None):
+		"""
+		Writes the final record of a plate (the active one by default) and drops it. The most recently
+		started remaining plate becomes active; when none is left the TubeToWell is reset as before.
+		Returns the barcode of the new active plate, or None.
+		"""
+		ttw = self.ttw
+		if plate_barcode is not None:
+			self.switchPlate(plate_barcode)
+		ttw.compactTransferRecordFiles()
+		if self.active is None:
+			ttw.reset()
+			return None
+		self.tubes.detach(ttw.tp)
+		del self.plates[self.active]
+		self.active = None
+		if self.plates:
+			ttw.endSession()
+			self.restore(list(self.plates)[-1])
+		else:
+			ttw.reset()
+		return self.active
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Multi-level undo/redo of the actions on a plate.
+
+TTWTransferProtocol.undo and undoCurrentScan only take back the last tube, once. ProtocolHistory keeps
+the last HISTORY_DEPTH actions (scans, undos, skips, discards, racks) as deltas instead: while an action
+runs, the PlateModel row views and moveToCurrent report every transfer and transfer sequence position
+about to change, and the history saves their values from before the action. When the action ends the
+new values of just those rows and positions are saved next to them, along with the protocol's cursor
+(_current_idx, canUndo, lightup_well) and TubeToWell.scanned_out.
+
+Undoing or redoing a step writes back the saved values of the rows and positions it changed, so it costs
+O(changed wells) whatever the plate size, and memory is bounded by the history depth times the wells an
+action touches (one or two for a scan). A new action clears the redo steps.
+"""
+
+from collections import deque
+from PlateModel import STATUSES
+
+# actions kept for undo
+HISTORY_DEPTH = 50
+# statuses of a transfer whose tube was placed, which get a warning row when an undo or redo changes them
+PLACED_STATUSES = ("started", "completed", "discarded")
+
+
+class HistoryStep:
+	"""The values an action changed: {tf_id: (status code, source tube, timestamp)}, {tf_seq position: tf_id} and the cursor, before and after."""
+
+	__slots__ = ("rows_before", "rows_after", "seq_before", "seq_after", "cursor_before", "cursor_after")
+
+	def __init__(self, rows_before, seq_before, cursor_before):
+		self.rows_before = rows_before
+		self.seq_before = seq_before
+		self.cursor_before = cursor_before
+		self.rows_after = None
+		self.seq_after = None
+		self.cursor_after = None
+
+
+class ProtocolHistory:
+	"""
+	Undo and redo stacks of HistorySteps for one protocol. begin/commit bracket an action (see the
+	recorded decorator in TubeToWell.py); noteRow and noteSeq are called before a row or a slice of tf_seq
+	changes while one is being recorded.
+	"""
+
+	def __init__(self, protocol, depth=HISTORY_DEPTH):
+		self.protocol = protocol
+		self.undo_steps = deque(maxlen=depth)
+		self.redo_steps = []
+		self.step = None
+
+	@property
+	def recording(self):
+		return self.step is not None
+
+	def cursor(self, ttw):
+		tp = self.protocol
+		return (tp._current_idx, tp.canUndo, tp.lightup_well, ttw.scanned_out)
+
+	def row(self, tf_id):
+		plate = self.protocol.plate
+		return (plate.status_codes[tf_id], plate.source_tubes[tf_id], plate.timestamps[tf_id])
+
+	def begin(self, ttw):
+		self.step = HistoryStep({}, {}, self.cursor(ttw))
+		self.protocol.plate.undo_history = self
+
+	def noteRow(self, tf_id):
+		"""Saves a transfer's values before the action being recorded first changes it."""
+		rows = self.step.rows_before
+		if tf_id not in rows:
+			rows[tf_id] = self.row(tf_id)
+
+	def noteSeq(self, start, stop):
+		"""Saves tf_seq[start:stop] before the action being recorded first rearranges it."""
+		tf_seq = self.protocol.tf_seq
+		seq = self.step.seq_before
+		for position in range(start, stop):
+			if position not in seq:
+				seq[position] = tf_seq[position]
+
+	def commit(self, ttw):
+		"""Ends the action being recorded, keeping it as an undo step if it changed anything."""
+		step, self.step = self.step, None
+		self.protocol.plate.undo_history = None
+		tf_seq = self.protocol.tf_seq
+		step.rows_after = {tf_id: self.row(tf_id) for tf_id in step.rows_before}
+		for tf_id, row in list(step.rows_after.items()):
+			if row == step.rows_before[tf_id]:
+				del step.rows_after[tf_id], step.rows_before[tf_id]
+		step.seq_after = {position: tf_seq[position] for position in step.seq_before}
+		for position, tf_id in list(step.seq_after.items()):
+			if tf_id == step.seq_before[position]:
+				del step.seq_after[position], step.seq_before[position]
+		step.cursor_after = self.cursor(ttw)
+		if step.rows_after or step.seq_after or step.cursor_after != step.cursor_before:
+			self.undo_steps.append(step)
+			self.redo_steps = []
+
+	def canUndo(self):
+		return bool(self.undo_steps)
+
+	def canRedo(self):
+		return bool(self.redo_steps)
+
+	def undo(self, ttw, count=1):
+		"""
+		Takes back up to count actions, most recent first. Returns (number of actions undone, warning rows
+		for the placed transfers that changed: [timestamp, tube, plate, well, status]).
+		"""
+		warnings = []
+		undone = 0
+		while undone < count and self.undo_steps:
+			step = self.undo_steps.pop()
+			self.apply(ttw, step.rows_before, step.seq_before, step.cursor_before, warnings)
+			self.redo_steps.append(step)
+			undone += 1
+		return undone, warnings
+
+	def redo(self, ttw, count=1):
+		"""Makes up to count undone actions again, oldest first. Returns like undo."""
+		warnings = []
+		redone = 0
+		while redone < count and self.redo_steps:
+			step = self.redo_steps.pop()
+			self.apply(ttw, step.rows_after, step.seq_after, step.cursor_after, warnings)
+			self.undo_steps.append(step)
+			redone += 1
+		return redone, warnings
+
+	def apply(self, ttw, rows, seq, cursor, warnings):
+		tp = self.protocol
+		plate = tp.plate
+		for tf_id, (code, source_tube, timestamp) in rows.items():
+			transfer = tp.transfers[tf_id]
+			if transfer["status"] in PLACED_STATUSES:
+				warnings.append([transfer[key] for key in ("timestamp", "source_tube", "dest_plate", "dest_well", "status")])
+			plate.setStatus(tf_id, STATUSES[code])
+			plate.source_tubes[tf_id] = source_tube
+			plate.timestamps[tf_id] = timestamp
+		if seq:
+			for position, tf_id in seq.items():
+				tp.tf_seq[position] = tf_id
+			# give each run of rewritten positions order keys that follow the restored sequence again
+			positions = sorted(seq)
+			start = previous = positions[0]
+			for position in positions[1:]:
+				if position != previous + 1:
+					tp.allocator.rekey(start, previous + 1)
+					start = position
+				previous = position
+			tp.allocator.rekey(start, previous + 1)
+		for tf_id in rows:
+			tp.reindexTransfer(tp.transfers[tf_id])
+		tp._current_idx, tp.canUndo, tp.lightup_well, ttw.scanned_out = cursor
+		tp.synchronize()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Reads the record csvs TubeToWell writes, for reconciliation and analysis.
+
+A records directory holds one <timestamp>_<plate>_tube_to_plate.csv per plate (plus a .journal while
+the plate is in progress) and a <record>_WARNING.csv for every plate where a tube was undone. Both start
+with the four metadata rows written by record_metadata:
+
+	%Plate Timestamp: ,20240101-120000
+	%Username: ,<user>
+	%Plate Barcode: ,<plate barcode>
+	%Timestamp,Tube Barcode,Location
+
+followed, in a record, by one row per used well: <timestamp>,<tube barcode>,<well>. A discarded well has
+"-discarded" appended to its tube barcode, and a skipped well has the tube barcode EMPTY. A warning file
+has one more header row, then one row per undone tube:
+<timestamp>,<tube barcode>,<plate>,<well>,<status>, Marked Undone at <timestamp>.
+
+read_record_file/read_warning_file turn a file into RecordRows; stream_records reads a whole directory,
+fanning the files out across a process pool when there are many; export_records writes the rows to one
+columnar file (Parquet if pyarrow is installed, otherwise csv or csv.gz).
+
+	python RecordReader.py <records_dir> -o all_records.parquet [--workers 4] [--no-warnings]
+"""
+
+import argparse, csv, glob, gzip, itertools, os, sys, time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from TransferRecords import DISCARDED_SUFFIX, JOURNAL_EXTENSION, METADATA_ROWS, read_transfer_journal
+
+RECORD_SUFFIX = "_tube_to_plate.csv"
+WARNING_SUFFIX = "_WARNING.csv"
+# tube barcode of a skipped well, see TubeToWell.EMPTY_FLAG
+EMPTY_FLAG = "EMPTY"
+UNDONE_PREFIX = "Marked Undone at "
+PLATE_TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+# below this many files a directory is read in this process
+PARALLEL_THRESHOLD = 32
+# rows per Parquet record batch, so exports stream instead of holding every row
+EXPORT_BATCH_ROWS = 65536
+
+# kind: "record" (a well of a plate) or "warning" (an undone tube)
+# status: "completed", "started" (plate still in progress), "discarded" or "empty" (a skipped well)
+RECORD_FIELDS = (
+	"kind",
+	"record",
+	"plate_barcode",
+	"user",
+	"plate_timestamp",
+	"timestamp",
+	"tube",
+	"well",
+	"status",
+	"undone_at",
+)
+RecordRow = namedtuple("RecordRow", RECORD_FIELDS)
+TIMESTAMP_FIELDS = ("plate_timestamp", "timestamp", "undone_at")
+
+
+def parse_timestamp(value, format=None):
+	"""Returns a datetime for a record timestamp, or None if it is blank or not a timestamp."""
+	value = (value or "").strip()
+	if not value:
+		return None
+	try:
+		if format is None:
+			return datetime.fromisoformat(value)
+		return datetime.strptime(value, format)
+	except ValueError:
+		return None
+
+
+def record_name(path):
+	"""The name of a record (or warning) file without its extensions."""
+	name = os.path.basename(str(path))
+	for suffix in (JOURNAL_EXTENSION, WARNING_SUFFIX, ".csv"):
+		if name.endswith(suffix):
+			name = name[: -len(suffix)]
+	return name
+
+
+def parse_metadata(metadata):
+	"""Returns (plate barcode, user, plate timestamp) from the metadata rows, or None if they aren't record metadata."""
+	if len(metadata) < 3 or not metadata[0] or not metadata[0][0].startswith("%Plate Timestamp"):
+		return None
+
+	def value(row):
+		return row[1].strip() if len(row) > 1 else ""
+
+	return value(metadata[2]), value(metadata[1]), parse_timestamp(value(metadata[0]), PLATE_TIMESTAMP_FORMAT)
+
+
+def split_tube(barcode, status):
+	"""Applies the -discarded suffix and EMPTY conventions: returns (tube barcode or None, status)."""
+	if barcode.endswith(DISCARDED_SUFFIX):
+		barcode = barcode[: -len(DISCARDED_SUFFIX)]
+		status = "discarded"
+	if barcode == EMPTY_FLAG:
+		return None, "empty"
+	return barcode or None, status
+
+
+def read_record_file(path):
+	"""
+	Returns the RecordRows of a record csv, including the changes in its journal if the plate is still
+	in progress (or was never finished). Returns [] if the file is not a record.
+	"""
+	metadata, rows = read_transfer_journal(path)
+	header = parse_metadata(metadata)
+	if header is None:
+		return []
+	plate_barcode, user, plate_timestamp = header
+	name = record_name(path)
+	# most wells of a plate share a handful of timestamps; parse (and later pickle) each one once
+	timestamps = {}
+	records = []
+	for timestamp, barcode, well, status in rows:
+		if timestamp not in timestamps:
+			timestamps[timestamp] = parse_timestamp(timestamp)
+		tube, status = split_tube(barcode, status)
+		records.append(
+			RecordRow("record", name, plate_barcode, user, plate_timestamp, timestamps[timestamp], tube, well, status, None)
+		)
+	return records
+
+
+def read_warning_file(path):
+	"""Returns the RecordRows (kind "warning") of the tubes undone on a plate."""
+	with open(path, newline="") as warning_file:
+		rows = list(csv.reader(warning_file))
+	header = parse_metadata(rows[:METADATA_ROWS])
+	if header is None:
+		return []
+	plate_barcode, user, plate_timestamp = header
+	name = record_name(path)
+	records = []
+	# the metadata rows are followed by the warning file's own column header
+	for row in rows[METADATA_ROWS + 1 :]:
+		if len(row) < 5:
+			continue
+		timestamp, barcode, _, well, status = row[:5]
+		undone_at = row[5].strip() if len(row) > 5 else ""
+		if undone_at.startswith(UNDONE_PREFIX):
+			undone_at = undone_at[len(UNDONE_PREFIX) :]
+		tube, status = split_tube(barcode, status)
+		records.append(
+			RecordRow(
+				"warning",
+				name,
+				plate_barcode,
+				user,
+				plate_timestamp,
+				parse_timestamp(timestamp),
+				tube,
+				well,
+				status,
+				parse_timestamp(undone_at, PLATE_TIMESTAMP_FORMAT),
+			)
+		)
+	return records
+
+
+def read_file(path):
+	if path.endswith(WARNING_SUFFIX):
+		return read_warning_file(path)
+	return read_record_file(path)
+
+
+def read_file_tuples(path):
+	"""read_file for the process pool: plain tuples pickle several times faster than RecordRows."""
+	return [tuple(row) for row in read_file(path)]
+
+
+def find_record_files(records_dir, warnings=True):
+	"""Returns the record csvs (existing or only journaled) and, optionally, warning files in a directory."""
+	pattern = os.path.join(glob.escape(records_dir), "*")
+	paths = set()
+	for path in glob.glob(pattern + RECORD_SUFFIX):
+		paths.add(path)
+	for path in glob.glob(pattern + RECORD_SUFFIX + JOURNAL_EXTENSION):
+		paths.add(path[: -len(JOURNAL_EXTENSION)])
+	if warnings:
+		paths.update(glob.glob(pattern + WARNING_SUFFIX))
+	return sorted(paths)
+
+
+def stream_records(records_dir, warnings=True, workers=None):
+	"""
+	Yields the RecordRows of every record (and warning) file in a directory, file by file in name order.
+	Large directories are parsed on a process pool of workers processes (default: one per cpu).
+	"""
+	paths = find_record_files(records_dir, warnings)
+	if len(paths) < PARALLEL_THRESHOLD or workers == 1:
+		for path in paths:
+			yield from read_file(path)
+		return
+	chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		for rows in executor.map(read_file_tuples, paths, chunksize=chunksize):
+			yield from map(RecordRow._make, rows)
+
+
+def export_records(rows, path):
+	"""
+	Writes rows to path as one table with a column per RECORD_FIELDS: Parquet for *.parquet (needs
+	pyarrow), otherwise csv (gzip-compressed for *.gz). Returns the number of rows written.
+	"""
+	if path.endswith(".parquet"):
+		# pyarrow is optional, only needed for Parquet exports
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+
+		schema = pa.schema(
+			[(field, pa.timestamp("s") if field in TIMESTAMP_FIELDS else pa.string()) for field in RECORD_FIELDS]
+		)
+		count = 0
+		with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+			rows = iter(rows)
+			while True:
+				batch = list(itertools.islice(rows, EXPORT_BATCH_ROWS))
+				if not batch:
+					break
+				arrays = [pa.array(column, field.type) for column, field in zip(zip(*batch), schema)]
+				writer.write_batch(pa.record_batch(arrays, schema=schema))
+				count += len(batch)
+		return count
+
+	if path.endswith(".gz"):
+		export_file = gzip.open(path, "wt", newline="", compresslevel=6)
+	else:
+		export_file = open(path, "w", newline="")
+	count = 0
+	with export_file:
+		writer = csv.writer(export_file)
+		writer.writerow(RECORD_FIELDS)
+		for row in rows:
+			writer.writerow(["" if value is None else value for value in row])
+			count += 1
+	return count
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("records_dir", nargs="?", default="records")
+	parser.add_argument("-o", "--output", help="combined file to write: .parquet, .csv or .csv.gz")
+	parser.add_argument("--workers", type=int, default=None, help="parser processes (default: one per cpu)")
+	parser.add_argument("--no-warnings", action="store_true", help="leave out the _WARNING.csv files")
+	args = parser.parse_args(argv)
+
+	start = time.perf_counter()
+	counts = Counter()
+
+	def counted(rows):
+		for row in rows:
+			counts[(row.kind, row.status)] += 1
+			yield row
+
+	rows = counted(stream_records(args.records_dir, not args.no_warnings, args.workers))
+	if args.output:
+		try:
+			export_records(rows, args.output)
+		except ImportError:
+			print("Writing Parquet needs pyarrow (pip install pyarrow); use a .csv or .csv.gz output instead", file=sys.stderr)
+			return 2
+	else:
+		for _ in rows:
+			pass
+	for (kind, status), count in sorted(counts.items()):
+		print("{:<10}{:<12}{:>10}".format(kind, status, count))
+	print("%s rows in %.2f s" % (sum(counts.values()), time.perf_counter() - start))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
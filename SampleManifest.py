@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Sample manifests: the list of tube barcodes a plate is restricted to.
+
+A manifest is a csv file with a header row followed by one sample id per row in the first column
+(any further columns are ignored). Files are streamed row by row, so large LIMS exports never need
+to be held in memory as anything but the final set of ids.
+"""
+
+import csv, hashlib, json, logging, mmap, os, struct
+
+MAX_REPORTED = 20
+
+
+class SampleManifest:
+	"""
+	Set of sample ids loaded from a manifest, plus what was rejected while loading.
+
+	samples is a frozenset, so checking a scanned barcode against the manifest takes constant time.
+	duplicates lists ids which appeared more than once, malformed lists (row number, value) of ids which
+	were not accepted.
+	"""
+
+	def __init__(self, samples, duplicates=None, malformed=None, filename=None):
+		self.samples = frozenset(samples)
+		self.duplicates = duplicates or []
+		self.malformed = malformed or []
+		self.filename = filename
+
+	def __contains__(self, barcode):
+		return barcode in self.samples
+
+	def __len__(self):
+		return len(self.samples)
+
+	def __iter__(self):
+		return iter(self.samples)
+
+	def report(self):
+		return manifest_report(self)
+
+
+def manifest_report(manifest):
+	"""
+	Returns a human readable summary of a manifest's duplicate and malformed ids, or an empty string if
+	there were none.
+	"""
+	lines = []
+	if manifest.duplicates:
+		lines.append(
+			"%s duplicate sample id(s): %s"
+			% (len(manifest.duplicates), ", ".join(manifest.duplicates[:MAX_REPORTED]))
+		)
+	if manifest.malformed:
+		lines.append(
+			"%s malformed sample id(s) were skipped: %s"
+			% (
+				len(manifest.malformed),
+				", ".join("row %s (%r)" % tuple(entry) for entry in manifest.malformed[:MAX_REPORTED]),
+			)
+		)
+	return "\n".join(lines)
+
+
+def is_malformed(sample_id):
+	"""Sample ids are single tokens of printable characters."""
+	return any(char.isspace() or not char.isprintable() for char in sample_id)
+
+
+def read_sample_ids(filename):
+	"""
+	Yields (row number, sample id) for every non-blank row after the header, with surrounding whitespace
+	stripped. A UTF-8 byte order mark at the start of the file is ignored.
+	"""
+	with open(filename, newline="", encoding="utf-8-sig") as samples_file:
+		reader = csv.reader(samples_file)
+		next(reader, None)
+		for row_number, row in enumerate(reader, start=2):
+			if not row:
+				continue
+			sample_id = row[0].strip()
+			if sample_id == "" and not any(cell.strip() for cell in row):
+				continue
+			yield row_number, sample_id
+
+
+def load_sample_manifest(filename):
+	"""Streams a manifest csv into a SampleManifest."""
+	samples = set()
+	duplicates = []
+	malformed = []
+	for row_number, sample_id in read_sample_ids(filename):
+		if sample_id == "" or is_malformed(sample_id):
+			malformed.append((row_number, sample_id))
+		elif sample_id in samples:
+			duplicates.append(sample_id)
+		else:
+			samples.add(sample_id)
+	return SampleManifest(samples, duplicates, malformed, filename=filename)
+
+
+# On-disk manifest index
+#
+# A manifest that has been loaded once is written to <cache dir>/<hash of its path>.idx as a sorted table
+# of fixed-width, NUL padded UTF-8 ids. Later loads mmap the table instead of re-parsing the csv, and the
+# pages are shared between processes; a barcode is looked up with an O(log n) binary search over the
+# table. The header records the size, mtime and sha256 of the source csv; the index is rebuilt whenever
+# the csv's contents change, and only takes the new mtime when the csv was touched without changing.
+#
+#	header: magic, version, record width, record count, source size, source mtime (ns), source sha256,
+#	        length of the trailing json report
+#	table:  record count x record width bytes, sorted
+#	report: json {"duplicates": [...], "malformed": [[row, value], ...]}
+
+INDEX_MAGIC = b"TTWSIDX1"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<8sHHIQQq32sQ")
+INDEX_EXTENSION = ".idx"
+# the source mtime field of the header, rewritten in place by MappedSampleIndex.matchesSource
+INDEX_MTIME = struct.Struct("<q")
+INDEX_MTIME_OFFSET = struct.calcsize("<8sHHIQQ")
+
+
+def file_sha256(filename, chunk_size=1 << 20):
+	digest = hashlib.sha256()
+	with open(filename, "rb") as source:
+		for chunk in iter(lambda: source.read(chunk_size), b""):
+			digest.update(chunk)
+	return digest.digest()
+
+
+def index_path(filename, cache_dir):
+	"""Returns the index file used for a manifest csv, keyed by the csv's absolute path."""
+	key = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+	return os.path.join(cache_dir, key + INDEX_EXTENSION)
+
+
+class MappedSampleIndex:
+	"""
+	Read-only, memory-mapped manifest index with the same interface as SampleManifest.
+	Membership tests are a binary search over the mapped table, O(log n) rather than the constant
+	time of SampleManifest's frozenset.
+	"""
+
+	def __init__(self, path, filename=None):
+		self.path = path
+		self.filename = filename
+		with open(path, "rb") as index_file:
+			self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+		(
+			magic,
+			version,
+			self.width,
+			_,
+			self.count,
+			self.source_size,
+			self.source_mtime,
+			self.source_sha256,
+			report_length,
+		) = INDEX_HEADER.unpack_from(self._mmap, 0)
+		if magic != INDEX_MAGIC or version != INDEX_VERSION:
+			self.close()
+			raise ValueError("%s is not a sample index" % path)
+		report_start = INDEX_HEADER.size + self.count * self.width
+		report = json.loads(self._mmap[report_start : report_start + report_length].decode("utf-8"))
+		self.duplicates = report["duplicates"]
+		self.malformed = [tuple(entry) for entry in report["malformed"]]
+
+	def _record(self, i):
+		start = INDEX_HEADER.size + i * self.width
+		return self._mmap[start : start + self.width]
+
+	def __contains__(self, barcode):
+		key = str(barcode).encode("utf-8")
+		if len(key) > self.width:
+			return False
+		key = key.ljust(self.width, b"\0")
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._record(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo < self.count and self._record(lo) == key
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		for i in range(self.count):
+			yield self._record(i).rstrip(b"\0").decode("utf-8")
+
+	def matchesSource(self, filename):
+		"""
+		Checks the index against the manifest csv, only hashing the csv if its size or mtime changed. A csv
+		whose mtime changed but not its contents (e.g. copied or saved again) gives the index its new mtime,
+		so it isn't hashed again on every load.
+		"""
+		stat = os.stat(filename)
+		if stat.st_size != self.source_size:
+			return False
+		if stat.st_mtime_ns == self.source_mtime:
+			return True
+		if file_sha256(filename) != self.source_sha256:
+			return False
+		self.updateSourceMtime(stat.st_mtime_ns)
+		return True
+
+	def updateSourceMtime(self, mtime):
+		"""Writes a new source mtime into the index header. If that fails the csv is just hashed again next time."""
+		try:
+			with open(self.path, "r+b") as index_file:
+				index_file.seek(INDEX_MTIME_OFFSET)
+				index_file.write(INDEX_MTIME.pack(mtime))
+		except OSError as err:
+			logging.debug("Could not update sample index %s: %s" % (self.path, err))
+			return
+		self.source_mtime = mtime
+
+	def report(self):
+		return manifest_report(self)
+
+	def close(self):
+		self._mmap.close()
+
+
+def write_sample_index(manifest, path, source_filename):
+	"""Writes a SampleManifest to an index file (atomically, via a temporary file)."""
+	records = sorted(sample.encode("utf-8") for sample in manifest.samples)
+	width = max((len(record) for record in records), default=1)
+	report = json.dumps(
+		{"duplicates": manifest.duplicates, "malformed": manifest.malformed}
+	).encode("utf-8")
+	stat = os.stat(source_filename)
+	header = INDEX_HEADER.pack(
+		INDEX_MAGIC,
+		INDEX_VERSION,
+		width,
+		0,
+		len(records),
+		stat.st_size,
+		stat.st_mtime_ns,
+		file_sha256(source_filename),
+		len(report),
+	)
+	tmp_path = path + ".tmp"
+	with open(tmp_path, "wb") as index_file:
+		index_file.write(header)
+		for record in records:
+			index_file.write(record.ljust(width, b"\0"))
+		index_file.write(report)
+	os.replace(tmp_path, path)
+
+
+def load_sample_index(filename, cache_dir):
+	"""
+	Returns a MappedSampleIndex for a manifest csv, building (or rebuilding) the cached index if it is
+	missing or out of date. Falls back to an in-memory SampleManifest if the cache can't be written.
+	"""
+	path = index_path(filename, cache_dir)
+	if os.path.isfile(path):
+		try:
+			index = MappedSampleIndex(path, filename=filename)
+			if index.matchesSource(filename):
+				return index
+			index.close()
+		except (OSError, ValueError, struct.error):
+			pass
+
+	manifest = load_sample_manifest(filename)
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		write_sample_index(manifest, path, filename)
+		return MappedSampleIndex(path, filename=filename)
+	except (OSError, ValueError, struct.error):
+		logging.warning("Could not write sample index %s, using the manifest in memory" % path)
+		return manifest
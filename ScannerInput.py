@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Barcode scanner input that doesn't go through the Kivy textbox.
+
+A keyboard-wedge scanner types each barcode into TubeToWellWidget's textbox, and a scan typed while
+the window is busy redrawing can be merged with the next one or lose characters. ScannerInput reads the
+scans itself instead, from any of these sources (the "scanner_input" configuration entry, or --scanner
+for TubeToWellCLI.py):
+
+	"tcp:5555" or "tcp:HOST:PORT"   a local TCP port; every connection sends scans, e.g. a scanner bridge
+	"unix:PATH"                     a Unix socket (not on Windows)
+	"device:PATH"                   a device file or named pipe, e.g. /dev/ttyACM0 for a scanner switched to
+	                                USB serial (CDC) mode
+	"device:PATH@BAUD"              a serial port, e.g. "device:COM3@9600" (needs the optional pyserial package)
+	"stdin"                         the standard input
+
+Scans end with CR, LF or CRLF, like the Enter a wedge scanner types; empty lines are ignored. Each scan
+is numbered and timestamped as soon as its line is complete and put on one bounded queue, and a single
+delivery thread hands the queued scans to the handler (e.g. TubeToWell.next) one at a time, in the order
+they arrived. While the queue is full the sources stop reading, so a burst of scans waits in the device
+or socket buffers (which makes a TCP sender block) instead of being dropped.
+
+The sources are read by an asyncio event loop on a background thread (start/stop), or inside an
+existing loop with run(). Device files and stdin are read by blocking reads on their own daemon
+threads, because asyncio can't wait on them on Windows.
+
+Scanners that can only act as a keyboard have to be switched to a serial mode (or bridged to a socket)
+to use this; raw keyboard HID reports are not decoded.
+"""
+
+import asyncio, itertools, logging, os, queue, socket, sys, threading, time
+
+from Metrics import METRICS
+
+# scans waiting for the handler before the sources stop reading
+QUEUE_SIZE = 64
+READ_SIZE = 4096
+# how long a serial port read waits, so the reading thread notices close()
+SERIAL_TIMEOUT = 0.5
+
+
+class Scan:
+	"""One scanned barcode: its number in arrival order, where it came from and when it arrived (time.time())."""
+
+	__slots__ = ("sequence", "barcode", "source", "received", "queued")
+
+	def __init__(self, sequence, barcode, source):
+		self.sequence = sequence
+		self.barcode = barcode
+		self.source = source
+		self.received = time.time()
+		self.queued = time.perf_counter()
+
+	def __repr__(self):
+		return "Scan(%s, %r, %s)" % (self.sequence, self.barcode, self.source)
+
+
+class LineSplitter:
+	"""Cuts a byte stream into barcodes at CR, LF or CRLF, keeping a partial line until the rest arrives."""
+
+	def __init__(self):
+		self.partial = b""
+
+	def feed(self, data):
+		lines = (self.partial + data).splitlines(True)
+		self.partial = b""
+		if lines and not lines[-1].endswith((b"\r", b"\n")):
+			self.partial = lines.pop()
+		return self.decode(lines)
+
+	def flush(self):
+		"""Returns the last line of a stream that ended without a line end."""
+		lines, self.partial = [self.partial], b""
+		return self.decode(lines)
+
+	@staticmethod
+	def decode(lines):
+		barcodes = (line.decode("utf-8", "replace").strip() for line in lines)
+		return [barcode for barcode in barcodes if barcode]
+
+
+class SocketSource:
+	"""Scans sent over a local TCP or Unix socket, one connection per scanner (or bridge)."""
+
+	def __init__(self, spec, host=None, port=None, path=None):
+		self.spec = spec
+		self.host = host
+		self.port = port
+		self.path = path
+		self.server = None
+		self.service = None
+
+	async def open(self, service):
+		self.service = service
+		if self.path is not None:
+			if os.path.exists(self.path):
+				# left behind by a run that didn't close it
+				os.unlink(self.path)
+			self.server = await asyncio.start_unix_server(self.client, self.path)
+		else:
+			self.server = await asyncio.start_server(self.client, self.host, self.port)
+			# the port actually bound, for port 0
+			self.port = self.server.sockets[0].getsockname()[1]
+
+	async def read(self):
+		await self.server.serve_forever()
+
+	async def client(self, reader, writer):
+		peer = writer.get_extra_info("peername") or self.path
+		name = "%s %s" % (self.spec, peer) if self.path is None else self.spec
+		try:
+			await self.service.readStream(reader, name)
+		except (ConnectionError, OSError) as err:
+			logging.warning("Scanner connection %s lost: %s", name, err)
+		finally:
+			writer.close()
+
+	def close(self):
+		if self.server is not None:
+			self.server.close()
+		if self.path is not None and os.path.exists(self.path):
+			os.unlink(self.path)
+
+
+class ThreadedSource:
+	"""Scans read by blocking reads on a daemon thread: device files, named pipes, serial ports and stdin."""
+
+	def __init__(self, spec, path=None, baudrate=None):
+		self.spec = spec
+		self.path = path
+		self.baudrate = baudrate
+		self.closed = False
+		self.service = None
+		self.loop = None
+		self.finished = None
+		self.thread = None
+
+	async def open(self, service):
+		self.service = service
+		self.loop = asyncio.get_running_loop()
+		self.finished = self.loop.create_future()
+		if self.baudrate is not None:
+			# fail now, not on the reading thread, when pyserial is missing
+			import serial  # noqa: F401
+		# opening a named pipe waits for its writer, so the thread opens the file as well
+		self.thread = threading.Thread(target=self._run, name="ScannerInput %s" % self.spec, daemon=True)
+		self.thread.start()
+
+	async def read(self):
+		await self.finished
+
+	def openStream(self):
+		if self.baudrate is not None:
+			import serial
+
+			return serial.Serial(self.path, self.baudrate, timeout=SERIAL_TIMEOUT)
+		if self.path is None:
+			return sys.stdin.fileno()
+		return os.open(self.path, os.O_RDONLY)
+
+	def readChunk(self, stream):
+		"""Returns the next bytes read, or b"" at the end of the stream or once the source is closed."""
+		if self.baudrate is None:
+			return os.read(stream, READ_SIZE)
+		while not self.closed:
+			data = stream.read(stream.in_waiting or 1)
+			if data:
+				return data
+		return b""
+
+	def closeStream(self, stream):
+		if self.baudrate is not None:
+			stream.close()
+		elif self.path is not None:
+			os.close(stream)
+
+	def submit(self, barcode):
+		# blocks this thread while the queue is full
+		asyncio.run_coroutine_threadsafe(self.service.put(barcode, self.spec), self.loop).result()
+
+	def _run(self):
+		error = None
+		splitter = LineSplitter()
+		try:
+			stream = self.openStream()
+			try:
+				while not self.closed:
+					data = self.readChunk(stream)
+					if not data:
+						break
+					for barcode in splitter.feed(data):
+						self.submit(barcode)
+				for barcode in splitter.flush():
+					self.submit(barcode)
+			finally:
+				self.closeStream(stream)
+		except RuntimeError:
+			# the service's event loop has stopped
+			return
+		except Exception as err:
+			error = err
+		try:
+			self.loop.call_soon_threadsafe(settle, self.finished, None, error)
+		except RuntimeError:
+			pass
+
+	def close(self):
+		self.closed = True
+
+
+def settle(future, result, error):
+	if future.done():
+		return
+	if error is not None:
+		future.set_exception(error)
+	else:
+		future.set_result(result)
+
+
+def parse_source(spec):
+	"""Returns the (not yet opened) source described by spec, e.g. "tcp:5555". Raises ValueError if spec isn't one."""
+	if not isinstance(spec, str):
+		raise ValueError("scanner source %r must be text, e.g. \"tcp:5555\"" % (spec,))
+	if spec in ("stdin", "-"):
+		return ThreadedSource("stdin")
+	kind, _, target = spec.partition(":")
+	if kind == "tcp":
+		host, _, port = target.rpartition(":")
+		if not port.isdigit() or not 0 <= int(port) < 65536:
+			raise ValueError("scanner source %s: expected tcp:PORT or tcp:HOST:PORT" % spec)
+		return SocketSource(spec, host=host or "127.0.0.1", port=int(port))
+	if kind == "unix":
+		if not target:
+			raise ValueError("scanner source %s: expected unix:PATH" % spec)
+		if not hasattr(socket, "AF_UNIX"):
+			raise ValueError("scanner source %s: Unix sockets are not available on this system" % spec)
+		return SocketSource(spec, path=target)
+	if kind == "device":
+		path, _, baudrate = target.rpartition("@") if "@" in target else (target, "", "")
+		if not path or (baudrate and not baudrate.isdigit()):
+			raise ValueError("scanner source %s: expected device:PATH or device:PATH@BAUD" % spec)
+		return ThreadedSource(spec, path=path, baudrate=int(baudrate) if baudrate else None)
+	raise ValueError("unknown scanner source %s (expected tcp:, unix:, device: or stdin)" % spec)
+
+
+class ScannerInput:
+	"""
+	Reads scans from sources and calls handler(scan) with each Scan, one at a time and in arrival order,
+	on a delivery thread. A handler that raises is logged and the next scan is delivered.
+	"""
+
+	def __init__(self, handler, sources, maxsize=QUEUE_SIZE):
+		self.handler = handler
+		self.sources = [parse_source(source) if isinstance(source, str) else source for source in sources]
+		self.maxsize = maxsize
+		self.received = 0
+		self.delivered = 0
+		self.failed = 0
+		# scans read after stop() was called
+		self.dropped = 0
+		self.max_depth = 0
+		self.sequence = itertools.count(1)
+		self.loop = None
+		self.queue = None
+		self.stopping = None
+		self.closing = False
+		self.deliveries = queue.SimpleQueue()
+		self.ready = threading.Event()
+		self.error = None
+		self.thread = None
+
+	async def put(self, barcode, source):
+		"""Queues a scan, waiting while the queue is full."""
+		if self.closing:
+			self.dropped += 1
+			logging.warning("Scanner input stopped, ignoring scan %s from %s", barcode, source)
+			return
+		scan = Scan(next(self.sequence), barcode, source)
+		self.received += 1
+		await self.queue.put(scan)
+		self.max_depth = max(self.max_depth, self.queue.qsize())
+
+	async def readStream(self, reader, source):
+		splitter = LineSplitter()
+		while True:
+			data = await reader.read(READ_SIZE)
+			if not data:
+				break
+			for barcode in splitter.feed(data):
+				await self.put(barcode, source)
+		for barcode in splitter.flush():
+			await self.put(barcode, source)
+
+	async def deliverScans(self):
+		while True:
+			scan = await self.queue.get()
+			try:
+				if METRICS.enabled:
+					METRICS.observe("scannerQueueWait", time.perf_counter() - scan.queued)
+				delivered = self.loop.create_future()
+				self.deliveries.put((scan, delivered))
+				await delivered
+				self.delivered += 1
+			except Exception as err:
+				self.failed += 1
+				logging.error("Scan %s from %s failed: %s", scan.barcode, scan.source, err)
+			finally:
+				self.queue.task_done()
+
+	def _deliver(self):
+		while True:
+			item = self.deliveries.get()
+			if item is None:
+				return
+			scan, delivered = item
+			result = error = None
+			try:
+				result = self.handler(scan)
+			except Exception as err:
+				error = err
+			try:
+				self.loop.call_soon_threadsafe(settle, delivered, result, error)
+			except RuntimeError:
+				return
+
+	async def run(self):
+		"""
+		Reads every source and delivers their scans until the sources end (e.g. stdin at end of file) or
+		stop() is called, then delivers the scans still queued.
+		"""
+		self.loop = asyncio.get_running_loop()
+		self.queue = asyncio.Queue(self.maxsize)
+		self.stopping = asyncio.Event()
+		deliverer = threading.Thread(target=self._deliver, name="ScannerInput delivery", daemon=True)
+		deliverer.start()
+		consumer = asyncio.ensure_future(self.deliverScans())
+		readers = []
+		try:
+			for source in self.sources:
+				await source.open(self)
+			self.ready.set()
+			readers = [asyncio.ensure_future(source.read()) for source in self.sources]
+			ended = asyncio.ensure_future(asyncio.gather(*readers, return_exceptions=True))
+			stopped = asyncio.ensure_future(self.stopping.wait())
+			await asyncio.wait([ended, stopped], return_when=asyncio.FIRST_COMPLETED)
+			stopped.cancel()
+			if ended.done():
+				for source, error in zip(self.sources, ended.result()):
+					if isinstance(error, Exception):
+						logging.error("Scanner source %s failed: %s", source.spec, error)
+			self.closing = True
+			for source in self.sources:
+				source.close()
+			await self.queue.join()
+		finally:
+			self.closing = True
+			for source in self.sources:
+				source.close()
+			for reader in readers:
+				reader.cancel()
+			consumer.cancel()
+			self.deliveries.put(None)
+
+	def start(self):
+		"""Runs the service on a background thread. Raises whatever stopped a source from opening."""
+		self.thread = threading.Thread(target=self._serve, name="ScannerInput", daemon=True)
+		self.thread.start()
+		self.ready.wait()
+		if self.error is not None:
+			raise self.error
+		return self
+
+	def _serve(self):
+		try:
+			asyncio.run(self.run())
+		except Exception as err:
+			if not self.ready.is_set():
+				self.error = err
+			else:
+				logging.error("Scanner input stopped: %s", err)
+		finally:
+			self.ready.set()
+
+	def stop(self, wait=True, timeout=10.0):
+		"""
+		Stops reading and delivers the scans already queued. With wait, returns once they are delivered
+		(don't wait from a thread the handler itself waits for).
+		"""
+		loop, stopping = self.loop, self.stopping
+		if loop is not None and stopping is not None:
+			try:
+				loop.call_soon_threadsafe(stopping.set)
+			except RuntimeError:
+				pass
+		if wait and self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join(timeout)
+
+	def stats(self):
+		return {
+			"received": self.received,
+			"delivered": self.delivered,
+			"failed": self.failed,
+			"dropped": self.dropped,
+			"max_depth": self.max_depth,
+		}
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Write-ahead journal of the operator actions on a plate, used to resume a plate after a crash.
+
+When a plate is started its set-up (configuration, template, sample list, metadata) is written to
+<records dir>/<record name>.session as a json header line. Every next, undo, undoCurrentScan,
+skipNextWell, discardSpecificWell, preassignBatch, undoSteps and redoSteps (and any sample list or template loaded mid-plate) is then
+appended as one json line and fsynced *before* it is applied. Replaying the actions on a fresh TubeToWell rebuilds the exact protocol state, including
+the transfer sequence, _current_idx, scanned_out, canUndo and lightup_well. The journal is removed
+when the plate is finished.
+
+	{"version": 1, "plate_barcode": ..., "num_wells": ..., "barcode_to_well": {...}, ...}
+	{"op": "next", "args": ["TUBE0001"], "time": 1700000000.0}
+	{"op": "undo", "args": [], "time": 1700000005.2}
+	...
+"""
+
+import glob, json, os, time
+
+SESSION_EXTENSION = ".session"
+SESSION_VERSION = 1
+SESSION_OPS = (
+	"next",
+	"undo",
+	"undoCurrentScan",
+	"skipNextWell",
+	"discardSpecificWell",
+	"preassignBatch",
+	"undoSteps",
+	"redoSteps",
+	"loadCSV",
+	"loadWellConfigurationCSV",
+)
+
+
+def session_path(records_dir, record_name):
+	"""Returns the session journal path for a plate's record name (TubeToWell.csv)."""
+	return os.path.join(records_dir, record_name + SESSION_EXTENSION)
+
+
+class SessionJournal:
+	"""Append-only, fsynced json lines file of a plate's set-up and actions."""
+
+	def __init__(self, path):
+		self.path = path
+		self._file = None
+
+	def start(self, header):
+		"""Creates the journal with its header, replacing any previous journal at the same path."""
+		self.close()
+		header = dict(header, version=SESSION_VERSION)
+		self._file = open(self.path, "w", encoding="utf-8")
+		self._write(header)
+
+	def reopen(self):
+		"""Opens an existing journal to append further actions (after a resume)."""
+		self.close()
+		self._file = open(self.path, "a", encoding="utf-8")
+
+	def append(self, op, *args):
+		self._write({"op": op, "args": list(args), "time": time.time()})
+
+	def _write(self, entry):
+		self._file.write(json.dumps(entry) + "\n")
+		self._file.flush()
+		os.fsync(self._file.fileno())
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def remove(self):
+		self.close()
+		if os.path.isfile(self.path):
+			os.remove(self.path)
+
+
+def read_session(path):
+	"""
+	Returns (header, [(op, args), ...]) from a session journal. A torn final line (a crash while it was
+	being written) is ignored; that action was never applied.
+	"""
+	with open(path, encoding="utf-8") as session_file:
+		lines = session_file.read().split("\n")
+	header = json.loads(lines[0])
+	if header.get("version") != SESSION_VERSION:
+		raise ValueError("%s is not a version %s session journal" % (path, SESSION_VERSION))
+	events = []
+	for line in lines[1:]:
+		if not line:
+			continue
+		try:
+			entry = json.loads(line)
+		except ValueError:
+			break
+		if entry.get("op") in SESSION_OPS:
+			events.append((entry["op"], entry.get("args", [])))
+	return header, events
+
+
+def read_session_header(path):
+	"""Returns just the header of a session journal, e.g. to describe it before resuming."""
+	with open(path, encoding="utf-8") as session_file:
+		return json.loads(session_file.readline())
+
+
+def find_sessions(records_dir):
+	"""Returns the session journals left in a records directory, most recently modified first."""
+	paths = glob.glob(os.path.join(glob.escape(records_dir), "*" + SESSION_EXTENSION))
+	return sorted(paths, key=os.path.getmtime, reverse=True)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Caches of parsed plate templates and of the transfer protocols built from them.
+
+Operators load the same few template csvs over and over. Loading one used to mean reading it with
+pandas, validating every row and building a TTWTransferProtocol from scratch, and starting each new
+plate built the protocol again. Two small LRU caches, shared by every TubeToWell in the process, skip
+that work when nothing changed:
+
+- templates: (sha256 of the file's bytes, plate geometry) -> the validated template, i.e. its control
+  wells and barcode -> well reservations. The geometry is part of the key because the same sheet can be
+  valid for a 384-well plate and invalid for a 96-well one. Templates with errors are never cached.
+- protocols: (plate geometry, controls, reservations) -> an unused protocol, kept as a skeleton that is
+  cloned (TTWTransferProtocol.clone) for every new plate instead of being rebuilt.
+
+cache_stats() returns the hit/miss/eviction counts of both caches, and metric_samples() the same counts
+for the Prometheus endpoint of Metrics.py.
+"""
+
+import hashlib, json
+from collections import OrderedDict
+
+# a handful of templates and plate types are in use at any one time
+TEMPLATE_CACHE_SIZE = 32
+PROTOCOL_CACHE_SIZE = 8
+
+
+class LRUCache:
+	"""A dict with a maximum size that evicts its least recently used entries, counting hits and misses."""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		"""Returns the entry for key (making it the most recently used), or None."""
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return entry
+
+	def put(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self):
+		return {
+			"size": len(self.entries),
+			"maxsize": self.maxsize,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+		}
+
+	def __len__(self):
+		return len(self.entries)
+
+
+templates = LRUCache(TEMPLATE_CACHE_SIZE)
+protocols = LRUCache(PROTOCOL_CACHE_SIZE)
+
+
+def geometry_key(num_wells, fill_order, custom_layout):
+	return (str(num_wells), fill_order, json.dumps(custom_layout, sort_keys=True))
+
+
+def template_key(data, num_wells, fill_order, custom_layout):
+	"""Cache key of a template file's contents (bytes) read for a plate geometry."""
+	return (hashlib.sha256(data).hexdigest(),) + geometry_key(num_wells, fill_order, custom_layout)
+
+
+def protocol_key(num_wells, fill_order, custom_layout, controls, barcode_to_well):
+	"""Cache key of the protocol for a plate geometry, control wells and barcode -> well reservations."""
+	return geometry_key(num_wells, fill_order, custom_layout) + (
+		tuple(controls or ()),
+		tuple(barcode_to_well.items()),
+	)
+
+
+def cache_stats():
+	"""Returns {"templates": stats, "protocols": stats} with the size and hit/miss/eviction counts of each cache."""
+	return {"templates": templates.stats(), "protocols": protocols.stats()}
+
+
+def metric_samples():
+	"""Returns the cache counts as Metrics collector samples: [(name, type, description, value)]."""
+	samples = []
+	for cache, stats in sorted(cache_stats().items()):
+		for field in ("hits", "misses", "evictions"):
+			samples.append(
+				("%s_cache_%s_total" % (cache[:-1], field), "counter", "%s of the %s cache." % (field.capitalize(), cache), stats[field])
+			)
+		samples.append(("%s_cache_entries" % cache[:-1], "gauge", "Entries in the %s cache." % cache, stats["size"]))
+	return samples
+
+
+def clear_caches():
+	templates.clear()
+	protocols.clear()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Append-only journal for tube to plate transfer records.
+
+Every state change of a transfer is appended to a journal file next to the record csv as a single
+row and fsynced, instead of rewriting the whole record after every scan. When a plate is finished the
+journal is compacted into the usual record csv layout:
+
+	%Plate Timestamp: ,<timestamp>
+	%Username: ,<user>
+	%Plate Barcode: ,<plate barcode>
+	%Timestamp,Tube Barcode,Location
+	<timestamp>,<tube barcode>[-discarded],<well>
+	...
+
+The journal uses the same four metadata rows followed by one event row per change:
+
+	<timestamp>,<tube barcode>,<well>,<status>
+"""
+
+import csv, os, queue, threading, logging
+from WellLit.Transfer import TError
+
+RECORD_KEYS = ["timestamp", "source_tube", "dest_well"]
+JOURNAL_KEYS = RECORD_KEYS + ["status"]
+JOURNAL_EXTENSION = ".journal"
+DISCARDED_SUFFIX = "-discarded"
+METADATA_ROWS = 4
+
+
+def record_metadata(timestamp, user, plate_barcode):
+	"""Returns the metadata rows written at the top of every record and journal file."""
+	return [
+		["%Plate Timestamp: ", timestamp],
+		["%Username: ", user],
+		["%Plate Barcode: ", plate_barcode],
+		["%Timestamp", "Tube Barcode", "Location"],
+	]
+
+
+def record_row(transfer):
+	"""
+	Returns the record csv row for a transfer, or None if the transfer does not belong in the record
+	(i.e it is still uncompleted)
+	"""
+	status = transfer["status"]
+	if status == "discarded":
+		row = [transfer[key] for key in RECORD_KEYS]
+		row[1] = (row[1] or "") + DISCARDED_SUFFIX
+		return row
+	elif status != "uncompleted":
+		return [transfer[key] for key in RECORD_KEYS]
+	return None
+
+
+def journal_path(record_path):
+	"""Returns the journal file path that belongs to a record csv path."""
+	return str(record_path) + JOURNAL_EXTENSION
+
+
+class TransferJournal:
+	"""
+	Append-only event log for a single record csv. Rows are flushed and fsynced on every append
+	so a crash never loses an acknowledged scan.
+	"""
+
+	def __init__(self, record_path, metadata):
+		self.record_path = str(record_path)
+		self.path = journal_path(record_path)
+		self.metadata = metadata
+		self.tail_checked = False
+
+	def exists(self):
+		return os.path.isfile(self.path)
+
+	def endsTorn(self):
+		"""True if the journal's last row was cut off mid-write (e.g. by a crash), leaving no line end."""
+		with open(self.path, "rb") as journal_file:
+			journal_file.seek(0, os.SEEK_END)
+			if journal_file.tell() == 0:
+				return False
+			journal_file.seek(-1, os.SEEK_END)
+			return journal_file.read(1) != b"\n"
+
+	def append(self, rows):
+		"""Appends event rows, writing the metadata header first if the journal is new."""
+		new_file = not self.exists()
+		# a journal left behind by a crash may end in a torn row; end it so it is not merged with the next one
+		torn = not new_file and not self.tail_checked and self.endsTorn()
+		self.tail_checked = True
+		with open(self.path, "a", newline="") as journal_file:
+			writer = csv.writer(journal_file)
+			if torn:
+				journal_file.write("\r\n")
+			if new_file:
+				writer.writerows(self.metadata)
+			writer.writerows(rows)
+			journal_file.flush()
+			os.fsync(journal_file.fileno())
+
+	def compact(self, rows):
+		"""
+		Writes the final record csv (metadata plus the given record rows) atomically and removes the journal.
+		"""
+		tmp_path = self.record_path + ".tmp"
+		with open(tmp_path, "w", newline="") as logfile:
+			log_writer = csv.writer(logfile)
+			log_writer.writerows(self.metadata)
+			log_writer.writerows(rows)
+			logfile.flush()
+			os.fsync(logfile.fileno())
+		os.replace(tmp_path, self.record_path)
+		if self.exists():
+			os.remove(self.path)
+
+
+class RecordWriter:
+	"""
+	Write-behind worker that performs journal appends and compactions on a background thread so the
+	scan loop never waits on the disk.
+
+	Bursts of queued appends for the same journal are coalesced into a single write, and a queued
+	compaction supersedes any appends queued before it. The queue is bounded, so a stalled disk
+	eventually applies backpressure instead of growing memory without limit. The first failure is kept
+	and re-raised as a TError by raiseError() on the caller's thread.
+	"""
+
+	def __init__(self, maxsize=256):
+		self._queue = queue.Queue(maxsize)
+		self._error = None
+		self._error_lock = threading.Lock()
+		self._thread = threading.Thread(target=self._run, name="RecordWriter", daemon=True)
+		self._thread.start()
+
+	def append(self, journal, rows):
+		self._queue.put(("append", journal, rows))
+
+	def compact(self, journal, rows):
+		self._queue.put(("compact", journal, rows))
+
+	def flush(self):
+		"""Blocks until every queued write is on disk, then raises any pending write failure."""
+		self._queue.join()
+		self.raiseError()
+
+	def raiseError(self):
+		"""Re-raises (and clears) the first write failure since the last call."""
+		with self._error_lock:
+			error, self._error = self._error, None
+		if error is not None:
+			raise error
+
+	def _run(self):
+		while True:
+			tasks = [self._queue.get()]
+			while True:
+				try:
+					tasks.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				self._write(tasks)
+			finally:
+				for _ in tasks:
+					self._queue.task_done()
+
+	def _write(self, tasks):
+		# coalesce into one pending operation per journal, preserving first-seen order
+		pending = {}
+		for kind, journal, rows in tasks:
+			current = pending.get(journal.path)
+			if kind == "compact" or current is None:
+				pending[journal.path] = [kind, journal, list(rows)]
+			elif current[0] == "append":
+				current[2].extend(rows)
+			else:
+				# appends queued after a compaction go to a fresh journal once the compaction is written
+				self._run_task(*current)
+				pending[journal.path] = [kind, journal, list(rows)]
+
+		for kind, journal, rows in pending.values():
+			self._run_task(kind, journal, rows)
+
+	def _run_task(self, kind, journal, rows):
+		try:
+			if kind == "compact":
+				journal.compact(rows)
+			else:
+				journal.append(rows)
+			logging.info("Wrote transfer record to " + journal.record_path)
+		except Exception as err:
+			logging.error("Cannot write record file to %s: %s" % (journal.record_path, err))
+			with self._error_lock:
+				if self._error is None:
+					self._error = TError("Cannot write record file to " + journal.record_path)
+
+
+def read_record_file(record_path):
+	"""
+	Reads a record csv, returning (metadata rows, {well: [timestamp, tube barcode, well, status]})
+	with wells in file order. The status of non-discarded rows is reported as completed.
+	"""
+	metadata, view = [], {}
+	with open(record_path, newline="") as logfile:
+		reader = csv.reader(logfile)
+		for i, row in enumerate(reader):
+			if i < METADATA_ROWS:
+				metadata.append(row)
+				continue
+			if len(row) < 3:
+				continue
+			timestamp, barcode, well = row[:3]
+			status = "completed"
+			if barcode.endswith(DISCARDED_SUFFIX):
+				barcode = barcode[: -len(DISCARDED_SUFFIX)]
+				status = "discarded"
+			view[well] = [timestamp, barcode, well, status]
+	return metadata, view
+
+
+def read_transfer_journal(record_path):
+	"""
+	Rebuilds the current record view from the last compacted record csv (if any) and its journal.
+
+	Returns (metadata rows, list of [timestamp, tube barcode, well, status]) for every well that is
+	not uncompleted, ordered by when the well was (most recently) first used.
+	"""
+	metadata, view = [], {}
+	if os.path.isfile(str(record_path)):
+		metadata, view = read_record_file(record_path)
+
+	path = journal_path(record_path)
+	if os.path.isfile(path):
+		with open(path, newline="") as journal_file:
+			reader = csv.reader(journal_file)
+			for i, row in enumerate(reader):
+				if i < METADATA_ROWS:
+					if len(metadata) < METADATA_ROWS:
+						metadata.append(row)
+					continue
+				if len(row) < len(JOURNAL_KEYS):
+					# a torn final row from a crash mid-write
+					continue
+				timestamp, barcode, well, status = row[: len(JOURNAL_KEYS)]
+				if status == "uncompleted":
+					view.pop(well, None)
+				else:
+					view[well] = [timestamp, barcode, well, status]
+	return metadata, list(view.values())
+
+
+def compact_transfer_journal(record_path):
+	"""
+	Compacts a journal left behind (e.g by a crash) into its record csv using only the files on disk. The
+	journal doesn't keep the transfer sequence, so the rows are in the order their wells were (most recently)
+	first used: the live record's order, unless a well was reset and used again after later wells. A plate
+	that still has its session journal is finished exactly with TubeToWell.abandonSession instead.
+	"""
+	metadata, rows = read_transfer_journal(record_path)
+	record_rows = []
+	for timestamp, barcode, well, status in rows:
+		if status == "discarded":
+			barcode += DISCARDED_SUFFIX
+		record_rows.append([timestamp, barcode, well])
+	TransferJournal(record_path, metadata).compact(record_rows)
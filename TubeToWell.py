@@ -5,48 +5,116 @@
 
 # updated 8/24/2020 Andrew Cote
 
-import csv, time, os, json, uuid, logging
-from WellLit.Transfer import TStatus, TError, TConfirm, TransferProtocol, Transfer
+import copy, csv, functools, glob, hashlib, io, time, os, logging, atexit, sqlite3
+
+_import_start = time.perf_counter()
+
+from WellLit.Transfer import TStatus, TError, TConfirm, TransferProtocol
+from PlateModel import PlateModel, StatusLists
+from PlateGeometry import plate_geometry
+from WellAllocator import FreeWellAllocator
+from SampleManifest import is_malformed, load_sample_index, read_sample_ids
+from TransferRecords import (
+	JOURNAL_EXTENSION,
+	TransferJournal,
+	RecordWriter,
+	compact_transfer_journal,
+	record_metadata,
+	record_row,
+	read_transfer_journal,
+)
+from SessionJournal import SessionJournal, find_sessions, read_session, read_session_header, session_path
+from BarcodeIndex import IndexFeed, open_index
+from ProtocolHistory import ProtocolHistory
+from Configuration import ConfigWatcher, POLL_INTERVAL, load_config
+import BarcodeRules, TemplateCache
+from Metrics import METRICS, instrument
 from pathlib import Path
-import pandas as pd
+
+# pandas is only needed to read template files and is imported there, keeping it out of startup
 
 EMPTY_FLAG = "EMPTY"
 
+# Startup profiling: run with the environment variable TTW_PROFILE_STARTUP=1 to print how long
+# imports, configuration loading and transfer protocol builds take.
+PROFILE_STARTUP = os.environ.get("TTW_PROFILE_STARTUP", "0") not in ("", "0")
+startup_timings = []
+
+
+def recordStartupTime(label, start):
+	"""Records the time elapsed since start (a time.perf_counter() value) when startup profiling is enabled."""
+	if PROFILE_STARTUP:
+		startup_timings.append((label, time.perf_counter() - start))
+
+
+def printStartupProfile():
+	"""Prints and clears the startup timings recorded so far."""
+	if startup_timings:
+		print("Startup profile (TTW_PROFILE_STARTUP):")
+		for label, seconds in startup_timings:
+			print("  {:<45}{:>10.1f} ms".format(label, seconds * 1000))
+		del startup_timings[:]
+
+
+def recorded(action):
+	"""
+	Decorator for the TubeToWell actions that change the plate: everything the action changes is
+	recorded as one undo step in the protocol's history (see ProtocolHistory.py), even if it fails
+	part way. An action called by another recorded action is part of the caller's step.
+	"""
+
+	@functools.wraps(action)
+	def recordedAction(self, *args, **kwargs):
+		tp = self.tp
+		if tp is None or tp.undo_history.recording:
+			return action(self, *args, **kwargs)
+		tp.undo_history.begin(self)
+		try:
+			return action(self, *args, **kwargs)
+		finally:
+			tp.undo_history.commit(self)
+
+	return recordedAction
+
+
+recordStartupTime("import TubeToWell dependencies", _import_start)
+METRICS.addCollector(TemplateCache.metric_samples)
+METRICS.addCollector(BarcodeRules.metric_samples)
+if PROFILE_STARTUP:
+	atexit.register(printStartupProfile)
+
+
 class TubeToWell:
 	"""A class for mapping scanned tubes to a well location.
 
 	functions at this level throw exceptions caught by TubeToWellWidget
 	"""
 	def __init__(self):
+		init_start = time.perf_counter()
 
 		# load in configuration settings
 		self.cwd = os.getcwd()
 		self.config_dir = os.path.join(self.cwd, "configs/")
+		self.cache_dir = os.path.join(self.cwd, "cache/")
+
+		start = time.perf_counter()
+		config = load_config(os.path.join(self.config_dir, "DEFAULT_CONFIG.json"))
+		recordStartupTime("TubeToWell.__init__: load configuration", start)
 
-		config_path = os.path.join(self.config_dir, "DEFAULT_CONFIG.json")
-		with open(config_path) as json_file:
-			configs = json.load(json_file)
-
-		self.num_wells = configs["num_wells"]
-		self.records_dir = configs["records_dir"]
-		self.custom_records_dir = None
-		self.samples_dir = configs["samples_dir"]
-		self.templates_dir = configs["templates_dir"]
-		self.controls = configs["controls"]
-		self.enable_scan_out = configs["enable_scan_out"]
-		self.barcode_to_well = {}
+		# the Configuration in use (see Configuration.py), and an edited one waiting for the next plate
+		self.config = None
+		self.pending_config = None
+		self.config_watcher = None
+		self.tp = None
+		self.applyConfig(config)
 		self.csv = ""
 		self.warning_file_path = ""
 		self.scanned_out = True
-
-		if not os.path.isdir(self.records_dir):
-			self.records_dir = self.cwd + "/records/"
-
-		if not os.path.isdir(self.samples_dir):
-			self.samples_dir = self.cwd + "/samples/"
-
-		if not os.path.isdir(self.templates_dir):
-			self.templates_dir = self.cwd + "/templates/"
+		self.template_errors = []
+		# tubes of the last rack placed with preassignBatch, [(barcode, well)], and how many stepBatch has shown
+		self.batch = None
+		self.batch_position = 0
+		self.batch_errors = []
 
 		self.warningsMade = False
 		self.timestamp = ""
@@ -56,19 +124,38 @@ class TubeToWell:
 		self.user = ""
 		self.tp = None
 		self.sample_list = None
-		self.tp = TTWTransferProtocol(self, controls=self.controls, num_wells=self.num_wells)
+		self.record_journals = {}
+		self.record_writer = RecordWriter()
+		# write-ahead journal of the current plate's actions, see SessionJournal.py
+		self.session = None
+		self.replaying = False
+		# tubes placed in every plate in progress, set by a PlateSessionManager (see PlateSessions.py)
+		self.tube_index = None
+		# persistent index of the tubes in every recorded plate, see BarcodeIndex.py
+		self.history = None
+		self.history_dir = None
+		start = time.perf_counter()
+		self.tp = self.buildProtocol()
+		recordStartupTime("TubeToWell.__init__: build transfer protocol", start)
+		recordStartupTime("TubeToWell.__init__ (total)", init_start)
 
 	def reset(self):
+		self.endSession()
+		# no plate is in progress any more, so an edited configuration file can be applied
+		self.applyPendingConfig()
 		self.timestamp = ""
 		self.plate_barcode = ""
 		self.metadata = ""
 		self.msg = ""
 		self.user = ""
 		self.csv = ""
-		self.tp = TTWTransferProtocol(self, controls=self.controls, num_wells=self.num_wells)
+		self.tp = self.buildProtocol()
+		self.batch = None
+		self.batch_position = 0
 		self.warningsMade = False
 		self.warning_file_path = ""
-		self.sample_list = None
+		self.closeSampleList()
+		self.record_journals = {}
 
 	def tp_present(self):
 		if self.tp is not None:
@@ -79,6 +166,8 @@ class TubeToWell:
 			)
 			raise TError(self.msg)
 
+	@instrument("next")
+	@recorded
 	def next(self, barcode):
 		"""
 		Checks to see if a transfer protocol is present, and if a sample list has been loaded
@@ -89,18 +178,22 @@ class TubeToWell:
 			# First check to see if this is a specifically assigned barcode
 			# (i.e a tube that should go to a specific well)
 			barcode = str(barcode)
+			if not self.replaying:
+				if self.tube_index is not None:
+					self.checkOtherPlates(barcode)
+				self.checkPreviousPlates(barcode)
+			self.logSessionEvent("next", barcode)
 
 			if self.enable_scan_out:
 				# Get the current transfer
 				if not self.scanned_out:
-					for i, tf_id in enumerate(self.tp.tf_seq):
+					for tf_id in self.tp.lists["started"]:
 						tf = self.tp.transfers[tf_id]
 						if tf['status'] == "started":
 							prev_barcode = tf['source_tube']
 							if prev_barcode == barcode:
 								self.scanned_out = True
 								tf.updateStatus(TStatus.completed)
-								self.tp.sortTransfers()
 								return
 							else:
 								self.log(
@@ -115,34 +208,28 @@ class TubeToWell:
 					found_well = False
 
 					# Find the transfer with this barcode
-					for i, tf_id in enumerate(self.tp.tf_seq):
-						tf = self.tp.transfers[tf_id]
-						if barcode == tf["source_tube"] and tf["status"] == "completed":
-							# This raises a duplicate barcode error message to the user
-							found_well = True
-							self.tp.next(barcode)
-							break
-						if barcode == tf["source_tube"] and tf["status"] not in ["completed",'discarded']:
+					matches = self.tp.transfersWithBarcode(barcode)
+					if "completed" in matches.values():
+						# This raises a duplicate barcode error message to the user
+						found_well = True
+						self.tp.next(barcode)
+					else:
+						# the first of its transfers in fill order, not in the order the index saw them
+						transfer = self.tp.findTransferByBarcode(barcode)
+						if transfer is not None:
 							found_well = True
-							id = tf.id
-							self.tp.tf_seq.insert(self.tp._current_idx, id)
-							self.tp.tf_seq.pop(i + 1)
+							self.tp.moveToCurrent(transfer.id)
 							self.tp.next(barcode)
 							self.writeTransferRecordFiles()
-							break
 					# If the well is not found above (for example, because the user discarded the originally reserved well for that barcode),
 					# scan through all the other wells to see if any are available (i.e not reserved and can be used)
 					if found_well == False:
-						for i, tf_id in enumerate(self.tp.tf_seq):
-							tf = self.tp.transfers[tf_id]
-							if tf["source_tube"] not in self.barcode_to_well.keys() and tf["status"] not in ["completed", "started", "discarded"]:
-								found_well = True
-								id = tf.id
-								self.tp.tf_seq.insert(self.tp._current_idx, id)
-								self.tp.tf_seq.pop(i + 1)
-								self.tp.next(barcode)
-								self.writeTransferRecordFiles()
-								break
+						id = self.tp.allocator.nextFree()
+						if id is not None:
+							found_well = True
+							self.tp.moveToCurrent(id)
+							self.tp.next(barcode)
+							self.writeTransferRecordFiles()
 
 					# If no well can be found, inform the user.
 					if found_well == False:
@@ -153,18 +240,9 @@ class TubeToWell:
 
 				elif self.sample_list is None:
 					# find the next non-reserved well in the sequence
-					found_well = False
-					for i, tf_id in enumerate(self.tp.tf_seq):
-						tf = self.tp.transfers[tf_id]
-						if tf["source_tube"] not in self.barcode_to_well.keys() and tf[
-							"status"
-						] not in ["started", "completed", "discarded"]:
-							id = tf.id
-							self.tp.tf_seq.insert(self.tp._current_idx, id)
-							self.tp.tf_seq.pop(i + 1)
-							found_well = True
-							break
-					if found_well == True:
+					id = self.tp.allocator.nextFree()
+					if id is not None:
+						self.tp.moveToCurrent(id)
 						self.tp.next(barcode)
 						self.writeTransferRecordFiles()
 					else:
@@ -177,11 +255,200 @@ class TubeToWell:
 					self.tp.next(barcode)
 					self.writeTransferRecordFiles()
 
+	def checkOtherPlates(self, barcode):
+		"""Raises TError if the tube is already in a started or completed well of another plate in progress."""
+		for plate_barcode, well in self.tube_index.platesWith(barcode).items():
+			if plate_barcode != self.plate_barcode:
+				self.log(f"The tube you scanned, {barcode}, was already scanned into well {well} of plate {plate_barcode}.")
+				raise TError(self.msg)
+
+	def historyIndex(self):
+		"""
+		Returns the barcode index of the records directory, or None if checking previous plates is turned
+		off or the index can't be opened. A new index is filled from the records already there on a
+		background thread, so until that is done a tube is only checked against the records indexed so far.
+		"""
+		if not self.check_previous_plates:
+			return None
+		if self.history is None or self.history_dir != self.records_dir:
+			try:
+				self.history = open_index(self.records_dir)
+			except (sqlite3.Error, OSError) as err:
+				logging.error("Cannot open the barcode index in %s: %s" % (self.records_dir, err))
+				self.history = None
+				return None
+			self.history_dir = self.records_dir
+		return self.history
+
+	def checkPreviousPlates(self, barcode):
+		"""Raises TError if the tube is already in a recorded plate other than this one."""
+		index = self.historyIndex()
+		if index is None or barcode == EMPTY_FLAG:
+			return
+		try:
+			found = index.lookup(barcode, exclude_record=self.csv)
+		except sqlite3.Error as err:
+			logging.error("Cannot look up %s in the barcode index: %s" % (barcode, err))
+			return
+		if found is not None:
+			plate, well, timestamp, _ = found
+			self.log(
+				f"The tube you scanned, {barcode}, was already scanned into well {well} of plate {plate} ({timestamp})."
+			)
+			raise TError(self.msg)
+
+	def loadRackCSV(self, filename):
+		"""
+		Places every tube of a rack scan at once (see preassignBatch). The csv has a header row followed by
+		one tube barcode per row in the first column, in the order the tubes should fill the plate.
+		"""
+		try:
+			barcodes = [barcode for _, barcode in read_sample_ids(filename)]
+		except (OSError, UnicodeDecodeError, csv.Error):
+			self.log(f"Failed to load rack csv (tried to load {filename}).")
+			raise TError(self.msg)
+		return self.preassignBatch(barcodes)
+
+	@recorded
+	def preassignBatch(self, barcodes):
+		"""
+		Places a whole batch of tubes (e.g. a rack scan) in one call, leaving the plate exactly as scanning
+		them one by one with next would (scanning each one out again when scan out is enabled): tubes
+		reserved by the template go to their wells, the others to the next free wells in fill order.
+
+		The batch is checked as a whole first, against the sample list, the template reservations, the
+		tubes already on this and other plates, repeats within the batch and the wells left; if anything
+		is wrong nothing is placed and TError lists every problem (also kept in batch_errors). The record
+		is written once for the whole batch. Returns [(barcode, well)]; stepBatch then lights the wells
+		up one at a time for pipetting.
+		"""
+		self.tp_present()
+		barcodes = [str(barcode).strip() for barcode in barcodes]
+		if not barcodes:
+			self.log("The rack has no tubes.")
+			raise TError(self.msg)
+		if self.enable_scan_out and not self.scanned_out:
+			self.log("Scan out the current tube before placing a rack of tubes.")
+			raise TError(self.msg)
+
+		report = self.validateBatch(barcodes)
+		if report:
+			self.batch_errors = report
+			lines = [
+				("Tube %s (%s): %s" % (entry["position"], entry["barcode"], entry["error"]))
+				if entry["position"] is not None
+				else entry["error"]
+				for entry in report
+			]
+			self.log(
+				"The rack has %s problem(s), no tubes were placed. Please fix these and try again:\n%s"
+				% (len(lines), "\n".join(lines))
+			)
+			raise TError(self.msg)
+		self.batch_errors = []
+
+		self.logSessionEvent("preassignBatch", barcodes)
+		wells = self.tp.assignBatch(barcodes, scan_out=self.enable_scan_out)
+		self.scanned_out = self.enable_scan_out
+		self.writeTransferRecordFiles()
+		self.batch = list(zip(barcodes, wells))
+		self.batch_position = 0
+		self.log("Placed %s tubes, from well %s to well %s" % (len(wells), wells[0], wells[-1]))
+		return self.batch
+
+	def validateBatch(self, barcodes):
+		"""
+		Returns the problems that stop a batch of tubes from being placed, as a list of
+		{"position": 1-based position in the batch (None for the batch as a whole), "barcode": ..., "error": ...}.
+		"""
+		tp = self.tp
+		report = []
+
+		def addError(i, barcode, error):
+			report.append({"position": i + 1, "barcode": barcode, "error": error})
+
+		# earlier plates are looked up for the whole batch at once
+		previous = {}
+		index = None if self.replaying else self.historyIndex()
+		if index is not None:
+			try:
+				previous = index.lookupMany(barcodes, exclude_record=self.csv)
+			except sqlite3.Error as err:
+				logging.error("Cannot look up the rack in the barcode index: %s" % err)
+
+		seen = {}
+		need_free_well = 0
+		for i, barcode in enumerate(barcodes):
+			if not barcode or barcode == EMPTY_FLAG or is_malformed(barcode):
+				addError(i, barcode, "Not a valid tube barcode")
+				continue
+			if not tp.isTube(barcode):
+				addError(i, barcode, "Not a valid tube barcode: %s" % tp.tube_rule.explain(barcode))
+				continue
+			if barcode in seen:
+				addError(i, barcode, "Repeated in the rack (tube %s)" % (seen[barcode] + 1))
+				continue
+			seen[barcode] = i
+			matches = tp.transfersWithBarcode(barcode)
+			placed = [tf_id for tf_id, status in matches.items() if status in ("started", "completed")]
+			if placed:
+				addError(i, barcode, "Already scanned into well %s" % tp.transfers[placed[0]]["dest_well"])
+				continue
+			if not self.replaying and self.tube_index is not None:
+				other_plates = sorted(
+					(plate, well) for plate, well in self.tube_index.platesWith(barcode).items() if plate != self.plate_barcode
+				)
+				if other_plates:
+					addError(i, barcode, "Already scanned into well %s of plate %s" % (other_plates[0][1], other_plates[0][0]))
+					continue
+			if barcode in previous:
+				plate, well, timestamp, _ = previous[barcode]
+				addError(i, barcode, "Already scanned into well %s of plate %s (%s)" % (well, plate, timestamp))
+				continue
+			if barcode in self.barcode_to_well:
+				if any(status != "discarded" for status in matches.values()):
+					# goes into its reserved well
+					continue
+			elif self.sample_list is not None and barcode not in self.sample_list:
+				addError(i, barcode, "Not in the sample list")
+				continue
+			need_free_well += 1
+
+		free_wells = sum(1 for tf_id in tp.tf_seq if tp.allocator.isFree(tf_id))
+		if need_free_well > free_wells:
+			report.append(
+				{
+					"position": None,
+					"barcode": None,
+					"error": "%s tubes need a free well but only %s are left on the plate" % (need_free_well, free_wells),
+				}
+			)
+		return report
+
+	def stepBatch(self):
+		"""
+		Lights up the well of the next tube of the last batch placed with preassignBatch. Returns
+		(barcode, well), or None (clearing the batch) once every tube has been shown.
+		"""
+		self.tp_present()
+		if not self.batch or self.batch_position >= len(self.batch):
+			self.batch = None
+			self.batch_position = 0
+			self.tp.lightup_well = None
+			return None
+		barcode, well = self.batch[self.batch_position]
+		self.batch_position += 1
+		self.tp.lightup_well = well
+		self.log("Tube %s of %s: %s -> %s" % (self.batch_position, len(self.batch), barcode, well))
+		return barcode, well
+
+	@recorded
 	def skip(self):
 		if self.tp_present():
 			self.tp.skip()
 			self.writeTransferRecordFiles()
 
+	@recorded
 	def failed(self):
 		if self.tp_present():
 			self.tp.failed()
@@ -194,8 +461,10 @@ class TubeToWell:
 
 		return prev_transfer
 
+	@recorded
 	def undoCurrentScan(self):
-		if not self.warningsMade:
+		self.logSessionEvent("undoCurrentScan")
+		if not self.warningsMade and not self.replaying:
 			self.makeWarningFile()
 			self.warningsMade = True
 		self.writeWarning()
@@ -208,8 +477,10 @@ class TubeToWell:
 					self.tp.undoCurrentScan()
 			self.writeTransferRecordFiles()
 
+	@recorded
 	def undo(self):
-		if not self.warningsMade:
+		self.logSessionEvent("undo")
+		if not self.warningsMade and not self.replaying:
 			self.makeWarningFile()
 			self.warningsMade = True
 		self.writeWarning()
@@ -217,47 +488,189 @@ class TubeToWell:
 			self.tp.undo()
 			self.writeTransferRecordFiles()
 
+	@recorded
+	def skipNextWell(self):
+		"""Skips the next well, marking it as empty in the records."""
+		if self.tp_present():
+			self.logSessionEvent("skipNextWell")
+			self.tp.skipNextWell()
+			self.writeTransferRecordFiles()
+
+	@recorded
+	def discardSpecificWell(self, well_name):
+		"""Discards a used or reserved well, freeing its tube to be aliquoted into another well."""
+		if self.tp_present():
+			self.logSessionEvent("discardSpecificWell", well_name)
+			self.tp.discardSpecificWell(well_name)
+			self.writeTransferRecordFiles()
+
+	def undoSteps(self, count=1):
+		"""
+		Takes back the last count actions on the plate (scans, undos, skips, discards, racks), most recent
+		first, from the protocol's history of the last HISTORY_DEPTH actions. Wells that lose a placed
+		tube are written to the warning file. Raises TError if there is nothing to undo.
+		"""
+		self.tp_present()
+		self.logSessionEvent("undoSteps", count)
+		undone, warnings = self.tp.undo_history.undo(self, count)
+		if not undone:
+			self.log("Nothing to undo")
+			raise TError(self.msg)
+		self.writeWarningRows(warnings)
+		self.writeTransferRecordFiles()
+		self.log("Undid %s action%s" % (undone, "" if undone == 1 else "s"))
+		return undone
+
+	def redoSteps(self, count=1):
+		"""Makes the last count actions taken back by undoSteps again, oldest first. Raises TError if there is nothing to redo."""
+		self.tp_present()
+		self.logSessionEvent("redoSteps", count)
+		redone, warnings = self.tp.undo_history.redo(self, count)
+		if not redone:
+			self.log("Nothing to redo")
+			raise TError(self.msg)
+		self.writeWarningRows(warnings)
+		self.writeTransferRecordFiles()
+		self.log("Redid %s action%s" % (redone, "" if redone == 1 else "s"))
+		return redone
+
+	def configureMetrics(self, config):
+		"""
+		Turns the operation metrics (see Metrics.py) on or off: "metrics_file" is the JSON-lines file to
+		write them to and "metrics_port" the local port to serve them on for Prometheus ("" and 0 are off).
+		A configuration without either entry leaves the metrics as they are.
+		"""
+		if not config.metrics_configured:
+			return
+		try:
+			METRICS.configure(config.metrics_file, config.metrics_port)
+		except (OSError, ValueError) as error:
+			logging.warning(
+				"Failed to enable metrics (file %s, port %s): %s", config.metrics_file, config.metrics_port, error
+			)
+
+	def protocolKey(self):
+		return TemplateCache.protocol_key(
+			self.num_wells, self.fill_order, self.custom_layout, self.controls, self.barcode_to_well
+		)
+
+	def applyConfig(self, config, reload=False):
+		"""
+		Makes config (a Configuration, see Configuration.py) the one in use. A configuration loaded with
+		setConfigurationFile unloads the template; one reloaded after an edit (reload) keeps the template
+		and the chosen records folder, unless the plate layout changed. Returns True if the transfer
+		protocol has to be rebuilt for it.
+		"""
+		previous = self.config
+		old_key = None if previous is None else self.protocolKey()
+		template_in_use = previous is not None and (bool(self.barcode_to_well) or self.controls != previous.controls)
+		keep_template = reload and template_in_use and config.geometry() == previous.geometry()
+		if reload and template_in_use and not keep_template:
+			self.log("The plate layout in the configuration file changed, the template was unloaded")
+
+		self.config = config
+		self.num_wells = config.num_wells
+		self.fill_order = config.fill_order
+		self.custom_layout = config.custom_layout
+		self.enable_scan_out = config.enable_scan_out
+		self.check_previous_plates = config.check_previous_plates
+		self.barcode_rules = config.barcode_rules
+		self.records_dir = config.records_dir
+		self.samples_dir = config.samples_dir
+		self.templates_dir = config.templates_dir
+		if not reload:
+			self.custom_records_dir = None
+		if not keep_template:
+			self.controls = list(config.controls)
+			self.barcode_to_well = {}
+		self.configureMetrics(config)
+
+		if not os.path.isdir(self.records_dir):
+			self.records_dir = self.cwd + "/records/"
+
+		if not os.path.isdir(self.samples_dir):
+			self.samples_dir = self.cwd + "/samples/"
+
+		if not os.path.isdir(self.templates_dir):
+			self.templates_dir = self.cwd + "/templates/"
+
+		if self.tp is None or old_key != self.protocolKey():
+			return True
+		# the protocol can stay, with the new rules
+		self.tp.barcode_to_well = self.barcode_to_well
+		self.tp.tube_rule = self.barcode_rules.tube
+		return False
+
+	def watchConfiguration(self, interval=POLL_INTERVAL):
+		"""
+		Watches the configuration file in use for edits. A valid edit is applied when no plate is in
+		progress any more (see reset), so a plate is never switched to another configuration part way.
+		"""
+		self.stopWatchingConfiguration()
+		if self.config.path is not None:
+			self.config_watcher = ConfigWatcher(self.config.path, self.queueConfig, interval).start()
+
+	def stopWatchingConfiguration(self):
+		if self.config_watcher is not None:
+			self.config_watcher.stop()
+			self.config_watcher = None
+
+	def queueConfig(self, config):
+		"""Keeps an edited configuration (called from the ConfigWatcher thread) for applyPendingConfig."""
+		self.pending_config = config
+
+	def applyPendingConfig(self):
+		"""Applies the configuration file edited since it was loaded, if any. Returns True if there was one."""
+		config = self.pending_config
+		if config is None:
+			return False
+		if self.pending_config is config:
+			self.pending_config = None
+		self.applyConfig(config, reload=True)
+		logging.info("Reloaded the edited configuration file %s", config.path)
+		return True
+
 	def log(self, msg):
 		self.msg = msg
 		logging.info(msg)
 
+	@instrument("checkSampleList")
 	def checkSampleList(self, barcode):
 		if barcode not in self.sample_list:
 			raise TError("Sample barcode not in list of pre-defined sample names.")
 
 	def setConfigurationFile(self, filename):
+		"""
+		Loads a configuration file (see Configuration.py). If it can't be read or isn't valid the default
+		configuration is loaded instead and TError is raised with the problems found. The protocol is only
+		rebuilt if the plate changes.
+		"""
 		err = False
+		start = time.perf_counter()
 		try:
-			with open(filename) as json_file:
-				configs = json.load(json_file)
-		except:
+			config = load_config(filename)
+			recordStartupTime("setConfigurationFile: load configuration", start)
+		except (OSError, ValueError) as error:
 			err = True
 			self.log(
-				f"Failed to load configuration file (tried to load {filename}). Loading default configuration file and continuing..."
+				f"Failed to load configuration file (tried to load {filename}): {error}. Loading default configuration file and continuing..."
 			)
-		self.num_wells = configs["num_wells"]
-		self.records_dir = configs["records_dir"]
-		self.custom_records_dir = None
-		self.samples_dir = configs["samples_dir"]
-		self.templates_dir = configs["templates_dir"]
-		self.controls = configs["controls"]
-		self.enable_scan_out = configs["enable_scan_out"]
-		self.barcode_to_well = {}
+			try:
+				config = load_config(os.path.join(self.config_dir, "DEFAULT_CONFIG.json"))
+			except (OSError, ValueError) as default_error:
+				self.log(f"{self.msg}\nFailed to load the default configuration file: {default_error}")
+				raise TError(self.msg)
+		unused = self.tp is not None and self.tp._current_idx == 0 and not self.tp.undo_history.canUndo()
+		rebuild = self.applyConfig(config)
 		self.csv = ""
 		self.warning_file_path = ""
 		self.scanned_out = True
 
-		if not os.path.isdir(self.records_dir):
-			self.records_dir = self.cwd + "/records/"
-
-		if not os.path.isdir(self.samples_dir):
-			self.samples_dir = self.cwd + "/samples/"
-
-		if not os.path.isdir(self.templates_dir):
-			self.templates_dir = self.cwd + "/templates/"
+		if rebuild or not unused:
+			start = time.perf_counter()
+			self.tp = self.buildProtocol()
+			recordStartupTime("setConfigurationFile: build transfer protocol", start)
 
-		self.tp = TTWTransferProtocol(self, controls=self.controls, num_wells=self.num_wells)
-		
 		if err:
 			raise TError(self.msg)
 
@@ -265,16 +678,31 @@ class TubeToWell:
 		"""
 		Loads in a csv file of sample names to be verified.
 		"""
+		self.logSessionEvent("loadCSV", filename)
+		# the cached index of the list loaded before can only be rewritten once it is unmapped (on Windows)
+		self.closeSampleList()
 		try:
 			# read the spreadsheet assuming first column is list of sample names, skipping the first row
-			samples_df = pd.read_csv(filename, skiprows=1, names=["sample"], dtype=str)
-			self.sample_list = [s for s in samples_df["sample"]]
-			self.log("Successfully loaded %s sample names" % len(self.sample_list))
-		except:
-			self.log("Failed to load file csv \n %s" % csv)
+			manifest = load_sample_index(filename, self.cache_dir)
+		except Exception:
+			self.log("Failed to load file csv \n %s" % filename)
 			raise TError(self.msg)
 
-	def loadWellConfigurationCSV(self, filename):
+		self.sample_list = manifest
+		self.log("Successfully loaded %s sample names" % len(self.sample_list))
+		report = manifest.report()
+		if report:
+			self.log("Loaded %s sample names.\n%s" % (len(self.sample_list), report))
+			raise TConfirm(self.msg)
+
+	def closeSampleList(self):
+		"""Drops the loaded sample list, closing the memory map of its cached index (see SampleManifest.py)."""
+		sample_list, self.sample_list = self.sample_list, None
+		close = getattr(sample_list, "close", None)
+		if close is not None:
+			close()
+
+	def loadWellConfigurationCSV(self, filename, digest=None):
 		"""Loads a well configuration csv/excel sheet.
 
 		This sheet uses a pre-defined template which maps well numbers (e.g A1/A2/D3/H5, etc.)
@@ -282,11 +710,42 @@ class TubeToWell:
 		Additionally instead of marking a well as "Available" or "Not Available", users can also map a well
 		to a specific sample barcode. If a well is mapped to a specific barcode, only the sample with the corresponding barcode
 		can be aliquoted into that well.
+
+		The session journal records the sha256 digest of the file with the filename; a resumed plate passes
+		it back as digest, and a file that changed since it was loaded raises TError.
 		"""
 
+		try:
+			with open(filename, "rb") as template_file:
+				data = template_file.read()
+		except OSError:
+			self.logSessionEvent("loadWellConfigurationCSV", filename)
+			self.log(
+				f"Failed to load well configuration csv (tried to load {filename})."
+			)
+			raise TError(self.msg)
+		file_digest = hashlib.sha256(data).hexdigest()
+		if digest is not None and digest != file_digest:
+			self.log(f"The well configuration csv {filename} changed since it was loaded.")
+			raise TError(self.msg)
+		self.logSessionEvent("loadWellConfigurationCSV", filename, file_digest)
+
+		# a template already parsed for this plate type is taken from the cache, see TemplateCache.py
+		key = TemplateCache.template_key(data, self.num_wells, self.fill_order, self.custom_layout)
+		template = TemplateCache.templates.get(key)
+		if template is not None:
+			controls, barcode_to_well = template
+			self.template_errors = []
+			self.controls = list(controls)
+			self.barcode_to_well = dict(barcode_to_well)
+			self.tp = self.buildProtocol()
+			return
+
+		import pandas as pd
+
 		try:
 			wells_config_df = pd.read_csv(
-				filename,
+				io.BytesIO(data),
 				header=0,
 				names=["wells", "availability", "barcodes"],
 				dtype=str,
@@ -298,6 +757,7 @@ class TubeToWell:
 			raise TError(self.msg)
 
 		self.parseWellConfigurationCSV(wells_config_df)
+		TemplateCache.templates.put(key, (tuple(self.controls), tuple(self.barcode_to_well.items())))
 
 	def parseWellConfigurationCSV(self, wells_config_df):
 		"""Parses the well_configuration.csv and performs some basic input validation.
@@ -309,64 +769,93 @@ class TubeToWell:
 		If there are any input errors, this function will fail and raise a specific error alerting the user
 		of the error(s) in the csv sheet that need to be rectified.
 		"""
-		valid_wells = self.tp.generateWellList()
+		# checked against the plate type the new protocol will have (the template cache is keyed by it)
+		valid_wells = plate_geometry(self.num_wells, self.fill_order, self.custom_layout).well_index
 
 		# Clean-up data
-		wells_config_df["wells"] = wells_config_df["wells"].str.upper()
-		wells_config_df["availability"] = wells_config_df["availability"].str.upper()
+		wells = wells_config_df["wells"].str.upper()
+		availability = wells_config_df["availability"].str.upper()
+		barcodes = wells_config_df["barcodes"]
+		has_barcode = barcodes.notna()
+		not_available = availability == "NOT AVAILABLE"
+
+		# Run every check over the whole sheet and collect the failing rows into a single report,
+		# one entry per problem: {"row": spreadsheet row, "column": A/B/C, "value": entry, "error": description}
+		report = []
+
+		def addErrors(mask, column, values, error):
+			for index, value in values[mask].items():
+				report.append(
+					{"row": index + 2, "column": column, "value": value, "error": error}
+				)
 
 		# Validate that the user entered wells are valid
-		no_nan_wells = wells_config_df[wells_config_df["wells"].notna()]["wells"]
-		invalid_wells = ~no_nan_wells.isin(valid_wells)
-		if any(invalid_wells):
-			list_of_invalid_rows = no_nan_wells[invalid_wells].to_string(
-				index=False, header=False
-			)
-			self.log(
-				f"Invalid well(s) encountered in column A: \n{list_of_invalid_rows}."
-			)
-			raise TError(self.msg)
+		invalid_wells = wells.notna() & ~wells.isin(valid_wells)
+		addErrors(invalid_wells, "A", wells, "Invalid well")
 
 		# Validate that there are no repeat barcodes
-		if not wells_config_df["barcodes"].dropna().is_unique:
-			self.log("A barcode has been repeated. Please fix this in the sheet.")
-			raise TError(self.msg)
+		repeated_barcodes = has_barcode & barcodes.duplicated(keep=False)
+		addErrors(repeated_barcodes, "C", barcodes, "Repeated barcode")
 
 		# Validate the available/not available column for invalid entries
-		no_nan_availability = wells_config_df[wells_config_df["availability"].notna()][
-			"availability"
-		]
-		invalid_availability = ~no_nan_availability.isin(["AVAILABLE", "NOT AVAILABLE"])
-		if any(invalid_availability):
-			list_of_invalid_rows = no_nan_availability[invalid_availability].to_string(
-				index=False, header=False
-			)
+		invalid_availability = availability.notna() & ~availability.isin(
+			["AVAILABLE", "NOT AVAILABLE"]
+		)
+		addErrors(invalid_availability, "B", availability, "Invalid Available/Not Available entry")
+
+		# A well can't be both unavailable and reserved for a barcode
+		unavailable_with_barcode = not_available & has_barcode
+		addErrors(
+			unavailable_with_barcode,
+			"C",
+			barcodes,
+			"Well specified as 'Not Available' AND assigned a barcode",
+		)
+
+		if report:
+			self.template_errors = sorted(report, key=lambda entry: entry["row"])
+			lines = [
+				"Row %s, column %s (%s): %s" % (entry["row"], entry["column"], entry["value"], entry["error"])
+				for entry in self.template_errors
+			]
 			self.log(
-				f"Invalid Available/Not Available entry in column B: \n{list_of_invalid_rows}"
+				"The template file has %s error(s). Please fix these in the sheet and try again:\n%s"
+				% (len(lines), "\n".join(lines))
 			)
 			raise TError(self.msg)
+		self.template_errors = []
 
 		# Add the unavailable wells and mark the wells reserved for specific barcodes
 		# Note if a templating file is loaded, the default control wells (as specified in the json file) are discarded.
-		self.controls = []
-		self.barcode_to_well = {}
-		for _, row in wells_config_df.iterrows():
-			well_number = row["wells"]
-			availability = row["availability"]
-			barcode = row["barcodes"]
-
-			if availability == "NOT AVAILABLE" and not pd.isna(barcode):
-				self.log(
-					f"A well has been specified as 'Not Available' AND a barcode has been assigned to this well. Please fix this in the sheet and try again. Issue on row: \n{well_number, availability, barcode}"
-				)
-				raise TError(self.msg)
-			elif availability == "NOT AVAILABLE":
-				self.controls.append(well_number)
-			elif not pd.isna(barcode):
-				barcode = str(barcode)
-				self.barcode_to_well[barcode] = well_number
+		self.controls = wells[not_available].tolist()
+		reserved = has_barcode & ~not_available
+		self.barcode_to_well = dict(
+			zip(barcodes[reserved].astype(str).tolist(), wells[reserved].tolist())
+		)
+
+		self.tp = self.buildProtocol()
 
-		self.tp = TTWTransferProtocol(self, controls=self.controls, num_wells=self.num_wells)
+	def buildProtocol(self):
+		"""
+		Returns a new transfer protocol for the current plate type and template, cloned from the cached
+		protocol for them when there is one (see TemplateCache.py).
+		"""
+		key = self.protocolKey()
+		skeleton = TemplateCache.protocols.get(key)
+		if skeleton is None:
+			skeleton = TTWTransferProtocol(
+				self,
+				controls=self.controls,
+				num_wells=self.num_wells,
+				fill_order=self.fill_order,
+				custom_layout=self.custom_layout,
+			)
+			# the cached skeleton outlives this TubeToWell's template, so it keeps copies of it
+			skeleton.controls = list(self.controls)
+			skeleton.barcode_to_well = dict(self.barcode_to_well)
+			skeleton.allocator.reserved_barcodes = skeleton.barcode_to_well
+			TemplateCache.protocols.put(key, skeleton)
+		return skeleton.clone(self)
 
 	def setSaveDirectory(self, directory):
 		"""Sets the location to save records"""
@@ -380,6 +869,9 @@ class TubeToWell:
 			self.tp.current_idx_decrement()
 			transfer = self.tp.current_transfer
 			self.tp.current_idx_increment()
+			if self.replaying:
+				# the file was written when the action was first made
+				return
 			keys = ["timestamp", "source_tube", "dest_plate", "dest_well", "status"]
 			with open(self.warning_file_path + ".csv", "a", newline="") as csvFile:
 				writer = csv.writer(csvFile)
@@ -390,6 +882,16 @@ class TubeToWell:
 				writer.writerow(warning_row)
 				csvFile.close()
 
+	def writeWarningRows(self, rows):
+		"""Appends rows of changed transfers ([timestamp, source tube, plate, well, status]) to the warning file."""
+		if self.replaying or not rows:
+			return
+		if not self.warningsMade:
+			self.makeWarningFile()
+		marked = " Marked Undone at " + time.strftime("%Y%m%d-%H%M%S")
+		with open(self.warning_file_path + ".csv", "a", newline="") as csvFile:
+			csv.writer(csvFile).writerows([row + [marked] for row in rows])
+
 	def makeWarningFile(self):
 		"""
 		Creates a warning file is none exists already
@@ -410,46 +912,322 @@ class TubeToWell:
 		self.timestamp = time.strftime("%Y%m%d-%H%M%S")
 		self.plate_barcode = plate_barcode
 		self.csv = self.timestamp + "_" + self.plate_barcode + "_tube_to_plate"
+		self.startSession()
+		# open the barcode index now rather than on the first scan (a new one is backfilled in the background)
+		self.historyIndex()
+
+	def startSession(self):
+		"""Starts the session journal for a new plate, recording everything needed to rebuild it."""
+		if self.session is not None:
+			self.session.close()
+		self.session = SessionJournal(session_path(self.records_dir, self.csv))
+		self.session.start(
+			{
+				"timestamp": self.timestamp,
+				"user": self.user,
+				"plate_barcode": self.plate_barcode,
+				"csv": self.csv,
+				"records_dir": self.records_dir,
+				"custom_records_dir": self.custom_records_dir,
+				"num_wells": self.num_wells,
+				"fill_order": self.fill_order,
+				"custom_layout": self.custom_layout,
+				"controls": self.controls,
+				"barcode_to_well": self.barcode_to_well,
+				"enable_scan_out": self.enable_scan_out,
+				"scanned_out": self.scanned_out,
+				"sample_list": getattr(self.sample_list, "filename", None),
+			}
+		)
+
+	def findResumableSession(self):
+		"""Returns the newest session journal in the records directory that fits the loaded plate layout, or None."""
+		for path in find_sessions(self.records_dir):
+			try:
+				header = read_session_header(path)
+			except (OSError, ValueError):
+				continue
+			layout = (header.get("num_wells"), header.get("fill_order"), header.get("custom_layout"))
+			if TemplateCache.geometry_key(*layout) == TemplateCache.geometry_key(
+				self.num_wells, self.fill_order, self.custom_layout
+			):
+				return path
+		return None
 
-	def writeTransferRecordFiles(self):
+	def logSessionEvent(self, op, *args):
+		"""Appends an action to the session journal before it is applied."""
+		if self.session is not None and not self.replaying:
+			self.session.append(op, *args)
+
+	def endSession(self):
+		"""Removes the session journal once its plate is finished."""
+		if self.session is not None:
+			self.session.remove()
+			self.session = None
+
+	def abandonSession(self, path):
+		"""
+		Finishes an unfinished plate the operator chose not to resume: rebuilds it from its session journal
+		on a separate TubeToWell, writes its record csv(s) exactly as finishing the plate would have and
+		removes the session journal. Returns False (leaving the journals as they are) if it can't be rebuilt.
+		"""
+		try:
+			header = read_session_header(path)
+		except (OSError, ValueError) as err:
+			logging.error("Cannot read the session journal %s: %s" % (path, err))
+			return False
+		finisher = type(self)()
+		# the plate is finished with the layout it was started with, whatever the configuration loaded now
+		finisher.num_wells = header.get("num_wells")
+		finisher.fill_order = header.get("fill_order")
+		finisher.custom_layout = header.get("custom_layout")
+		finisher.barcode_rules = self.barcode_rules
+		# the tubes were checked against earlier plates when they were scanned
+		finisher.check_previous_plates = False
+		try:
+			finisher.resumeSession(path)
+			finisher.compactTransferRecordFiles()
+		except TError as err:
+			logging.error("Cannot finish the plate of %s: %s" % (path, err))
+			if finisher.session is not None:
+				finisher.session.close()
+				finisher.session = None
+			return False
+		finally:
+			finisher.closeSampleList()
+		finisher.endSession()
+		return True
+
+	def compactLeftoverJournals(self):
+		"""
+		Compacts the record journals in the records directories that no session journal can resume (e.g.
+		left by a crash after the session journal was removed) into their record csvs.
+		Returns the record paths compacted.
+		"""
+		compacted = []
+		for directory in (self.records_dir, self.custom_records_dir):
+			if directory is None:
+				continue
+			for path in sorted(glob.glob(os.path.join(glob.escape(directory), "*.csv" + JOURNAL_EXTENSION))):
+				record_path = path[: -len(JOURNAL_EXTENSION)]
+				name = os.path.basename(record_path)[: -len(".csv")]
+				if os.path.isfile(session_path(self.records_dir, name)):
+					continue
+				try:
+					compact_transfer_journal(record_path)
+				except (OSError, ValueError) as err:
+					logging.error("Cannot compact the record journal of %s: %s" % (record_path, err))
+					continue
+				compacted.append(record_path)
+		return compacted
+
+	def resumeSession(self, path):
+		"""
+		Rebuilds an unfinished plate from its session journal (see SessionJournal.py) by replaying the
+		recorded actions without touching the record files, then restores the transfer timestamps from
+		the record journal and brings the record up to date with the rebuilt state.
+		Raises TError if the journal or the sample list it refers to can't be loaded.
+		"""
+		try:
+			header, events = read_session(path)
+		except (OSError, ValueError, IndexError) as err:
+			self.log(f"Cannot resume the plate from {path}: {err}")
+			raise TError(self.msg)
+		problem = self.sessionMismatch(header, events)
+		if problem is not None:
+			self.log(f"Cannot resume the plate from {path}: {problem}")
+			raise TError(self.msg)
+
+		if self.session is not None:
+			self.session.close()
+			self.session = None
+		self.timestamp = header["timestamp"]
+		self.user = header["user"]
+		self.plate_barcode = header["plate_barcode"]
+		self.csv = header["csv"]
+		self.records_dir = header["records_dir"]
+		self.custom_records_dir = header["custom_records_dir"]
+		self.num_wells = header["num_wells"]
+		self.fill_order = header["fill_order"]
+		self.custom_layout = header["custom_layout"]
+		self.controls = header["controls"]
+		self.barcode_to_well = header["barcode_to_well"]
+		self.enable_scan_out = header["enable_scan_out"]
+		self.scanned_out = header["scanned_out"]
+		self.metadata = record_metadata(self.timestamp, self.user, self.plate_barcode)
+		self.record_journals = {}
+		self.closeSampleList()
+		if header["sample_list"] is not None:
+			try:
+				self.sample_list = load_sample_index(header["sample_list"], self.cache_dir)
+			except Exception:
+				self.log(f"Cannot resume the plate: failed to load its sample list {header['sample_list']}")
+				raise TError(self.msg)
+		self.warning_file_path = os.path.join(self.records_dir + self.csv + "_WARNING")
+		self.warningsMade = os.path.isfile(self.warning_file_path + ".csv")
+		if not self.warningsMade:
+			self.warning_file_path = ""
+
+		self.tp = self.buildProtocol()
+		self.replaying = True
+		try:
+			for op, args in events:
+				try:
+					getattr(self, op)(*args)
+				except (TError, TConfirm):
+					# the action failed the same way when it was first made
+					pass
+		finally:
+			self.replaying = False
+
+		self.tp.popChangedTransfers()
+		for record_path in self.recordPaths():
+			self.syncRecordJournal(record_path)
+		self.session = SessionJournal(path)
+		self.session.reopen()
+		self.log(f"Resumed plate {self.plate_barcode} ({len(events)} actions replayed)")
+
+	def sessionMismatch(self, header, events):
+		"""
+		Returns why a session journal can't be resumed with the configuration and files loaded now, or None:
+		a plate layout other than the loaded configuration's (the one the plate display shows), template wells
+		that aren't on that plate, or a template file loaded during the plate that has changed since.
+		"""
+		try:
+			layout = (header["num_wells"], header["fill_order"], header["custom_layout"])
+			wells = list(header["controls"] or []) + list(header["barcode_to_well"].values())
+		except (KeyError, AttributeError, TypeError) as err:
+			return f"its header is incomplete ({err})"
+		if TemplateCache.geometry_key(*layout) != TemplateCache.geometry_key(
+			self.num_wells, self.fill_order, self.custom_layout
+		):
+			return (
+				f"it is a {layout[0]} well plate ({layout[1]} fill order), but the configuration loaded now is for a"
+				f" {self.num_wells} well plate ({self.fill_order} fill order)"
+			)
+		valid_wells = plate_geometry(*layout).well_index
+		unknown = [well for well in wells if well not in valid_wells]
+		if unknown:
+			return "its template has wells that are not on the plate: " + ", ".join(map(str, unknown))
+		for op, args in events:
+			if op != "loadWellConfigurationCSV" or len(args) < 2:
+				continue
+			try:
+				with open(args[0], "rb") as template_file:
+					changed = hashlib.sha256(template_file.read()).hexdigest() != args[1]
+			except OSError:
+				return f"its template {args[0]} can't be read"
+			if changed:
+				return f"its template {args[0]} changed since it was loaded"
+		return None
+
+	def syncRecordJournal(self, record_path):
 		"""
-		Writes metadata from current transfer sequence to a csv file
+		Copies the timestamps of a resumed plate's transfers from its record, and appends any transfer
+		the record is missing or has out of date (e.g. writes still queued when the app died).
 		"""
+		keys = ["timestamp", "source_tube", "dest_well", "status"]
+		_, rows = read_transfer_journal(record_path)
+		recorded = {row[2]: row for row in rows}
+		missing = []
+		for transfer in self.tp.orderedTransfers():
+			row = recorded.get(transfer["dest_well"])
+			if transfer["status"] == "uncompleted":
+				if row is not None:
+					missing.append([transfer[key] for key in keys])
+			elif row is not None and row[1] == (transfer["source_tube"] or "") and row[3] == transfer["status"]:
+				transfer["timestamp"] = row[0]
+			else:
+				missing.append([transfer[key] for key in keys])
+		if missing:
+			journal, _ = self.recordJournal(record_path)
+			self.record_writer.append(journal, missing)
+
+	def recordPaths(self):
+		"""Returns the record csv path(s) for the current plate, including the custom records directory if set"""
 		record_path_filename = Path(self.records_dir + self.csv + ".csv")
 		paths_to_write = [record_path_filename]
 		if self.custom_records_dir != None:
 			paths_to_write.append(Path(self.custom_records_dir + self.csv + ".csv"))
+		return paths_to_write
+
+	def recordJournal(self, path):
+		"""
+		Returns (journal, is_new) for a record path, creating the journal on first use.
+		is_new is True when neither the record nor its journal exist on disk yet.
+		"""
+		journal = self.record_journals.get(path)
+		if journal is None:
+			journal = TransferJournal(path, self.metadata)
+			self.record_journals[path] = journal
+			return journal, not (journal.exists() or os.path.isfile(path))
+		return journal, False
+
+	@instrument("writeTransferRecordFiles")
+	def writeTransferRecordFiles(self):
+		"""
+		Queues every transfer changed since the last write for appending to the record journal(s).
+		The write happens on the record writer thread; a failure from an earlier write is raised here as a TError.
+		The journal is compacted into the record csv by compactTransferRecordFiles when the plate is finished.
+		"""
+		if self.replaying:
+			return
+		self.record_writer.raiseError()
+		paths_to_write = self.recordPaths()
+		# use the first 4 rows of the output file for metadata
+		self.metadata = record_metadata(self.timestamp, self.user, self.plate_barcode)
+		keys = ["timestamp", "source_tube", "dest_well", "status"]
+		changed_rows = [
+			[self.tp.transfers[tf_id][key] for key in keys]
+			for tf_id in self.tp.popChangedTransfers()
+		]
 		for path in paths_to_write:
-			# use the first 5 rows of the output file for metadata
-			self.metadata = [
-				["%Plate Timestamp: ", self.timestamp],
-				["%Username: ", self.user],
-				["%Plate Barcode: ", self.plate_barcode],
-				["%Timestamp", "Tube Barcode", "Location"],
-			]
-			try:
-				with open(path, "w", newline="") as logfile:
-					log_writer = csv.writer(logfile)
-					log_writer.writerows(self.metadata)
-					keys = ["timestamp", "source_tube", "dest_well"]
-					for transfer_id in self.tp.tf_seq:
-						transfer = self.tp.transfers[transfer_id]
-						status = transfer["status"]
-						if status == "discarded":
-							row = [transfer[key] for key in keys]
-							row[1] += "-discarded"
-							log_writer.writerow(row)
-						elif status != "uncompleted":
-							log_writer.writerow([transfer[key] for key in keys])
-					self.log("Wrote transfer record to " + str(record_path_filename))
-			except:
-				raise TError("Cannot write record file to " + str(path))
+			journal, is_new = self.recordJournal(path)
+			if is_new:
+				# a new record (e.g in a newly chosen save directory) starts from the full current state
+				self.record_writer.append(
+					journal,
+					[
+						[transfer[key] for key in keys]
+						for transfer in self.tp.orderedTransfers()
+						if transfer["status"] != "uncompleted"
+					],
+				)
+			elif changed_rows:
+				self.record_writer.append(journal, changed_rows)
+		index = self.historyIndex()
+		if index is not None and changed_rows:
+			self.record_writer.append(IndexFeed(index, paths_to_write[0], self.plate_barcode), changed_rows)
+
+	def compactTransferRecordFiles(self):
+		"""
+		Writes the complete record csv for the current plate from the transfer sequence and removes the journal(s).
+		Blocks until all queued record writes are on disk.
+		"""
+		self.metadata = record_metadata(self.timestamp, self.user, self.plate_barcode)
+		self.tp.popChangedTransfers()
+		rows = []
+		for transfer in self.tp.orderedTransfers():
+			row = record_row(transfer)
+			if row is not None:
+				rows.append(row)
+		for path in self.recordPaths():
+			journal, _ = self.recordJournal(path)
+			self.record_writer.compact(journal, rows)
+		self.record_writer.flush()
+		self.log("Wrote transfer record to " + str(self.recordPaths()[0]))
 
 	def isPlate(self, check_input):
-		return True
+		if self.barcode_rules.plate.accepts(check_input):
+			return True
+		self.log(f"{check_input} is not a valid plate barcode: {self.barcode_rules.plate.explain(check_input)}")
+		return False
 
 	def isName(self, check_input):
-		return True
+		if self.barcode_rules.name.accepts(check_input):
+			return True
+		self.log(f"{check_input} is not a valid name: {self.barcode_rules.name.explain(check_input)}")
+		return False
 
 
 class TTWTransferProtocol(TransferProtocol):
@@ -458,71 +1236,123 @@ class TTWTransferProtocol(TransferProtocol):
 	and tracking tube origins and transfer status
 	"""
 
-	def __init__(self, ttw: TubeToWell, controls=None, num_wells=96, **kwargs):
+	def __init__(
+		self,
+		ttw: TubeToWell,
+		controls=None,
+		num_wells=96,
+		fill_order="column",
+		custom_layout=None,
+		**kwargs
+	):
 		super(TTWTransferProtocol, self).__init__(**kwargs)
 		self.msg = ""
 		self.controls = controls
 		self.num_wells = num_wells
+		self.geometry = plate_geometry(num_wells, fill_order, custom_layout)
 		self.barcode_to_well = ttw.barcode_to_well
+		# compiled tube barcode rules of the configuration, see BarcodeRules.py
+		self.tube_rule = ttw.barcode_rules.tube
+		# source_tube -> {transfer id: status}, kept live by the PlateModel row views
+		self.barcode_index = {}
+		self._indexed_barcodes = {}
+		# cross-plate tube index and this plate's key in it, when several plates are in progress
+		self.tube_index = None
+		self.index_key = None
+		# transfer ids changed since the last record write, in order of first change
+		self.changed_transfers = {}
+		# number of full re-sorts of the transfer lists (see sortTransfers)
+		self.resorts = 0
 		self.buildTransferProtocol(ttw)
 		self.lightup_well = None  # special well that can be lit up under different edge cases (e.g. rescan)
+		# undo/redo steps of the actions on this plate, see ProtocolHistory.py
+		self.undo_history = ProtocolHistory(self)
 
 	def generateWellList(self):
-		"""Returns a list of well names (e.g A1, A2, etc.) (depending on whether a 96/384 well plate is used)."""
-		well_names = []
-		# build list of wells
-		if self.num_wells == "384":
-			well_rows = [chr(x) for x in range(ord("A"), ord("P") + 1)]
-			well_cols = [i for i in range(1, 25)]
-		else:
-			well_rows = [chr(x) for x in range(ord("A"), ord("H") + 1)]
-			well_cols = [i for i in range(1, 13)]
-
-		for num in well_cols:
-			for letter in well_rows:
-				well_name = letter + str(num)
-				well_names.append(well_name)
-
-		return well_names
+		"""Returns a list of well names (e.g A1, B1, etc.) in fill order for the plate geometry in use."""
+		return list(self.geometry.well_names)
 
 	def buildTransferProtocol(self, ttw: TubeToWell):
-		well_names = self.generateWellList()
-		valid_well_names = []
-		for well_name in well_names:
-			if (well_name not in self.controls) and (
-				well_name not in ttw.barcode_to_well.values()
-			):
-				valid_well_names.append(well_name)
+		excluded_wells = set(self.controls)
+		excluded_wells.update(ttw.barcode_to_well.values())
+		valid_well_names = [
+			well_name
+			for well_name in self.geometry.well_names
+			if well_name not in excluded_wells
+		]
 		self.valid_wells = valid_well_names
 
-		# build transfer protocol:
-		self.tf_seq = []
+		self.allocator = None
 
-		current_idx = 0
-		for well in valid_well_names:
-			unique_id = str(uuid.uuid1())
-			tf = Transfer(unique_id, dest_plate=ttw.plate_barcode, dest_well=well)
-			self.transfers[unique_id] = tf
-			self.tf_seq.append(unique_id)
-			current_idx += 1
+		# build transfer protocol: one row per available well, followed by the wells reserved for specific barcodes
+		self.plate = PlateModel(self.geometry.well_names, dest_plate=ttw.plate_barcode, protocol=self)
+		self.transfers = self.plate
+		self.tf_seq = list(self.plate.addRows(valid_well_names))
 
 		# add specified wells
-		for barcode in ttw.barcode_to_well.keys():
-			well = ttw.barcode_to_well[barcode]
-			unique_id = str(uuid.uuid1())
-			tf = Transfer(
-				unique_id,
-				dest_plate=ttw.plate_barcode,
-				dest_well=well,
-				source_tube=barcode,
-			)
-			self.transfers[unique_id] = tf
-			self.tf_seq.append(unique_id)
-			current_idx += 1
+		reserved_ids = self.plate.addRows(
+			ttw.barcode_to_well.values(), source_tubes=ttw.barcode_to_well.keys()
+		)
+		self.tf_seq.extend(reserved_ids)
+		for tf_id in reserved_ids:
+			self.reindexTransfer(self.transfers[tf_id])
+
+		# well name -> ids of the transfers into it, and reserved well -> the (first) barcode it is reserved for
+		self.well_transfers = {}
+		for tf_id in self.tf_seq:
+			self.well_transfers.setdefault(self.transfers[tf_id]["dest_well"], []).append(tf_id)
+		self.reserved_barcodes = {}
+		for barcode, well in ttw.barcode_to_well.items():
+			self.reserved_barcodes.setdefault(well, barcode)
+
+		self.lists = StatusLists(self.plate)
+		self.allocator = FreeWellAllocator(self.plate, self.tf_seq, ttw.barcode_to_well)
 
 		self._current_idx = 0
+		self.changed_transfers = {}
 		self.synchronize()
 
+	def clone(self, ttw: TubeToWell):
+		"""
+		Returns a copy of this protocol for a new plate of ttw, in the state this one is in, without
+		rebuilding it. Used to stamp out fresh protocols from the unused ones in TemplateCache.protocols.
+		The copy shares no mutable state with this protocol; the plate geometry and the compiled barcode
+		rules it still shares are never changed once built.
+		"""
+		tp = copy.copy(self)
+		tp.controls = ttw.controls
+		tp.num_wells = ttw.num_wells
+		tp.barcode_to_well = ttw.barcode_to_well
+		tp.tube_rule = ttw.barcode_rules.tube
+		tp.plate = self.plate.copy(protocol=tp, dest_plate=ttw.plate_barcode)
+		tp.transfers = tp.plate
+		tp.tf_seq = list(self.tf_seq)
+		tp.barcode_index = {barcode: dict(tf_ids) for barcode, tf_ids in self.barcode_index.items()}
+		tp._indexed_barcodes = dict(self._indexed_barcodes)
+		tp.changed_transfers = dict(self.changed_transfers)
+		tp.valid_wells = list(self.valid_wells)
+		tp.well_transfers = {well: list(tf_ids) for well, tf_ids in self.well_transfers.items()}
+		tp.reserved_barcodes = dict(self.reserved_barcodes)
+		tp.tube_index = None
+		tp.index_key = None
+		tp.resorts = 0
+		tp.lists = StatusLists(tp.plate)
+		tp.allocator = self.allocator.copy(tp.plate, tp.tf_seq, ttw.barcode_to_well)
+		tp.undo_history = ProtocolHistory(tp)
+		tp.synchronize()
+		return tp
+
+	def sortTransfers(self):
+		"""
+		Rebuilds the status buckets behind lists from scratch. The buckets are updated on every status
+		change, so nothing calls this during a run; resorts counts the calls for profiling.
+		"""
+		self.resorts += 1
+		plate = self.plate
+		plate.buckets = [{} for _ in plate.buckets]
+		for tf_id in self.tf_seq:
+			plate.buckets[plate.status_codes[tf_id]][tf_id] = None
+
 	def canUpdate(self):
 		"""
 		Checks to see that current transfer has not already been timestamped with a status.
@@ -530,7 +1360,6 @@ class TTWTransferProtocol(TransferProtocol):
 		Raises TConfirm is plate is complete
 		"""
 		self.synchronize()
-		self.sortTransfers()
 		if self.current_transfer["timestamp"] is None:
 			return True
 		else:
@@ -551,7 +1380,6 @@ class TTWTransferProtocol(TransferProtocol):
 		Moves index to the next transfer in a plate.
 		Raises TConfirm is plate is complete
 		"""
-		self.sortTransfers()
 		self.canUndo = True
 		if self.plateComplete():
 			pass
@@ -561,7 +1389,6 @@ class TTWTransferProtocol(TransferProtocol):
 	def undoCurrentScan(self, reserved: bool = False):
 		"""Cancel the current scan."""
 		self.synchronize()
-		self.sortTransfers()
 		if self._current_idx > 0:
 			if self.canUndo:
 				self.current_idx_decrement()
@@ -570,7 +1397,6 @@ class TTWTransferProtocol(TransferProtocol):
 				else:
 					self.current_transfer.resetTransfer()
 				self.canUndo = False
-				self.sortTransfers()
 				self.log(
 					"Current scan has been cancelled. A new tube can be scanned for aliquoting into this well."
 				)
@@ -584,7 +1410,6 @@ class TTWTransferProtocol(TransferProtocol):
 		then step forwards and mark the started transfer as uncomplete
 		"""
 		self.synchronize()
-		self.sortTransfers()
 		if self.canUndo:
 			self.current_idx_decrement()
 			self.current_idx_decrement()
@@ -595,7 +1420,6 @@ class TTWTransferProtocol(TransferProtocol):
 				self.current_transfer.resetTransfer()
 			else:
 				self.current_transfer.resetTransfer()
-			self.sortTransfers()
 			self.canUndo = False
 			self.log("transfer marked incomplete: %s" % self.tf_id())
 		else:
@@ -605,12 +1429,9 @@ class TTWTransferProtocol(TransferProtocol):
 	def isWellUsed(self, well_name: str):
 		"""Checks to see if a well has already been used."""
 
-		for unique_id in self.tf_seq:
-			transfer = self.transfers[unique_id]
-			well = transfer["dest_well"]
-			if well == well_name:
-				if transfer.status is TStatus.completed:
-					return True
+		for unique_id in self.transfersInWell(well_name):
+			if self.transfers[unique_id].status is TStatus.completed:
+				return True
 
 		return False
 
@@ -621,27 +1442,37 @@ class TTWTransferProtocol(TransferProtocol):
 		and free up the test tube barcode so that it may be aliquoted into another well.
 		"""
 
-		for tf_id in self.tf_seq:
+		for tf_id in self.transfersInWell(well_name):
 			transfer = self.transfers[tf_id]
-			well = transfer["dest_well"]
-			if well == well_name:
-				self.discarded_well_barcode = transfer["source_tube"]
-				transfer.updateStatus(TStatus.discarded)
-		self.sortTransfers()
+			self.discarded_well_barcode = transfer["source_tube"]
+			transfer.updateStatus(TStatus.discarded)
+
+	def transfersInWell(self, well_name: str):
+		"""Returns the ids of the transfers into a well, in sequence order."""
+		tf_ids = self.well_transfers.get(well_name, ())
+		if len(tf_ids) > 1:
+			# only possible when a template reserves one well for several barcodes
+			tf_ids = [tf_id for tf_id in self.tf_seq if tf_id in tf_ids]
+		return tf_ids
+
+	def isAvailableWell(self, well_name: str):
+		"""Checks whether a well is one of the wells filled in sequence (not a control or reserved well)."""
+		return well_name in self.well_transfers and well_name not in self.reserved_barcodes
+
+	def reservedBarcode(self, well_name: str):
+		"""Returns the barcode a well is reserved for in the template, or None."""
+		return self.reserved_barcodes.get(well_name)
 
 	def skipNextWell(self):
 		"""Skip the next well and mark it as empty."""
 		self.next(EMPTY_FLAG)
 
 	def plateComplete(self):
-		""" """
+		"""Checks whether every transfer has been used, from the count of uncompleted transfers."""
 		self.synchronize()
-		self.sortTransfers()
-		for unique_id in self.tf_seq:
-			if self.transfers[unique_id].status == TStatus.uncompleted:
-				return False
-		return True
+		return self.plate.countWithStatus(TStatus.uncompleted) == 0
 
+	@instrument("TTWTransferProtocol.next")
 	def next(self, barcode):
 		"""
 		Marks the current transfer as complete if started and the next transfer as started is uncomplete
@@ -672,7 +1503,6 @@ class TTWTransferProtocol(TransferProtocol):
 						if not previous_transfer.status == TStatus.discarded:
 							previous_transfer.updateStatus(TStatus.completed)
 
-					self.sortTransfers()
 					self.log("transfer started: %s" % self.tf_id())
 					self.lightup_well = None
 					self.step()
@@ -684,16 +1514,14 @@ class TTWTransferProtocol(TransferProtocol):
 						if not previous_transfer.status == TStatus.discarded:
 							previous_transfer.updateStatus(TStatus.completed)
 
-					self.sortTransfers()
 					tf = self.findTransferByBarcode(barcode)
 					self.log("Tube already scanned into well %s" % tf["dest_well"])
 					self.lightup_well = tf["dest_well"]
 					raise TError(self.msg)
 			else:
-				self.log("%s is not a valid barcode" % barcode)
+				self.log("%s is not a valid barcode: %s" % (barcode, self.tube_rule.explain(barcode)))
 				raise TError(self.msg)
 
-		self.sortTransfers()
 
 	def complete(self, barcode):
 		"""
@@ -702,7 +1530,6 @@ class TTWTransferProtocol(TransferProtocol):
 		raises TConfirm if the plate is already complete
 		"""
 		self.synchronize()
-		self.sortTransfers()
 		if self.plateComplete():
 			self.log("Plate is complete, press reset to start a new plate")
 			raise TConfirm(self.msg)
@@ -718,29 +1545,164 @@ class TTWTransferProtocol(TransferProtocol):
 					self.log("Tube already scanned into well %s" % tf["dest_well"])
 					raise TError(self.msg)
 			else:
-				self.log("%s is not a valid barcode" % barcode)
+				self.log("%s is not a valid barcode: %s" % (barcode, self.tube_rule.explain(barcode)))
 				raise TError(self.msg)
 
-	def uniqueBarcode(self, barcode):
-		print(barcode)
+	def assignBatch(self, barcodes, scan_out=False):
+		"""
+		Places a batch of tubes already checked by TubeToWell.validateBatch, one after the other exactly as
+		next would: a tube reserved by the template into its reserved well, any other tube into the next
+		free well. With scan_out every tube is completed straight away, as if scanned out again. Returns
+		the wells the tubes went into, in batch order.
+		"""
+		plate = self.plate
+		wells = []
+		touched = {}
+		# the barcode, allocator and cross-plate indexes are updated once per transfer at the end instead of
+		# on every change; within a batch every tube is different, so nothing below reads a stale entry
+		plate.protocol = None
+		try:
+			for barcode in barcodes:
+				tf_id = None
+				if barcode in self.barcode_to_well:
+					for reserved_id, status in self.transfersWithBarcode(barcode).items():
+						if status != "discarded":
+							tf_id = reserved_id
+							break
+				if tf_id is None:
+					tf_id = self.allocator.nextFree()
+				self.moveToCurrent(tf_id)
+				self.synchronize()
+				transfer = self.current_transfer
+				transfer["source_tube"] = barcode
+				transfer.updateStatus(TStatus.started)
+				touched[tf_id] = None
+				if self._current_idx > 0:
+					previous_id = self.tf_seq[self._current_idx - 1]
+					previous_transfer = self.transfers[previous_id]
+					if not previous_transfer.status == TStatus.discarded:
+						previous_transfer.updateStatus(TStatus.completed)
+						touched[previous_id] = None
+				self.step()
+				if scan_out:
+					transfer.updateStatus(TStatus.completed)
+				wells.append(transfer["dest_well"])
+		finally:
+			plate.protocol = self
+			for tf_id in touched:
+				self.reindexTransfer(self.transfers[tf_id])
+		self.lightup_well = None
+		self.log("%s transfers started" % len(wells))
+		return wells
+
+	def reindexTransfer(self, tf):
+		"""Updates the barcode index entry for a single transfer after its source tube or status changed."""
+		old_barcode = self._indexed_barcodes.pop(tf.id, None)
+		if old_barcode is not None:
+			bucket = self.barcode_index[old_barcode]
+			del bucket[tf.id]
+			if not bucket:
+				del self.barcode_index[old_barcode]
+
+		barcode = tf["source_tube"]
+		if barcode is not None:
+			self.barcode_index.setdefault(barcode, {})[tf.id] = tf["status"]
+			self._indexed_barcodes[tf.id] = barcode
+
+		self.changed_transfers[tf.id] = None
+		if self.allocator is not None:
+			self.allocator.update(tf.id)
+		if self.tube_index is not None:
+			self.tube_index.refresh(self, *{old_barcode, barcode})
+
+	def moveToCurrent(self, tf_id):
+		"""Moves a transfer to the current position in the sequence, so that it is filled by the next scan."""
+		current = self._current_idx
+		if current > 0 and self.tf_seq[current - 1] == tf_id:
+			# the transfer just before the current one stays where it is
+			return
+		if self.plate.undo_history is not None:
+			try:
+				i = self.allocator.position(tf_id, current)
+			except ValueError:
+				i = self.tf_seq.index(tf_id)
+			self.plate.undo_history.noteSeq(min(i, current), max(i, current) + 1)
+		try:
+			self.allocator.moveToPosition(tf_id, current)
+		except ValueError:
+			# a transfer from earlier in the sequence (e.g. one marked skipped), moved the way it always has been
+			i = self.tf_seq.index(tf_id)
+			self.tf_seq.insert(current, tf_id)
+			self.tf_seq.pop(i + 1)
+			self.allocator.renumber()
+
+	def popChangedTransfers(self):
+		"""Returns the ids of transfers changed since the last call, in order of first change."""
+		changed = list(self.changed_transfers)
+		self.changed_transfers = {}
+		return changed
+
+	def orderedTransfers(self):
+		"""Yields transfers in sequence order"""
 		for tf_id in self.tf_seq:
-			tf = self.transfers[tf_id]
-			if barcode in self.barcode_to_well.keys():
-				if barcode == tf["source_tube"] and tf["status"] in [
-					"started",
-					"completed",
-				]:
-					return False
-			elif barcode == tf["source_tube"] and tf["status"] != "discarded":
-				return False
-		return True
+			yield self.transfers[tf_id]
 
-	def findTransferByBarcode(self, barcode):
+	def transfersWithBarcode(self, barcode):
+		"""Returns a {transfer id: status} dict of every transfer holding this tube barcode."""
+		return self.barcode_index.get(barcode, {})
+
+	def checkInvariants(self):
+		"""
+		Rebuilds the lookup indexes from scratch and compares them against the live ones.
+		Raises AssertionError describing the first mismatch found
+		"""
+		expected = {}
+		for tf_id, tf in self.transfers.items():
+			if tf["source_tube"] is not None:
+				expected.setdefault(tf["source_tube"], {})[tf_id] = tf["status"]
+		if expected != self.barcode_index:
+			raise AssertionError(
+				"Barcode index out of sync: expected %s, found %s" % (expected, self.barcode_index)
+			)
+		expected_free = None
 		for tf_id in self.tf_seq:
 			tf = self.transfers[tf_id]
-			if barcode == tf["source_tube"] and tf["status"] != "discarded":
-				return tf
-		return None
+			if tf["source_tube"] not in self.barcode_to_well and tf["status"] not in ["started", "completed", "discarded"]:
+				expected_free = tf_id
+				break
+		if expected_free != self.allocator.nextFree():
+			raise AssertionError(
+				"Free well allocator out of sync: expected %s, found %s" % (expected_free, self.allocator.nextFree())
+			)
+		keys = [self.allocator.keys[tf_id] for tf_id in self.tf_seq]
+		if any(before >= after for before, after in zip(keys, keys[1:])):
+			raise AssertionError("Free well allocator order keys do not follow tf_seq: %s" % keys)
+		for status in TStatus:
+			expected_ids = {tf_id for tf_id in self.tf_seq if self.transfers[tf_id].status is status}
+			if expected_ids != set(self.lists[status.value]):
+				raise AssertionError(
+					"%s transfers out of sync: expected %s, found %s"
+					% (status.value, sorted(expected_ids), self.lists[status.value])
+				)
+
+	def uniqueBarcode(self, barcode):
+		statuses = self.transfersWithBarcode(barcode).values()
+		if barcode in self.barcode_to_well.keys():
+			return not any(status in ["started", "completed"] for status in statuses)
+		return all(status == "discarded" for status in statuses)
+
+	def findTransferByBarcode(self, barcode):
+		candidates = [
+			tf_id
+			for tf_id, status in self.transfersWithBarcode(barcode).items()
+			if status != "discarded"
+		]
+		if not candidates:
+			return None
+		if len(candidates) > 1:
+			# keep the original behaviour of returning the earliest match in the sequence
+			candidates = [tf_id for tf_id in self.tf_seq if tf_id in candidates]
+		return self.transfers[candidates[0]]
 
 	def isTube(self, check_input):
-		return True
+		return check_input == EMPTY_FLAG or self.tube_rule.accepts(check_input)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Headless driver for TubeToWell.
+
+Reads barcodes and control commands, one per line, from a file or stdin and runs them through the same
+TubeToWell calls the GUI makes, printing the outcome and duration of every operation. Useful for
+scripted runs, reproducing bug reports and load testing the scan loop without a display.
+
+Run from the repository folder (like TubeToWellGUI.py, the default configuration is read from configs/):
+
+	python TubeToWellCLI.py --config configs/CONFIG2.json --template templates/example_template.csv scans.txt
+	type scans.txt | python TubeToWellCLI.py -
+	python TubeToWellCLI.py --resume records/<record name>.session more_scans.txt
+	python TubeToWellCLI.py --scanner tcp:5555 --scanner device:/dev/ttyACM0
+
+With --scanner the lines are read from scanner sources instead (see ScannerInput.py), until they end
+or Ctrl-C.
+
+Input lines:
+	<barcode>           scan a tube (or scan it out again when scan out is enabled)
+	!undo               undo the last tube ("Undo Last Tube")
+	!undo-scan          cancel the current scan ("Cancel Current Scan")
+	!skip               skip the next well and mark it empty
+	!discard <well>     discard a specific well
+	!discard-last       discard the last well
+	!finish             finish the active plate: write its final record and switch to the last plate started
+	!plate <barcode>    start a new plate, alongside any plates still in progress
+	!switch <barcode>   switch to another plate in progress
+	!rack <csv>         place every tube of a rack scan csv at once (see TubeToWell.preassignBatch)
+	!step               light up the well of the next tube of the last rack
+	!rollback [n]       take back the last n actions, 1 by default (see TubeToWell.undoSteps)
+	!redo [n]           make the last n actions taken back again
+	# ...               comment
+"""
+
+import argparse, asyncio, os, sys, time
+from WellLit.Transfer import TError, TConfirm
+from TubeToWell import TubeToWell
+from PlateSessions import PlateSessionManager
+from Metrics import METRICS
+from ScannerInput import ScannerInput
+
+COMMAND_PREFIX = "!"
+
+
+class OperationTimer:
+	"""Collects the duration of every call per operation name."""
+
+	def __init__(self):
+		self.durations = {}
+
+	def record(self, operation, seconds):
+		self.durations.setdefault(operation, []).append(seconds)
+
+	def wrap(self, operation, func):
+		"""Returns func wrapped so every call is recorded under operation."""
+
+		def timed(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.record(operation, time.perf_counter() - start)
+
+		return timed
+
+	def percentile(self, operation, fraction):
+		"""Nearest-rank percentile of an operation's durations, in seconds."""
+		durations = sorted(self.durations.get(operation, []))
+		if not durations:
+			return 0.0
+		rank = max(0, min(len(durations) - 1, int(round(fraction * len(durations))) - 1))
+		return durations[rank]
+
+	def summary(self):
+		"""Returns a table of count, total, p50 and p99 per operation."""
+		lines = [
+			"{:<28}{:>8}{:>12}{:>12}{:>12}".format("operation", "count", "total (ms)", "p50 (ms)", "p99 (ms)")
+		]
+		for operation, durations in sorted(self.durations.items()):
+			lines.append(
+				"{:<28}{:>8}{:>12.2f}{:>12.3f}{:>12.3f}".format(
+					operation,
+					len(durations),
+					sum(durations) * 1000,
+					self.percentile(operation, 0.5) * 1000,
+					self.percentile(operation, 0.99) * 1000,
+				)
+			)
+		return "\n".join(lines)
+
+
+class ScanDriver:
+	"""
+	Runs scans and control commands through TubeToWell the same way TubeToWellWidget does, catching
+	TError/TConfirm where the GUI would show a popup.
+	"""
+
+	def __init__(self, ttw: TubeToWell, user="", timer=None):
+		self.ttw = ttw
+		self.user = user
+		self.timer = timer if timer is not None else OperationTimer()
+		self.plates = PlateSessionManager(ttw)
+		# time the record writes made from inside TubeToWell as well
+		self.ttw.writeTransferRecordFiles = self.timer.wrap(
+			"writeTransferRecordFiles", self.ttw.writeTransferRecordFiles
+		)
+
+	def startPlate(self, plate_barcode):
+		if not self.ttw.isPlate(plate_barcode):
+			raise TError(self.ttw.msg)
+		self.plates.startPlate(plate_barcode, self.user)
+		return "Started plate %s" % plate_barcode
+
+	def resumePlate(self, path):
+		self.plates.resumePlate(path)
+		return self.ttw.msg
+
+	def switchPlate(self, plate_barcode):
+		self.plates.switchPlate(plate_barcode)
+		return "Switched to plate %s" % plate_barcode
+
+	def next(self, barcode):
+		try:
+			self.ttw.next(barcode)
+		except TConfirm:
+			self.ttw.compactTransferRecordFiles()
+			raise
+		well = "COMPLETED"
+		for tf_id in self.ttw.tp.lists["started"]:
+			well = self.ttw.tp.transfers[tf_id]["dest_well"]
+		return "%s -> %s" % (barcode, well)
+
+	def undo(self):
+		self.ttw.undo()
+		return "Previous tube un-scanned"
+
+	def undoCurrentScan(self):
+		self.ttw.undoCurrentScan()
+		return "Current scan cancelled"
+
+	def skip(self):
+		self.ttw.skipNextWell()
+		return "Skipped next well"
+
+	def discard(self, well):
+		well = well.upper()
+		if self.ttw.tp.isAvailableWell(well):
+			if not self.ttw.tp.isWellUsed(well):
+				raise TError("This well hasn't been used yet! Nothing to discard.")
+		elif self.ttw.tp.reservedBarcode(well) is None:
+			raise TError("Invalid well name entered.")
+		self.ttw.discardSpecificWell(well)
+		return "Discarded well %s (barcode %s)" % (well, self.ttw.tp.discarded_well_barcode)
+
+	def discardLast(self):
+		if self.ttw.tp._current_idx > 1:
+			prev_id = self.ttw.tp.tf_seq[self.ttw.tp._current_idx - 2]
+			return self.discard(self.ttw.tp.transfers[prev_id]["dest_well"])
+		raise TError("No previous well to discard")
+
+	def rack(self, filename):
+		placed = self.ttw.loadRackCSV(filename)
+		return "Placed %s tubes: %s" % (len(placed), " ".join("%s->%s" % pair for pair in placed))
+
+	def step(self):
+		step = self.ttw.stepBatch()
+		if step is None:
+			return "No more tubes in the rack"
+		return "%s -> %s" % step
+
+	def rollback(self, count):
+		undone = self.ttw.undoSteps(self.stepCount(count))
+		return "Took back %s action%s" % (undone, "" if undone == 1 else "s")
+
+	def redo(self, count):
+		redone = self.ttw.redoSteps(self.stepCount(count))
+		return "Redid %s action%s" % (redone, "" if redone == 1 else "s")
+
+	def stepCount(self, count):
+		if not count:
+			return 1
+		if not count.isdigit() or int(count) < 1:
+			raise TError("Invalid number of actions: %s" % count)
+		return int(count)
+
+	def finish(self):
+		active = self.plates.finishPlate()
+		if active is not None:
+			return "Plate finished, switched to plate %s" % active
+		return "Plate finished"
+
+	def execute(self, line):
+		"""
+		Runs one input line. Returns (operation, argument, result, message, seconds) or None for blank
+		lines and comments; result is "ok", "error" (TError) or "confirm" (TConfirm).
+		"""
+		line = line.strip()
+		if not line or line.startswith("#"):
+			return None
+
+		if line.startswith(COMMAND_PREFIX):
+			command, _, argument = line[len(COMMAND_PREFIX) :].partition(" ")
+			argument = argument.strip()
+			operations = {
+				"undo": ("undo", lambda: self.undo()),
+				"undo-scan": ("undoCurrentScan", lambda: self.undoCurrentScan()),
+				"skip": ("skip", lambda: self.skip()),
+				"discard": ("discard", lambda: self.discard(argument)),
+				"discard-last": ("discardLast", lambda: self.discardLast()),
+				"finish": ("finish", lambda: self.finish()),
+				"plate": ("plate", lambda: self.startPlate(argument)),
+				"switch": ("switch", lambda: self.switchPlate(argument)),
+				"rack": ("rack", lambda: self.rack(argument)),
+				"step": ("step", lambda: self.step()),
+				"rollback": ("rollback", lambda: self.rollback(argument)),
+				"redo": ("redo", lambda: self.redo(argument)),
+			}
+			if command not in operations:
+				return (command, argument, "error", "Unknown command %s" % line, 0.0)
+			operation, func = operations[command]
+		else:
+			operation, argument = "next", line
+			func = lambda: self.next(argument)
+
+		start = time.perf_counter()
+		try:
+			message, result = func(), "ok"
+		except TError as err:
+			message, result = str(err), "error"
+		except TConfirm as conf:
+			message, result = str(conf), "confirm"
+		seconds = time.perf_counter() - start
+		self.timer.record(operation, seconds)
+		return (operation, argument, result, message, seconds)
+
+
+def build_ttw(config=None, template=None, samples=None, records_dir=None):
+	"""Creates a TubeToWell set up the way the GUI sets it up from its file dialogs."""
+	ttw = TubeToWell()
+	if config:
+		ttw.setConfigurationFile(config)
+	if records_dir:
+		os.makedirs(records_dir, exist_ok=True)
+		ttw.records_dir = os.path.join(records_dir, "")
+	if template:
+		ttw.loadWellConfigurationCSV(template)
+	if samples:
+		try:
+			ttw.loadCSV(samples)
+		except TConfirm as conf:
+			print(conf, file=sys.stderr)
+	return ttw
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("input", nargs="?", default="-", help="file of barcodes and commands, or - for stdin")
+	parser.add_argument("--config", help="configuration json (default: configs/DEFAULT_CONFIG.json)")
+	parser.add_argument("--template", help="well template csv")
+	parser.add_argument("--samples", help="sample list csv")
+	parser.add_argument("--records-dir", help="write records here instead of the configured records_dir")
+	parser.add_argument("--user", default="cli", help="user name written to the records")
+	parser.add_argument("--plate", default="CLI", help="barcode of the first plate")
+	parser.add_argument(
+		"--resume",
+		metavar="SESSION",
+		action="append",
+		help="resume an unfinished plate from its .session journal (repeat for several plates)",
+	)
+	parser.add_argument(
+		"--scanner",
+		metavar="SOURCE",
+		action="append",
+		help="read lines from a scanner source instead of the input: tcp:PORT, unix:PATH, device:PATH[@BAUD] "
+		"or stdin (repeat for several)",
+	)
+	parser.add_argument("--quiet", action="store_true", help="only print the timing summary")
+	parser.add_argument("--metrics-file", help="append per-operation metrics to this JSON-lines file (see Metrics.py)")
+	parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+	args = parser.parse_args(argv)
+
+	try:
+		ttw = build_ttw(args.config, args.template, args.samples, args.records_dir)
+	except TError as err:
+		print("Setup failed: %s" % err, file=sys.stderr)
+		return 2
+
+	if args.metrics_file or args.metrics_port:
+		try:
+			METRICS.configure(args.metrics_file, args.metrics_port)
+		except (OSError, ValueError) as err:
+			print("Setup failed: cannot enable metrics: %s" % err, file=sys.stderr)
+			return 2
+
+	driver = ScanDriver(ttw, user=args.user)
+	if args.resume:
+		for path in args.resume:
+			try:
+				print(driver.resumePlate(path))
+			except TError as err:
+				print("Resume failed: %s" % err, file=sys.stderr)
+				return 2
+	else:
+		try:
+			driver.startPlate(args.plate)
+		except TError as err:
+			print("Setup failed: %s" % err, file=sys.stderr)
+			return 2
+
+	errors = 0
+
+	# scanner input runs the lines on its delivery thread, one at a time
+	def run(line):
+		nonlocal errors
+		outcome = driver.execute(line)
+		if outcome is None:
+			return
+		operation, argument, result, message, seconds = outcome
+		errors += result == "error"
+		if not args.quiet:
+			print(
+				"{:<16}{:<20}{:<9}{:>9.3f} ms  {}".format(
+					operation, argument, result, seconds * 1000, message.replace("\n", " ")
+				)
+			)
+
+	if args.scanner:
+		try:
+			scanner_input = ScannerInput(lambda scan: run(scan.barcode), args.scanner)
+		except ValueError as err:
+			print("Setup failed: %s" % err, file=sys.stderr)
+			return 2
+		try:
+			asyncio.run(scanner_input.run())
+		except KeyboardInterrupt:
+			pass
+		finally:
+			ttw.record_writer.flush()
+	else:
+		stream = sys.stdin if args.input == "-" else open(args.input)
+		try:
+			for line in stream:
+				run(line)
+		finally:
+			if stream is not sys.stdin:
+				stream.close()
+			ttw.record_writer.flush()
+
+	print(driver.timer.summary())
+	return 1 if errors else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
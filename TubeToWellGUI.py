@@ -2,10 +2,15 @@
 # Joana Cabrera
 # 3/15/2020
 
-import kivy, os
+import os, threading, time
+
+_import_start = time.perf_counter()
+
+import kivy
 
 kivy.require("1.11.1")
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.gridlayout import GridLayout
@@ -16,7 +21,13 @@ from kivy.properties import StringProperty
 from kivy.properties import ObjectProperty, StringProperty
 from WellLit.WellLitGUI import WellLitWidget, WellLitPopup, ConfirmPopup
 from WellLit.Transfer import TError, TConfirm
-from TubeToWell import TubeToWell
+from TubeToWell import TubeToWell, recordStartupTime, printStartupProfile
+from IncrementalLighting import IncrementalLighting
+from SessionJournal import read_session_header
+from Metrics import instrument
+from ScannerInput import ScannerInput
+
+recordStartupTime("import TubeToWellGUI (kivy, WellLit GUI, TubeToWell)", _import_start)
 
 
 def on_focus(instance, value):
@@ -29,11 +40,19 @@ def on_focus(instance, value):
 
 class TubeToWellApp(App):
 	def build(self):
+		start = time.perf_counter()
 		self.t = TubeToWellWidget()
+		recordStartupTime("TubeToWellApp.build", start)
 		return self.t
 
 	def on_start(self):
 		self.t.showChooseConfigFile()
+		printStartupProfile()
+
+	def on_stop(self):
+		if self.t.scanner_input is not None:
+			# the delivery thread may be waiting for this (Kivy) thread
+			self.t.scanner_input.stop(wait=False)
 
 class LoadDialog(FloatLayout):
 	load = ObjectProperty(None)
@@ -69,8 +88,12 @@ class TubeToWellWidget(WellLitWidget):
 		self.filename = None
 		self.save_directory = None
 		self.template_file = None
+		self.rack_file = None
+		self.lighting = None
+		self.resume_path = None
 		self.user = ""
 		self.initialized = False
+		self.scanner_input = None
 
 	def _on_keyboard_up(self, keyboard, keycode, text, modifiers):
 		if keycode[1] == "esc":
@@ -79,9 +102,14 @@ class TubeToWellWidget(WellLitWidget):
 			)
 
 	def quit_button(self):
-		self.ttw.writeTransferRecordFiles()
 		self.showPopup("Are you sure you want to exit?", "Confirm exit", func=self.quit)
 
+	def quit(self, *args):
+		"""Exits once the user confirmed, after the queued record writes are on disk and the record is compacted."""
+		self.ttw.record_writer.flush()
+		self.ttw.compactTransferRecordFiles()
+		super(TubeToWellWidget, self).quit(*args)
+
 	def chooseFileDialog(self, load_file_func, cancel_func, dir_path, popup_title):
 		content = LoadDialog(
 			load=load_file_func, cancel=cancel_func, load_path=dir_path
@@ -149,6 +177,42 @@ class TubeToWellWidget(WellLitWidget):
 			except TConfirm as conf:
 				self.showPopup(conf, "Load Successful")
 
+	def showChooseRackFile(self):
+		self.chooseFileDialog(self._chooseRackFile, self.dismiss_popup, self.load_path, popup_title="Choose rack scan file")
+
+	def _chooseRackFile(self, filename):
+		self.dismiss_popup()
+		self.rack_file = filename
+		self.showPopup(
+			TConfirm(
+				"Every tube in the rack scan will be assigned a well now, in fill order. "
+				"Press Enter with an empty tube barcode to light up the wells one at a time. Are you sure?"
+			),
+			"Confirm rack scan load",
+			func=self._loadRackFile,
+		)
+
+	def _loadRackFile(self, _):
+		if not self.rack_file:
+			self.showPopup(TError("Invalid target to load"), "Unable to load file")
+			return
+		try:
+			placed = self.ttw.loadRackCSV(self.rack_file[0])
+			self.updateLights()
+			self.ids.status.text = f"Rack placed:\n{len(placed)} tubes"
+		except TError as err:
+			self.showPopup(err, "Load Failed")
+
+	def stepBatch(self):
+		"""Lights up the well of the next tube of the last rack scan."""
+		step = self.ttw.stepBatch()
+		self.updateLights()
+		if step is None:
+			self.ids.status.text = "Rack done"
+		else:
+			self.ids.tube_barcode.text = step[0]
+			self.ids.status.text = f"Rack tube {self.ttw.batch_position}/{len(self.ttw.batch)}:\n{step[0]} -> {step[1]}"
+
 	def showChooseConfigFile(self):
 		self.chooseFileDialog(self._chooseConfigFile, self.loadDefaultConfig, self.configs_path, popup_title="Choose configuration file")
 
@@ -176,6 +240,9 @@ class TubeToWellWidget(WellLitWidget):
 					self.ttw.setConfigurationFile(filename)
 					self.ids.dest_plate.initialize(filename)
 					self.initialized = True
+					self.ttw.watchConfiguration()
+					self.startScannerInput()
+					self.offerResume()
 			except TError as err:
 				self.showPopup(err, "Load Failed")
 			except TConfirm as conf:
@@ -186,7 +253,81 @@ class TubeToWellWidget(WellLitWidget):
 		config_path = os.path.join(cwd, "configs", "DEFAULT_CONFIG.json")
 		self.ttw.setConfigurationFile(config_path)
 		self.ids.dest_plate.initialize(config_path)
+		self.ttw.watchConfiguration()
+		self.startScannerInput()
 		self.dismiss_popup()
+		self.offerResume()
+
+	def startScannerInput(self):
+		"""
+		Starts reading scans from the "scanner_input" sources of the configuration (see ScannerInput.py), if
+		it has any. They are read when the first configuration is loaded; changing them needs a restart.
+		"""
+		if self.scanner_input is not None or not self.ttw.config.scanner_input:
+			return
+		try:
+			self.scanner_input = ScannerInput(self.enterScan, self.ttw.config.scanner_input).start()
+		except (OSError, ImportError, ValueError) as err:
+			sources = ", ".join(self.ttw.config.scanner_input)
+			self.showPopup(TError("Unable to read scans from %s: %s" % (sources, err)), "Scanner input")
+
+	def enterScan(self, scan):
+		"""
+		Called on the scanner input's delivery thread for every scan: enters it on the Kivy thread as if it
+		had been typed into the textbox, and returns once it has been handled, so the next scan waits.
+		"""
+		handled = threading.Event()
+
+		def enter(_):
+			try:
+				self.ids.textbox.text = scan.barcode
+				self.ids.textbox.dispatch("on_text_validate")
+			finally:
+				handled.set()
+
+		Clock.schedule_once(enter)
+		handled.wait()
+
+	def offerResume(self):
+		"""Offers to resume the most recent unfinished plate left in the records directory (e.g. after a crash)."""
+		self.ttw.compactLeftoverJournals()
+		self.resume_path = self.ttw.findResumableSession()
+		if self.resume_path is None:
+			return
+		header = read_session_header(self.resume_path)
+		self.showPopup(
+			TConfirm(
+				f"Plate {header['plate_barcode']} (started {header['timestamp']} by {header['user']}) was not finished."
+				" Do you want to resume it?"
+			),
+			"Resume plate",
+			func=self.resumePlate,
+		)
+
+	def resumePlate(self, _):
+		try:
+			self.ttw.resumeSession(self.resume_path)
+		except TError as err:
+			self.showPopup(err, "Unable to resume plate")
+			return
+		self.resume_path = None
+		self.user = self.ttw.user
+		self.plate_barcode = self.ttw.plate_barcode
+		self.ids.user.text = self.user
+		self.ids.plate_barcode.text = self.plate_barcode
+		self.txt_file_path = os.path.join(self.ttw.csv + "_FINISHED.txt")
+		self.confirm_popup = ConfirmPopup(self.txt_file_path)
+
+		# skip the user and plate barcode scans and go straight to scanning tubes
+		self.ids.textbox.funbind("on_text_validate", self.scanUser)
+		self.ids.textbox.funbind("on_text_validate", self.scanPlate)
+		self.ids.textbox.bind(on_text_validate=self.next)
+		self.ids.textbox.text = ""
+		self.ids.status.text = "Please scan tube"
+		self.scanMode = True
+		if self.lighting is not None:
+			self.lighting.invalidate()
+		self.updateLights()
 
 	def showChooseSaveDirectory(self):
 		content = ChooseSaveDirDialog(
@@ -228,43 +369,23 @@ class TubeToWellWidget(WellLitWidget):
 				"Unable to set save directory",
 			)
 
+	@instrument("updateLights")
 	def updateLights(self):
 		"""
 		For tube to well applications, scanning a barcode will light up the well it should be pipetted into.
 		Internally that transfer is already marked as complete, and can be undone by the user.
 		Therefore the well being lit up is actually the previous transfer, i.e the one just completed.
 		"""
-		if self.ids.dest_plate.pl is not None:
+		pl = self.ids.dest_plate.pl
+		if pl is not None:
+			if self.lighting is None or self.lighting.pl is not pl:
+				self.lighting = IncrementalLighting(pl)
 			if self.ttw.tp_present():
-				# reset all wells for each refresh
-				self.ids.dest_plate.pl.emptyWells()
-
-				# mark completed wells as filled
-				for tf_id in self.ttw.tp.lists["completed"]:
-					self.ids.dest_plate.pl.markFilled(
-						self.ttw.tp.transfers[tf_id]["dest_well"]
-					)
-
-				# mark current in-progress transfer as the target
-				for tf_id in self.ttw.tp.lists["started"]:
-					self.ids.dest_plate.pl.markTarget(
-						self.ttw.tp.transfers[tf_id]["dest_well"]
-					)
-				# mark discarded wells as discarded
-				for tf_id in self.ttw.tp.lists["discarded"]:
-					self.ids.dest_plate.pl.markDiscarded(
-						self.ttw.tp.transfers[tf_id]["dest_well"]
-					)
-
-				# mark the control wells
-				for control_well in self.ttw.controls:
-					self.ids.dest_plate.pl.markControl(control_well)
-
-				if self.ttw.tp.lightup_well is not None:
-					self.ids.dest_plate.pl.markRescan(self.ttw.tp.lightup_well)
-
-			# update and show plot
-			self.ids.dest_plate.pl.show()
+				# only the wells whose state changed since the last refresh are redrawn
+				self.lighting.update(self.ttw)
+			else:
+				self.lighting.invalidate()
+				pl.show()
 
 	def showPopup(self, error, title: str, func=None):
 		self._popup = WellLitPopup()
@@ -291,8 +412,10 @@ class TubeToWellWidget(WellLitWidget):
 		self.ids.tube_barcode.text = barcode
 		self.ids.textbox.text = ""
 
-		# Ensure a blank barcode can't be used
+		# Ensure a blank barcode can't be used; after a rack scan it steps to the next tube of the rack
 		if barcode == "":
+			if self.ttw.batch:
+				self.stepBatch()
 			return
 
 		try:
@@ -307,7 +430,7 @@ class TubeToWellWidget(WellLitWidget):
 			self.status = self.ttw.msg
 			self.updateLights()
 		except TConfirm as conf:
-			self.ttw.writeTransferRecordFiles()
+			self.ttw.compactTransferRecordFiles()
 			self.showPopup(conf, "Plate complete")
 			self.status = self.ttw.msg
 			self.updateLights()
@@ -345,6 +468,28 @@ class TubeToWellWidget(WellLitWidget):
 			self.showPopup(err, "Unable to undo")
 			self.status = self.ttw.msg
 
+	def undoAction(self):
+		"""Takes back the last action on the plate, whatever it was (see TubeToWell.undoSteps)."""
+		try:
+			self.ttw.undoSteps()
+			self.updateLights()
+			self.status = self.ttw.msg
+			self.ids.status.text = self.ttw.msg
+		except TError as err:
+			self.showPopup(err, "Unable to undo")
+			self.status = self.ttw.msg
+
+	def redoAction(self):
+		"""Makes the last action taken back by undoAction again."""
+		try:
+			self.ttw.redoSteps()
+			self.updateLights()
+			self.status = self.ttw.msg
+			self.ids.status.text = self.ttw.msg
+		except TError as err:
+			self.showPopup(err, "Unable to redo")
+			self.status = self.ttw.msg
+
 	def discardLastWell(self):
 		if self.ttw.tp._current_idx > 1:
 			prev_id = self.ttw.tp.tf_seq[self.ttw.tp._current_idx - 2]
@@ -357,7 +502,7 @@ class TubeToWellWidget(WellLitWidget):
 
 	def discardWellConfirmation(self):
 		text = self.ids.textbox.text.upper()
-		is_well = text in self.ttw.tp.valid_wells
+		is_well = self.ttw.tp.isAvailableWell(text)
 		if is_well:
 			if self.ttw.tp.isWellUsed(text):
 				self.showPopup(
@@ -369,10 +514,8 @@ class TubeToWellWidget(WellLitWidget):
 				self.showPopup(
 					"This well hasn't been used yet! Nothing to discard.", "Invaid well"
 				)
-		elif text in self.ttw.barcode_to_well.values():
-			barcode = list(self.ttw.barcode_to_well.keys())[
-				list(self.ttw.barcode_to_well.values()).index(text)
-			]
+		elif self.ttw.tp.reservedBarcode(text) is not None:
+			barcode = self.ttw.tp.reservedBarcode(text)
 			self.showPopup(
 				f"Well {text} was specifically reserved for barcode {barcode} in the loaded template file. Are you sure you want to discard this well?",
 				"Reserved well",
@@ -383,8 +526,7 @@ class TubeToWellWidget(WellLitWidget):
 
 	def discardSpecificWell(self, _):
 		text = self.ids.textbox.text.upper()
-		self.ttw.tp.discardSpecificWell(text)
-		self.ttw.writeTransferRecordFiles()
+		self.ttw.discardSpecificWell(text)
 		self.ids.textbox.text = ""
 		self.updateLights()
 		self.showPopup(
@@ -421,8 +563,7 @@ class TubeToWellWidget(WellLitWidget):
 		)
 
 	def skipWell(self, _):
-		self.ttw.tp.skipNextWell()
-		self.ttw.writeTransferRecordFiles()
+		self.ttw.skipNextWell()
 		self.ids.textbox.text = ""
 		self.updateLights()
 
@@ -434,8 +575,8 @@ class TubeToWellWidget(WellLitWidget):
 		)
 
 	def resetAll(self, button):
-		# Flush the data
-		self.ttw.writeTransferRecordFiles()
+		# Flush the data and compact the record journal into the final record csv
+		self.ttw.compactTransferRecordFiles()
 
 		# restart metadata collection
 		self.ids.textbox.funbind("on_text_validate", self.next)
@@ -451,13 +592,19 @@ class TubeToWellWidget(WellLitWidget):
 
 		if self.ids.dest_plate.pl is not None:
 			self.ids.dest_plate.pl.emptyWells()
+		if self.lighting is not None:
+			self.lighting.invalidate()
 
+		displayed = self.ttw.config
 		self.ttw.reset()
+		if self.ttw.config is not displayed:
+			# the configuration file was edited during the plate: redraw the plate with its lighting positions
+			self.ids.dest_plate.initialize(self.ttw.config.path)
 		self.updateLights()
 
 	def showBarcodeError(self, barcode_type):
 		self.error_popup.title = "Barcode Error"
-		self.error_popup.show("Not a valid " + barcode_type + " barcode")
+		self.error_popup.show("Not a valid " + barcode_type + " barcode\n" + self.ttw.msg)
 		self.ids.textbox.text = ""
 
 	def scanUser(self, *args):
@@ -488,6 +635,10 @@ class TubeToWellWidget(WellLitWidget):
 			self.ids.plate_barcode.text = check_input
 			self.ids.textbox.text = ""
 
+			# starting a new plate instead of resuming the one offered finishes that one as it is
+			if self.resume_path is not None:
+				self.ttw.abandonSession(self.resume_path)
+				self.resume_path = None
 			self.ttw.setMetaData(plate_barcode=self.plate_barcode, user=self.user)
 
 			# set up text file confirmation
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Picks the well the next scanned tube goes into.
+
+A well is free when its transfer is not started, completed or discarded and is not holding a tube
+reserved by the template. TubeToWell always fills the first free well in the transfer sequence, which
+it used to find with a linear search over tf_seq followed by an insert/pop to move that transfer to
+the current position. FreeWellAllocator keeps the free transfers in a heap ordered by their position
+in the sequence, so the next free well is found in O(log n) and moving it only shifts the few
+transfers between it and the current position.
+"""
+
+import heapq
+from WellLit.Transfer import TStatus
+from PlateModel import STATUS_CODES
+
+FREE_STATUS_CODES = frozenset(
+	STATUS_CODES[status] for status in TStatus if status not in (TStatus.started, TStatus.completed, TStatus.discarded)
+)
+
+# smallest gap between two order keys before they are renumbered
+MIN_KEY_GAP = 1e-9
+
+
+class FreeWellAllocator:
+	"""
+	Heap of free transfer ids keyed by an order key that follows the transfer's position in tf_seq.
+
+	Entries are invalidated lazily: a transfer that stops being free, or whose key changes, keeps its
+	old entry until it reaches the top of the heap and is discarded there. update must be called
+	whenever a transfer's status or source tube changes.
+	"""
+
+	def __init__(self, plate, tf_seq, reserved_barcodes):
+		self.plate = plate
+		self.tf_seq = tf_seq
+		self.reserved_barcodes = reserved_barcodes
+		self.renumber()
+
+	def copy(self, plate, tf_seq, reserved_barcodes):
+		"""Returns a copy of the allocator for a copy of its plate and transfer sequence, without renumbering."""
+		allocator = FreeWellAllocator.__new__(FreeWellAllocator)
+		allocator.plate = plate
+		allocator.tf_seq = tf_seq
+		allocator.reserved_barcodes = reserved_barcodes
+		allocator.keys = list(self.keys)
+		allocator.heap = list(self.heap)
+		return allocator
+
+	def renumber(self):
+		"""Resets every order key to the transfer's position in tf_seq and rebuilds the heap."""
+		self.keys = [0.0] * len(self.plate)
+		for position, tf_id in enumerate(self.tf_seq):
+			self.keys[tf_id] = float(position)
+		self.heap = [(self.keys[tf_id], tf_id) for tf_id in self.tf_seq if self.isFree(tf_id)]
+		heapq.heapify(self.heap)
+
+	def rekey(self, start, stop):
+		"""
+		Gives the transfers at tf_seq[start:stop], after that slice was rewritten, order keys spread evenly
+		between those of their neighbours, and re-queues the free ones.
+		"""
+		tf_seq = self.tf_seq
+		before = self.keys[tf_seq[start - 1]] if start > 0 else None
+		after = self.keys[tf_seq[stop]] if stop < len(tf_seq) else None
+		if before is None and after is None:
+			self.renumber()
+			return
+		if before is None:
+			before = after - (stop - start + 1)
+		if after is None:
+			after = before + (stop - start + 1)
+		gap = (after - before) / (stop - start + 1)
+		if gap < MIN_KEY_GAP:
+			self.renumber()
+			return
+		for offset, position in enumerate(range(start, stop), start=1):
+			tf_id = tf_seq[position]
+			self.keys[tf_id] = before + offset * gap
+			self.update(tf_id)
+
+	def isFree(self, tf_id):
+		return (
+			self.plate.status_codes[tf_id] in FREE_STATUS_CODES
+			and self.plate.source_tubes[tf_id] not in self.reserved_barcodes
+		)
+
+	def update(self, tf_id):
+		"""Re-queues a transfer after its status or source tube changed."""
+		if self.isFree(tf_id):
+			heapq.heappush(self.heap, (self.keys[tf_id], tf_id))
+
+	def nextFree(self):
+		"""Returns the id of the first free transfer in sequence order, or None if there is none."""
+		heap = self.heap
+		while heap:
+			key, tf_id = heap[0]
+			if key == self.keys[tf_id] and self.isFree(tf_id):
+				return tf_id
+			heapq.heappop(heap)
+		return None
+
+	def position(self, tf_id, start=0):
+		"""
+		Returns where a transfer is in tf_seq, looking from start on. The order keys increase along tf_seq,
+		so this is a binary search; raises ValueError if the transfer isn't there.
+		"""
+		tf_seq, keys = self.tf_seq, self.keys
+		key = keys[tf_id]
+		lo, hi = start, len(tf_seq)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if keys[tf_seq[mid]] < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < len(tf_seq) and tf_seq[lo] == tf_id:
+			return lo
+		# not where its key says (e.g. a transfer listed twice in tf_seq): search the slow way
+		return tf_seq.index(tf_id, start)
+
+	def moveToPosition(self, tf_id, position):
+		"""
+		Moves a transfer found at or after position in tf_seq to that position, shifting the transfers in
+		between back by one.
+		"""
+		tf_seq = self.tf_seq
+		i = self.position(tf_id, position)
+		if i == position:
+			return
+		tf_seq[position : i + 1] = [tf_id] + tf_seq[position:i]
+
+		# give the transfer a key between its new neighbours
+		after = self.keys[tf_seq[position + 1]]
+		before = self.keys[tf_seq[position - 1]] if position > 0 else after - 2.0
+		key = (before + after) / 2
+		if after - key < MIN_KEY_GAP or key - before < MIN_KEY_GAP:
+			self.renumber()
+		else:
+			self.keys[tf_id] = key
+			self.update(tf_id)
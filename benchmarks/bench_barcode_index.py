@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Measures the persistent barcode index (BarcodeIndex.py):
+
+- lookup latency (p50/p99, hits and misses) once the index holds millions of historical tubes, loaded
+  synthetically as 384-well plates;
+- backfill of a records directory of finished record csvs, parsed in this process and on a process pool.
+
+usage (from the repository root): python benchmarks/bench_barcode_index.py [--tubes 2000000] [--records 400]
+"""
+
+import argparse, csv, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BarcodeIndex import BarcodeIndex, backfill, index_path
+from PlateGeometry import plate_geometry
+from TransferRecords import record_metadata
+
+WELLS = plate_geometry("384").well_names
+LOOKUPS = 20000
+
+
+def percentile(durations, fraction):
+	durations = sorted(durations)
+	return durations[max(0, min(len(durations) - 1, int(round(fraction * len(durations))) - 1))]
+
+
+def load_synthetic(index, num_tubes, batch_plates=200):
+	"""Fills the index with num_tubes tubes in 384-well plates, batch_plates plates per transaction."""
+	plates = (num_tubes + len(WELLS) - 1) // len(WELLS)
+	for first in range(0, plates, batch_plates):
+		batch = []
+		for plate in range(first, min(plates, first + batch_plates)):
+			timestamp = "2025-01-01 00:00:%02d" % (plate % 60)
+			rows = [
+				[timestamp, "TUBE%08d" % (plate * len(WELLS) + i), well, "completed"]
+				for i, well in enumerate(WELLS)
+				if plate * len(WELLS) + i < num_tubes
+			]
+			batch.append(("PLATE%06d_tube_to_plate" % plate, "PLATE%06d" % plate, rows, ""))
+		index.replaceRecords(batch)
+
+
+def time_lookups(index, num_tubes):
+	hits, misses = [], []
+	rng = random.Random(1)
+	for i in range(LOOKUPS):
+		if i % 2:
+			barcode, durations = "TUBE%08d" % rng.randrange(num_tubes), hits
+		else:
+			barcode, durations = "MISSING%08d" % rng.randrange(num_tubes), misses
+		start = time.perf_counter()
+		index.lookup(barcode, exclude_record="CURRENT")
+		durations.append(time.perf_counter() - start)
+	return hits, misses
+
+
+def write_records(records_dir, num_records):
+	for record in range(num_records):
+		plate = "BACKFILL%05d" % record
+		path = os.path.join(records_dir, "20250101-000000_%s_tube_to_plate.csv" % plate)
+		with open(path, "w", newline="") as record_file:
+			writer = csv.writer(record_file)
+			writer.writerows(record_metadata("20250101-000000", "bench", plate))
+			for i, well in enumerate(WELLS):
+				writer.writerow(["2025-01-01 00:00:00", "BF%05d_%03d" % (record, i), well])
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--tubes", type=int, default=2000000)
+	parser.add_argument("--records", type=int, default=400)
+	parser.add_argument("--workers", type=int, default=None)
+	args = parser.parse_args(argv)
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		index = BarcodeIndex(os.path.join(work_dir, "index.sqlite"))
+		start = time.perf_counter()
+		load_synthetic(index, args.tubes)
+		print("loaded %s tubes in %.1f s" % (len(index), time.perf_counter() - start))
+		hits, misses = time_lookups(index, args.tubes)
+		print("{:<10}{:>10}{:>12}{:>12}".format("lookup", "count", "p50 (ms)", "p99 (ms)"))
+		for label, durations in (("hit", hits), ("miss", misses)):
+			print(
+				"{:<10}{:>10}{:>12.4f}{:>12.4f}".format(
+					label, len(durations), percentile(durations, 0.5) * 1000, percentile(durations, 0.99) * 1000
+				)
+			)
+		index.close()
+
+		records_dir = os.path.join(work_dir, "records")
+		os.makedirs(records_dir)
+		write_records(records_dir, args.records)
+		print("\nbackfill of %s records of %s wells" % (args.records, len(WELLS)))
+		for label, workers in (("1 process", 1), ("process pool", args.workers)):
+			path = index_path(records_dir)
+			if os.path.isfile(path):
+				os.remove(path)
+			start = time.perf_counter()
+			count = backfill(records_dir, workers=workers)
+			print("{:<14}{:>8} records in {:.2f} s".format(label, count, time.perf_counter() - start))
+		start = time.perf_counter()
+		count = backfill(records_dir)
+		print("{:<14}{:>8} records in {:.2f} s (nothing changed)".format("incremental", count, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+	main()
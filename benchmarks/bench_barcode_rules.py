@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Times the compiled barcode rules (BarcodeRules.py) on synthetic scans: valid tubes from two vendors
+mixed with truncated reads, two tubes scanned together and tubes of an unknown vendor. The compiled
+rules are compared with reading the same "barcode_rules" entry afresh for every scan (regular
+expressions through re's own cache), and both must accept and reject the same scans.
+
+usage (from the repository root): python benchmarks/bench_barcode_rules.py [--scans 100000] [--repeat 3]
+"""
+
+import argparse, os, random, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BarcodeRules import CHECKSUMS, compile_rules, is_doubled
+
+RULES = {
+	"tube": {
+		"min_length": 8,
+		"max_length": 12,
+		"pattern": "[A-Z0-9]+",
+		"reject_doubled": True,
+		"vendors": {
+			"Azenta": {"prefixes": ["FR", "FD"], "length": 10},
+			"Thermo": {
+				"prefixes": ["FG"],
+				"checksum": "mod103",
+				"check_character_sent": True,
+				"pattern": "FG[0-9]{6}[A-Z0-9]",
+			},
+		},
+	}
+}
+
+
+def with_mod103(body):
+	total = 104 + sum(position * (ord(char) - 32) for position, char in enumerate(body, start=1))
+	return body + chr(total % 103 + 32)
+
+
+def synthetic_scans(count, seed=0):
+	rnd = random.Random(seed)
+	thermo = []
+	while len(thermo) < 50:
+		# keep the Thermo tubes whose check character is a letter or digit
+		barcode = with_mod103("FG%06d" % rnd.randint(0, 999999))
+		if barcode[-1].isalnum() and barcode[-1].upper() == barcode[-1]:
+			thermo.append(barcode)
+	scans = []
+	for _ in range(count):
+		r = rnd.random()
+		if r < 0.6:
+			scans.append("%s%08d" % (rnd.choice(("FR", "FD")), rnd.randint(0, 99999999)))
+		elif r < 0.8:
+			scans.append(rnd.choice(thermo))
+		elif r < 0.9:
+			scans.append(("FR%08d" % rnd.randint(0, 99999999))[: rnd.randint(3, 9)])
+		elif r < 0.95:
+			scans.append("FR%08d" % rnd.randint(0, 9999) * 2)
+		else:
+			scans.append("XX%08d" % rnd.randint(0, 99999999))
+	return scans
+
+
+def interpreted(spec, barcode):
+	"""Checks barcode straight from the configuration entry, the way an uncompiled engine would."""
+
+	def passes(entry):
+		min_length = entry.get("length", entry.get("min_length"))
+		max_length = entry.get("length", entry.get("max_length"))
+		if min_length is not None and len(barcode) < min_length:
+			return False
+		if max_length is not None and len(barcode) > max_length:
+			return False
+		if entry.get("pattern") is not None and re.fullmatch(entry["pattern"], barcode) is None:
+			return False
+		if entry.get("checksum") is not None and not CHECKSUMS[entry["checksum"]](barcode):
+			return False
+		return True
+
+	if not passes(spec):
+		return False
+	if spec.get("reject_doubled") and is_doubled(barcode):
+		return False
+	if spec.get("vendors"):
+		best = None
+		for vendor in spec["vendors"].values():
+			for prefix in vendor["prefixes"]:
+				if barcode.startswith(prefix) and (best is None or len(prefix) > len(best[0])):
+					best = (prefix, vendor)
+		if best is None or not passes(best[1]):
+			return False
+	return True
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--scans", type=int, default=100000)
+	parser.add_argument("--repeat", type=int, default=3)
+	args = parser.parse_args(argv)
+
+	scans = synthetic_scans(args.scans)
+	start = time.perf_counter()
+	rule = compile_rules(RULES).tube
+	compile_time = time.perf_counter() - start
+
+	best_compiled = best_interpreted = None
+	for _ in range(args.repeat):
+		start = time.perf_counter()
+		compiled = [rule.accepts(barcode) for barcode in scans]
+		elapsed = time.perf_counter() - start
+		best_compiled = elapsed if best_compiled is None else min(best_compiled, elapsed)
+
+		start = time.perf_counter()
+		plain = [interpreted(RULES["tube"], barcode) for barcode in scans]
+		elapsed = time.perf_counter() - start
+		best_interpreted = elapsed if best_interpreted is None else min(best_interpreted, elapsed)
+
+	reasons = {}
+	for barcode, accepted in zip(scans, compiled):
+		if not accepted:
+			reason = rule.check(barcode)[0]
+			reasons[reason] = reasons.get(reason, 0) + 1
+	print("compiled the rules in %.3f ms" % (compile_time * 1000))
+	print("{:<14}{:>14}".format("engine", "us per scan"))
+	print("{:<14}{:>14.2f}".format("compiled", best_compiled / len(scans) * 1e6))
+	print("{:<14}{:>14.2f}".format("interpreted", best_interpreted / len(scans) * 1e6))
+	print(
+		"%s scans, %s rejected (%s), engines agree: %s"
+		% (
+			len(scans),
+			compiled.count(False),
+			", ".join("%s %s" % item for item in sorted(reasons.items())),
+			"yes" if compiled == plain else "NO",
+		)
+	)
+
+
+if __name__ == "__main__":
+	main()
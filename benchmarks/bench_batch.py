@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compares placing a rack of tubes with one preassignBatch call against scanning the same tubes one at
+a time with next (and scanning each out again when scan out is enabled), on fresh plates, and checks
+both leave the plate in the same state. Also checks that a rack holding a tube of an earlier, finished
+plate is rejected as a whole.
+
+usage (from the repository root): python benchmarks/bench_batch.py [--sizes 96 384] [--repeat 3]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WellLit.Transfer import TError
+from TubeToWellCLI import ScanDriver, build_ttw
+
+
+def plate_state(ttw):
+	tp = ttw.tp
+	return (
+		list(tp.tf_seq),
+		tp._current_idx,
+		ttw.scanned_out,
+		[(t["source_tube"], t["dest_well"], t["status"]) for t in tp.orderedTransfers()],
+	)
+
+
+def new_plate(num_wells, records_dir, plate):
+	ttw = build_ttw(records_dir=records_dir)
+	ttw.num_wells = str(num_wells)
+	ttw.reset()
+	driver = ScanDriver(ttw, user="bench")
+	driver.startPlate(plate)
+	return ttw, driver
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384])
+	parser.add_argument("--repeat", type=int, default=3)
+	args = parser.parse_args(argv)
+
+	print("{:<8}{:>14}{:>14}{:>10}{:>8}".format("tubes", "next (ms)", "batch (ms)", "speedup", "match"))
+	with tempfile.TemporaryDirectory() as records_dir:
+		for num_wells in args.sizes:
+			best_loop = best_batch = None
+			match = True
+			for run in range(args.repeat):
+				run_dir = tempfile.mkdtemp(dir=records_dir)
+				rack = ["RACK%s_%04d" % (run, i) for i in range(num_wells)]
+
+				ttw, _ = new_plate(num_wells, run_dir, "LOOP")
+				start = time.perf_counter()
+				for barcode in rack:
+					ttw.next(barcode)
+					if ttw.enable_scan_out:
+						ttw.next(barcode)
+				ttw.record_writer.flush()
+				loop = time.perf_counter() - start
+				expected = plate_state(ttw)
+				ttw.endSession()
+
+				ttw, _ = new_plate(num_wells, tempfile.mkdtemp(dir=records_dir), "BATCH")
+				start = time.perf_counter()
+				ttw.preassignBatch(rack)
+				ttw.record_writer.flush()
+				batch = time.perf_counter() - start
+				match = match and plate_state(ttw) == expected
+				best_loop = loop if best_loop is None else min(best_loop, loop)
+				best_batch = batch if best_batch is None else min(best_batch, batch)
+
+				if run == 0:
+					# a new plate in the same folder must refuse a rack holding a tube of the finished one
+					ttw.compactTransferRecordFiles()
+					ttw.endSession()
+					ttw, _ = new_plate(num_wells, run_dir, "AGAIN")
+					try:
+						ttw.preassignBatch(["NEW%04d" % i for i in range(num_wells - 1)] + rack[-1:])
+						match = False
+					except TError:
+						match = match and not ttw.tp.lists["started"] and not ttw.tp.lists["completed"]
+			print(
+				"{:<8}{:>14.1f}{:>14.1f}{:>9.0f}x{:>8}".format(
+					num_wells, best_loop * 1000, best_batch * 1000, best_loop / best_batch, "yes" if match else "NO"
+				)
+			)
+
+
+if __name__ == "__main__":
+	main()
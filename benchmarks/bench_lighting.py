@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Compares the cost per scan of redrawing the plate lighting from scratch (empty every well, re-mark
+everything, redraw the canvas) against IncrementalLighting's diff and blit, on matplotlib's headless
+Agg backend.
+
+The plate is a stand-in with the interface PlateLayer expects of WellLit's PlateLighting (the WellLit
+submodule needs a display to build its plate widget, and its names are not checked here): a fig, a wells dict of Well objects that each have a matplotlib
+patch in marker and their own markEmpty/mark* methods, and the plate-level mark*(well), emptyWells and
+show. Like the real layer it has no markEmpty(well), so the incremental updates go through the same
+PlateLayer adapter as in the GUI; the run fails if they fall back to full redraws. Each plate is filled tube by tube through the headless scan driver (scanning every tube out again
+when scan out is enabled) and the lights are updated after every scan, like the GUI does.
+
+usage (from the repository root): python benchmarks/bench_lighting.py [--sizes 96 384]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matplotlib
+
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Circle
+
+from IncrementalLighting import IncrementalLighting, well_states
+from PlateGeometry import plate_geometry
+from TubeToWellCLI import OperationTimer, ScanDriver, build_ttw
+
+COLORS = {
+	"empty": "white",
+	"filled": "blue",
+	"target": "green",
+	"discarded": "red",
+	"control": "gray",
+	"rescan": "orange",
+}
+
+
+class BenchWell:
+	"""One well of the plate: its patch and the mark methods PlateLayer expects of WellLit's Well."""
+
+	def __init__(self, marker):
+		self.marker = marker
+
+	def _mark(self, state):
+		self.marker.set_facecolor(COLORS[state])
+
+	def markEmpty(self):
+		self._mark("empty")
+
+	def markFilled(self):
+		self._mark("filled")
+
+	def markTarget(self):
+		self._mark("target")
+
+	def markDiscarded(self):
+		self._mark("discarded")
+
+	def markControl(self):
+		self._mark("control")
+
+	def markRescan(self):
+		self._mark("rescan")
+
+
+class BenchPlate:
+	"""Agg plate lighting layer with the interface PlateLayer expects of WellLit's PlateLighting."""
+
+	def __init__(self, num_wells):
+		geometry = plate_geometry(str(num_wells))
+		self.fig = Figure(figsize=(8, 6), dpi=100)
+		FigureCanvasAgg(self.fig)
+		self.ax = self.fig.add_subplot(111)
+		self.ax.set_xlim(0, geometry.num_cols + 1)
+		self.ax.set_ylim(0, geometry.num_rows + 1)
+		self.ax.set_aspect("equal")
+		self.wells = {}
+		for name in geometry.well_names:
+			row = geometry.rows.index(name.rstrip("0123456789"))
+			col = int(name[len(geometry.rows[row]) :])
+			circle = Circle((col, geometry.num_rows - row), 0.4, facecolor=COLORS["empty"], edgecolor="black")
+			self.ax.add_patch(circle)
+			self.wells[name] = BenchWell(circle)
+		self.fig.canvas.draw()
+
+	def emptyWells(self):
+		for well in self.wells.values():
+			well.markEmpty()
+
+	def markFilled(self, well):
+		self.wells[well].markFilled()
+
+	def markTarget(self, well):
+		self.wells[well].markTarget()
+
+	def markDiscarded(self, well):
+		self.wells[well].markDiscarded()
+
+	def markControl(self, well):
+		self.wells[well].markControl()
+
+	def markRescan(self, well):
+		self.wells[well].markRescan()
+
+	def show(self):
+		self.fig.canvas.draw()
+
+
+def run_plate(num_wells, incremental, records_dir):
+	ttw = build_ttw(records_dir=records_dir)
+	ttw.num_wells = str(num_wells)
+	ttw.reset()
+	driver = ScanDriver(ttw, user="bench", timer=OperationTimer())
+	driver.startPlate("BENCH%s" % num_wells)
+	lighting = IncrementalLighting(BenchPlate(num_wells))
+
+	durations = []
+	script = []
+	for i in range(num_wells):
+		script.append("TUBE%06d" % i)
+		if ttw.enable_scan_out:
+			script.append("TUBE%06d" % i)
+	for line in script:
+		driver.execute(line)
+		start = time.perf_counter()
+		if incremental:
+			lighting.update(ttw)
+		else:
+			# the original updateLights
+			lighting.redrawAll(well_states(ttw))
+		durations.append(time.perf_counter() - start)
+	ttw.record_writer.flush()
+	return durations, lighting
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384])
+	args = parser.parse_args(argv)
+
+	fell_back = False
+	print("{:<8}{:<14}{:>10}{:>12}{:>12}{:>10}{:>10}".format("wells", "mode", "updates", "mean (ms)", "max (ms)", "full", "partial"))
+	with tempfile.TemporaryDirectory() as records_dir:
+		for num_wells in args.sizes:
+			for mode, incremental in (("full redraw", False), ("incremental", True)):
+				durations, lighting = run_plate(num_wells, incremental, tempfile.mkdtemp(dir=records_dir))
+				print(
+					"{:<8}{:<14}{:>10}{:>12.3f}{:>12.3f}{:>10}{:>10}".format(
+						num_wells,
+						mode,
+						len(durations),
+						sum(durations) / len(durations) * 1000,
+						max(durations) * 1000,
+						lighting.full_redraws,
+						lighting.partial_redraws,
+					)
+				)
+				if incremental and lighting.partial_redraws < len(durations) - 1:
+					fell_back = True
+	if fell_back:
+		print("FAIL: the incremental updates fell back to full redraws")
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
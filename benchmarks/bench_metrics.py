@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of the operation metrics (Metrics.py) on the scan loop: the synthetic plates of
+bench_scan_loop.py are replayed with metrics disabled, with the in-memory counters only (what the
+Prometheus endpoint serves) and with the JSON-lines file as well, comparing scans/sec and the p50
+latency of next.
+
+usage (from the repository root): python benchmarks/bench_metrics.py [--sizes 96 384] [--repeat 3]
+"""
+
+import argparse, os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from Metrics import METRICS
+from bench_scan_loop import run_plate
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384])
+	parser.add_argument("--repeat", type=int, default=3)
+	args = parser.parse_args(argv)
+
+	print("{:<8}{:<18}{:>12}{:>16}".format("wells", "metrics", "scans/sec", "next p50 (ms)"))
+	with tempfile.TemporaryDirectory() as records_dir:
+		modes = (
+			("disabled", {}),
+			("counters", {"counters": True}),
+			("counters + file", {"metrics_file": os.path.join(records_dir, "metrics.jsonl")}),
+		)
+		for num_wells in args.sizes:
+			for label, options in modes:
+				METRICS.configure(**options)
+				best_rate, best_p50 = 0.0, None
+				for _ in range(args.repeat):
+					timer, scans, elapsed, _ = run_plate(num_wells, True, tempfile.mkdtemp(dir=records_dir))
+					best_rate = max(best_rate, scans / elapsed)
+					p50 = timer.percentile("next", 0.5)
+					best_p50 = p50 if best_p50 is None else min(best_p50, p50)
+				METRICS.close()
+				print("{:<8}{:<18}{:>12.0f}{:>16.4f}".format(num_wells, label, best_rate, best_p50 * 1000))
+
+
+if __name__ == "__main__":
+	main()
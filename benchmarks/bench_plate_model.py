@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Compares building and resetting a plate's transfers with the original uuid-keyed Transfer dicts
+against the array-backed PlateModel.
+
+build: creating the transfers of an empty plate, with the peak memory used while doing it.
+reset: what "Finish Plate" and loading a configuration file cost. The original code built the Transfer
+dicts from scratch on every reset; TubeToWell.reset and TubeToWell.setConfigurationFile are timed on
+a TubeToWell set up for each plate size.
+
+usage (from the repository root): python benchmarks/bench_plate_model.py [--repeat 50] [--sizes 96 384 1536]
+"""
+
+import argparse, json, os, sys, tempfile, time, uuid, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WellLit.Transfer import Transfer
+from PlateModel import PlateModel
+from TubeToWellCLI import build_ttw
+
+SHAPES = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+def well_names(num_rows, num_cols):
+	rows = []
+	for i in range(num_rows):
+		name = ""
+		i += 1
+		while i:
+			i, rem = divmod(i - 1, 26)
+			name = chr(ord("A") + rem) + name
+		rows.append(name)
+	return [row + str(col) for col in range(1, num_cols + 1) for row in rows]
+
+
+def build_transfer_dicts(wells):
+	transfers, tf_seq = {}, []
+	for well in wells:
+		unique_id = str(uuid.uuid1())
+		transfers[unique_id] = Transfer(unique_id, dest_plate="", dest_well=well)
+		tf_seq.append(unique_id)
+	return transfers, tf_seq
+
+
+def build_plate_model(wells):
+	plate = PlateModel(wells, dest_plate="")
+	tf_seq = list(plate.addRows(wells))
+	return plate, tf_seq
+
+
+def time_call(func, repeats):
+	"""Returns the mean seconds per call of func()."""
+	start = time.perf_counter()
+	for _ in range(repeats):
+		func()
+	return (time.perf_counter() - start) / repeats
+
+
+def peak_memory(func):
+	"""Returns the peak bytes allocated while func() runs, including what it returns."""
+	tracemalloc.start()
+	result = func()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del result
+	return peak
+
+
+def config_file(directory, num_wells):
+	"""Writes a copy of the default configuration for a plate size, with its records in directory."""
+	with open(os.path.join("configs", "DEFAULT_CONFIG.json")) as default:
+		config = json.load(default)
+	config["num_wells"] = str(num_wells)
+	config["records_dir"] = os.path.join(directory, "records", "")
+	config["check_previous_plates"] = False
+	path = os.path.join(directory, "config_%s.json" % num_wells)
+	with open(path, "w") as config_json:
+		json.dump(config, config_json)
+	return path
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--repeat", type=int, default=50)
+	parser.add_argument("--sizes", nargs="+", type=int, choices=sorted(SHAPES), default=sorted(SHAPES))
+	args = parser.parse_args(argv)
+
+	print("{:<8}{:<24}{:>12}{:>18}".format("wells", "build", "ms", "peak memory (kB)"))
+	for num_wells in args.sizes:
+		wells = well_names(*SHAPES[num_wells])
+		for name, builder in [("Transfer dicts", build_transfer_dicts), ("PlateModel", build_plate_model)]:
+			build_ms = time_call(lambda: builder(wells), args.repeat) * 1000
+			memory_kb = peak_memory(lambda: builder(wells)) / 1024
+			print("{:<8}{:<24}{:>12.3f}{:>18.1f}".format(num_wells, name, build_ms, memory_kb))
+
+	print()
+	print("{:<8}{:<24}{:>12}{:>18}".format("wells", "reset", "ms", "peak memory (kB)"))
+	with tempfile.TemporaryDirectory() as directory:
+		for num_wells in args.sizes:
+			wells = well_names(*SHAPES[num_wells])
+			path = config_file(directory, num_wells)
+			ttw = build_ttw(config=path)
+			resets = [
+				("Transfer dicts", lambda: build_transfer_dicts(wells)),
+				("TubeToWell.reset", ttw.reset),
+				("setConfigurationFile", lambda: ttw.setConfigurationFile(path)),
+			]
+			for name, reset in resets:
+				reset_ms = time_call(reset, args.repeat) * 1000
+				memory_kb = peak_memory(reset) / 1024
+				print("{:<8}{:<24}{:>12.3f}{:>18.1f}".format(num_wells, name, reset_ms, memory_kb))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Fills several destination plates at once through the headless scan driver, switching the active plate
+before every tube (round robin), and reports scans/sec plus p50/p99 latency of switching plates and of
+next. Every 20th tube is first scanned into the wrong plate (it is already in another plate) and must be
+rejected by the cross-plate tube check.
+
+usage (from the repository root): python benchmarks/bench_plate_sessions.py [--plates 2 4] [--wells 384]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TubeToWellCLI import OperationTimer, ScanDriver, build_ttw
+
+OPERATIONS = ["switch", "next"]
+REJECT_EVERY = 20
+
+
+def run_plates(num_plates, num_wells, records_dir):
+	"""Returns (timer, scans, elapsed, rejected duplicates, expected rejections)."""
+	ttw = build_ttw(records_dir=records_dir)
+	ttw.num_wells = str(num_wells)
+	ttw.reset()
+	timer = OperationTimer()
+	driver = ScanDriver(ttw, user="bench", timer=timer)
+	plates = ["PLATE%s" % i for i in range(num_plates)]
+	for plate in plates:
+		driver.execute("!plate %s" % plate)
+
+	rejected = expected = 0
+	start = time.perf_counter()
+	for i in range(num_wells):
+		for p, plate in enumerate(plates):
+			tube = "TUBE%s_%06d" % (p, i)
+			if i % REJECT_EVERY == REJECT_EVERY - 1 and num_plates > 1:
+				# a tube from the previous round of another plate
+				other = (p + 1) % num_plates
+				driver.execute("!switch %s" % plate)
+				outcome = driver.execute("TUBE%s_%06d" % (other, i - 1))
+				expected += 1
+				rejected += outcome[2] == "error"
+			driver.execute("!switch %s" % plate)
+			driver.execute(tube)
+			if ttw.enable_scan_out:
+				driver.execute(tube)
+	ttw.record_writer.flush()
+	elapsed = time.perf_counter() - start
+	scans = len(timer.durations.get("next", []))
+	for plate in plates:
+		driver.execute("!finish")
+	return timer, scans, elapsed, rejected, expected
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--plates", nargs="+", type=int, default=[1, 2, 4])
+	parser.add_argument("--wells", type=int, default=384)
+	args = parser.parse_args(argv)
+
+	with tempfile.TemporaryDirectory() as records_dir:
+		for num_plates in args.plates:
+			timer, scans, elapsed, rejected, expected = run_plates(num_plates, args.wells, tempfile.mkdtemp(dir=records_dir))
+			print(
+				"\n%s plates of %s wells: %s scans in %.3f s, %.0f scans/sec, %s/%s cross-plate duplicates rejected"
+				% (num_plates, args.wells, scans, elapsed, scans / elapsed, rejected, expected)
+			)
+			print("{:<28}{:>8}{:>12}{:>12}".format("operation", "count", "p50 (ms)", "p99 (ms)"))
+			for operation in OPERATIONS:
+				print(
+					"{:<28}{:>8}{:>12.3f}{:>12.3f}".format(
+						operation,
+						len(timer.durations.get(operation, [])),
+						timer.percentile(operation, 0.5) * 1000,
+						timer.percentile(operation, 0.99) * 1000,
+					)
+				)
+
+
+if __name__ == "__main__":
+	main()
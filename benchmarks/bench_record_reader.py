@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Times reading a large records directory with RecordReader.py, in one process and on a process pool,
+and exporting the combined rows to csv.gz (and Parquet when pyarrow is installed).
+
+The directory is filled with synthetic finished 384-well records (with discarded and EMPTY wells) and a
+warning file for every tenth plate.
+
+usage (from the repository root): python benchmarks/bench_record_reader.py [--records 1000] [--workers 4]
+"""
+
+import argparse, csv, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PlateGeometry import plate_geometry
+from RecordReader import export_records, stream_records
+from TransferRecords import DISCARDED_SUFFIX, record_metadata
+
+WELLS = plate_geometry("384").well_names
+
+
+def write_records(records_dir, num_records):
+	for record in range(num_records):
+		plate = "READ%05d" % record
+		name = os.path.join(records_dir, "20250101-000000_%s_tube_to_plate" % plate)
+		metadata = record_metadata("20250101-000000", "bench", plate)
+		with open(name + ".csv", "w", newline="") as record_file:
+			writer = csv.writer(record_file)
+			writer.writerows(metadata)
+			for i, well in enumerate(WELLS):
+				tube = "RD%05d_%03d" % (record, i)
+				if i % 50 == 49:
+					tube = "EMPTY" + DISCARDED_SUFFIX
+				elif i % 40 == 39:
+					tube += DISCARDED_SUFFIX
+				writer.writerow(["2025-01-01 00:00:00", tube, well])
+		if record % 10 == 0:
+			with open(name + "_WARNING.csv", "w", newline="") as warning_file:
+				writer = csv.writer(warning_file)
+				writer.writerows(metadata)
+				writer.writerow(["Timestamp", "Source Tube", "Destination well"])
+				writer.writerow(["2025-01-01 00:00:00", "RD%05d_000" % record, "", "A1", "completed", " Marked Undone at 20250101-000001"])
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--records", type=int, default=1000)
+	parser.add_argument("--workers", type=int, default=None)
+	args = parser.parse_args(argv)
+
+	with tempfile.TemporaryDirectory() as records_dir:
+		write_records(records_dir, args.records)
+		print("{:<24}{:>10}{:>10}".format("read", "rows", "s"))
+		for label, workers in (("1 process", 1), ("process pool", args.workers)):
+			start = time.perf_counter()
+			rows = sum(1 for _ in stream_records(records_dir, workers=workers))
+			print("{:<24}{:>10}{:>10.2f}".format(label, rows, time.perf_counter() - start))
+
+		outputs = ["combined.csv.gz"]
+		try:
+			import pyarrow
+
+			outputs.append("combined.parquet")
+		except ImportError:
+			print("(pyarrow is not installed, skipping the Parquet export)")
+		for output in outputs:
+			path = os.path.join(records_dir, output)
+			start = time.perf_counter()
+			rows = export_records(stream_records(records_dir, workers=args.workers), path)
+			print(
+				"{:<24}{:>10}{:>10.2f}  {:.1f} MB".format(
+					"export " + output, rows, time.perf_counter() - start, os.path.getsize(path) / 1e6
+				)
+			)
+
+
+if __name__ == "__main__":
+	main()
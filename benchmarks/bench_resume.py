@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Times resuming an unfinished plate from its session journal.
+
+Each plate is filled tube by tube through the headless scan driver (scanning every tube out again when
+scan out is enabled, with an undo every few tubes) and left unfinished, as if the app had crashed.
+A fresh TubeToWell then resumes it with resumeSession, and the rebuilt protocol is checked against the
+original one: transfer sequence, current index, scanned_out, canUndo, lightup_well and every transfer.
+
+usage (from the repository root): python benchmarks/bench_resume.py [--sizes 96 384] [--repeat 5]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SessionJournal import read_session, session_path
+from TubeToWellCLI import OperationTimer, ScanDriver, build_ttw
+
+UNDO_EVERY = 25
+
+
+def protocol_state(ttw):
+	tp = ttw.tp
+	return (
+		list(tp.tf_seq),
+		tp._current_idx,
+		ttw.scanned_out,
+		tp.canUndo,
+		tp.lightup_well,
+		[(t["timestamp"], t["source_tube"], t["dest_well"], t["status"]) for t in tp.orderedTransfers()],
+	)
+
+
+def build_session(num_wells, records_dir):
+	"""Fills a plate through the scan driver without finishing it. Returns the TubeToWell."""
+	ttw = build_ttw(records_dir=records_dir)
+	ttw.num_wells = str(num_wells)
+	ttw.reset()
+	driver = ScanDriver(ttw, user="bench", timer=OperationTimer())
+	driver.startPlate("RESUME%s" % num_wells)
+	for i in range(num_wells):
+		barcode = "TUBE%06d" % i
+		driver.execute(barcode)
+		if ttw.enable_scan_out:
+			driver.execute(barcode)
+		if i % UNDO_EVERY == UNDO_EVERY - 1 and i < num_wells - 1:
+			driver.execute("!undo")
+			driver.execute(barcode)
+			if ttw.enable_scan_out:
+				driver.execute(barcode)
+	ttw.record_writer.flush()
+	return ttw
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384])
+	parser.add_argument("--repeat", type=int, default=5)
+	args = parser.parse_args(argv)
+
+	print("{:<8}{:>10}{:>14}{:>14}{:>10}".format("wells", "actions", "mean (ms)", "best (ms)", "match"))
+	with tempfile.TemporaryDirectory() as records_dir:
+		for num_wells in args.sizes:
+			ttw = build_session(num_wells, tempfile.mkdtemp(dir=records_dir))
+			path = session_path(ttw.records_dir, ttw.csv)
+			_, events = read_session(path)
+			expected = protocol_state(ttw)
+
+			durations, match = [], True
+			for _ in range(args.repeat):
+				resumed = build_ttw(records_dir=ttw.records_dir)
+				# a plate is only resumed with the plate layout it was started with
+				resumed.num_wells = ttw.num_wells
+				start = time.perf_counter()
+				resumed.resumeSession(path)
+				durations.append(time.perf_counter() - start)
+				resumed.record_writer.flush()
+				match = match and protocol_state(resumed) == expected
+				resumed.session.close()
+			print(
+				"{:<8}{:>10}{:>14.2f}{:>14.2f}{:>10}".format(
+					num_wells,
+					len(events),
+					sum(durations) / len(durations) * 1000,
+					min(durations) * 1000,
+					"yes" if match else "NO",
+				)
+			)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Replays synthetic 96, 384 and 1536 well plates through the headless scan driver and reports scans/sec
+plus p50/p99 latency for next, undo, undoCurrentScan and writeTransferRecordFiles, and how often the
+protocol re-sorted its transfer lists from scratch.
+
+Each plate is filled tube by tube (scanning every tube out again when scan out is enabled); every 10th
+tube is cancelled with undoCurrentScan before it is scanned out and rescanned, and every 25th is undone
+after it is scanned out and rescanned.
+
+usage (from the repository root): python benchmarks/bench_scan_loop.py [--sizes 96 384 1536] [--no-scan-out]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TubeToWellCLI import OperationTimer, ScanDriver, build_ttw
+
+OPERATIONS = ["next", "undo", "undoCurrentScan", "writeTransferRecordFiles"]
+
+
+def synthetic_script(num_wells, scan_out):
+	lines = []
+	for i in range(num_wells):
+		tube = "TUBE%06d" % i
+		lines.append(tube)
+		if i % 10 == 9:
+			lines.append("!undo-scan")
+			lines.append(tube)
+		if scan_out:
+			lines.append(tube)
+		if i % 25 == 24:
+			lines.append("!undo")
+			lines.append(tube)
+			if scan_out:
+				lines.append(tube)
+	return lines
+
+
+def run_plate(num_wells, scan_out, records_dir):
+	ttw = build_ttw(records_dir=records_dir)
+	ttw.num_wells = str(num_wells)
+	ttw.enable_scan_out = scan_out
+	ttw.reset()
+	timer = OperationTimer()
+	driver = ScanDriver(ttw, user="bench", timer=timer)
+	driver.startPlate("BENCH%s" % num_wells)
+
+	script = synthetic_script(num_wells, scan_out)
+	start = time.perf_counter()
+	for line in script:
+		driver.execute(line)
+	ttw.record_writer.flush()
+	elapsed = time.perf_counter() - start
+	scans = len(timer.durations.get("next", []))
+	return timer, scans, elapsed, ttw.tp.resorts
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384, 1536])
+	parser.add_argument("--no-scan-out", action="store_true")
+	args = parser.parse_args(argv)
+
+	with tempfile.TemporaryDirectory() as records_dir:
+		for num_wells in args.sizes:
+			timer, scans, elapsed, resorts = run_plate(
+				num_wells, not args.no_scan_out, tempfile.mkdtemp(dir=records_dir)
+			)
+			print("\n%s wells: %s scans in %.3f s, %.0f scans/sec" % (num_wells, scans, elapsed, scans / elapsed))
+			print("full transfer list re-sorts: %s (%.2f per scan)" % (resorts, resorts / scans))
+			print("{:<28}{:>8}{:>12}{:>12}".format("operation", "count", "p50 (ms)", "p99 (ms)"))
+			for operation in OPERATIONS:
+				print(
+					"{:<28}{:>8}{:>12.3f}{:>12.3f}".format(
+						operation,
+						len(timer.durations.get(operation, [])),
+						timer.percentile(operation, 0.5) * 1000,
+						timer.percentile(operation, 0.99) * 1000,
+					)
+				)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Stress test of the scanner input service (ScannerInput.py): a fake scanner writes --rate scans per
+second (50 by default) into a named pipe read as a device file (a local TCP port on systems without
+named pipes, or with --source tcp / unix), and every scan is run through TubeToWell.next, each tube
+scanned in and then out again. Scans are written the way a serial scanner sends them: CR, LF or CRLF
+line ends, now and then two scans in one write or one scan split over two writes. Every --slow-every
+scans the handler sleeps --slow-ms, like a slow redraw of the display, so the small queue fills up and
+the fake scanner has to wait.
+
+Checks that every scan was delivered, once and in the order it was sent, and that every tube ended up
+completed in the records. Reports the delay from writing a scan to the end of its TubeToWell.next.
+tests/test_scanner_input.py runs stress for a few seconds on every source.
+
+usage (from the repository root): python benchmarks/bench_scanner_input.py [--rate 50] [--seconds 10] [--source fifo]
+"""
+
+import argparse, os, random, socket, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ScannerInput import ScannerInput, SocketSource, parse_source
+from TubeToWellCLI import ScanDriver, build_ttw
+
+LINE_ENDS = (b"\r", b"\n", b"\r\n")
+
+
+def scan_lines(tubes, enable_scan_out):
+	lines = []
+	for i in range(tubes):
+		barcode = "FR%08d" % i
+		lines.append(barcode)
+		if enable_scan_out:
+			lines.append(barcode)
+	return lines
+
+
+def fake_scanner(write, lines, rate, sent, seed=0):
+	"""Writes lines at rate per second, recording when each was written."""
+	rnd = random.Random(seed)
+	interval = 1.0 / rate
+	due = time.perf_counter()
+	i = 0
+	while i < len(lines):
+		due += interval
+		delay = due - time.perf_counter()
+		if delay > 0:
+			time.sleep(delay)
+		data = lines[i].encode() + rnd.choice(LINE_ENDS)
+		r = rnd.random()
+		if r < 0.05 and i + 1 < len(lines):
+			# two scans in one write
+			sent.append(time.perf_counter())
+			sent.append(time.perf_counter())
+			write(data + lines[i + 1].encode() + b"\r")
+			i += 2
+			due += interval
+			continue
+		sent.append(time.perf_counter())
+		if r < 0.1:
+			# a scan split over two writes
+			write(data[:3])
+			time.sleep(0.002)
+			write(data[3:])
+		else:
+			write(data)
+		i += 1
+
+
+def open_source(kind, directory):
+	"""Returns (source spec, function opening the fake scanner's end and returning (write, close))."""
+	if kind == "fifo":
+		path = os.path.join(directory, "scanner")
+		os.mkfifo(path)
+
+		def connect():
+			fd = os.open(path, os.O_WRONLY)
+			return (lambda data: os.write(fd, data)), (lambda: os.close(fd))
+
+		return "device:%s" % path, connect
+	if kind == "unix":
+		path = os.path.join(directory, "scanner.sock")
+
+		def connect():
+			client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			client.connect(path)
+			return client.sendall, client.close
+
+		return "unix:%s" % path, connect
+	return "tcp:0", None
+
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def stress(directory, rate, seconds, source="fifo", queue_size=8, slow_every=25, slow_ms=150.0):
+	"""
+	Runs the fake scanner for seconds at rate scans per second through a ScannerInput into a TubeToWell
+	recording to directory. Returns a dict: the source spec, the lines written and the barcodes delivered
+	(in order), when each was written and handled, the handler results, the service stats and the tubes
+	completed in the records.
+	"""
+	ttw = build_ttw(records_dir=os.path.join(directory, "records"))
+	ttw.num_wells = "1536"
+	ttw.reset()
+	driver = ScanDriver(ttw, user="bench")
+	driver.startPlate("SCANNER")
+	scans = int(rate * seconds)
+	lines = scan_lines(scans // 2 if ttw.enable_scan_out else scans, ttw.enable_scan_out)
+
+	delivered, done, results = [], [], {}
+
+	def handler(scan):
+		outcome = driver.execute(scan.barcode)
+		done.append(time.perf_counter())
+		delivered.append(scan.barcode)
+		results[outcome[2]] = results.get(outcome[2], 0) + 1
+		if slow_every and len(delivered) % slow_every == 0:
+			time.sleep(slow_ms / 1000)
+
+	spec, connect = open_source(source, directory)
+	scanner_source = parse_source(spec)
+	service = ScannerInput(handler, [scanner_source], maxsize=queue_size).start()
+	if isinstance(scanner_source, SocketSource) and scanner_source.path is None:
+		client = socket.create_connection(("127.0.0.1", scanner_source.port))
+		spec = "tcp:%s" % scanner_source.port
+		write, close = client.sendall, client.close
+	else:
+		write, close = connect()
+
+	sent = []
+	start = time.perf_counter()
+	writer = threading.Thread(target=fake_scanner, args=(write, lines, rate, sent))
+	writer.start()
+	writer.join()
+	write_time = time.perf_counter() - start
+	close()
+	deadline = time.time() + 30
+	while len(delivered) < len(lines) and time.time() < deadline:
+		time.sleep(0.05)
+	service.stop()
+	ttw.record_writer.flush()
+	completed = {ttw.tp.transfers[tf_id]["source_tube"] for tf_id in ttw.tp.lists["completed"]}
+	ttw.endSession()
+	return {
+		"spec": spec,
+		"lines": lines,
+		"sent": sent,
+		"write_time": write_time,
+		"delivered": delivered,
+		"delays": [finished - written for written, finished in zip(sent, done)],
+		"results": results,
+		"stats": service.stats(),
+		"completed": completed,
+	}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--rate", type=float, default=50.0, help="scans per second")
+	parser.add_argument("--seconds", type=float, default=10.0)
+	parser.add_argument("--source", choices=("fifo", "tcp", "unix"), default="fifo" if hasattr(os, "mkfifo") else "tcp")
+	parser.add_argument("--queue", type=int, default=8, help="scans the service queues before the scanner waits")
+	parser.add_argument("--slow-every", type=int, default=25)
+	parser.add_argument("--slow-ms", type=float, default=150.0)
+	args = parser.parse_args(argv)
+
+	with tempfile.TemporaryDirectory() as directory:
+		run = stress(directory, args.rate, args.seconds, args.source, args.queue, args.slow_every, args.slow_ms)
+	lines, delivered, sent, delays = run["lines"], run["delivered"], run["sent"], run["delays"]
+	tubes = set(lines)
+	print(
+		"source %s, %s scans written in %.2f s (%.1f scans/sec)"
+		% (run["spec"], len(sent), run["write_time"], len(sent) / run["write_time"])
+	)
+	print(
+		"delivered %s, lost %s, in order: %s, handler errors %s, results %s"
+		% (
+			len(delivered),
+			len(lines) - len(delivered),
+			"yes" if delivered == lines else "NO",
+			run["stats"]["failed"],
+			", ".join("%s %s" % item for item in sorted(run["results"].items())),
+		)
+	)
+	print("max queue depth %s of %s" % (run["stats"]["max_depth"], args.queue))
+	if delays:
+		print(
+			"write -> handled (ms): p50 %.2f  p99 %.2f  max %.2f"
+			% (percentile(delays, 0.5) * 1000, percentile(delays, 0.99) * 1000, max(delays) * 1000)
+		)
+	print("tubes completed in the records: %s of %s" % (len(run["completed"] & tubes), len(tubes)))
+	ok = delivered == lines and run["completed"] >= tubes
+	print("PASS" if ok else "FAIL")
+	return 0 if ok else 1
+
+
+if __name__ == "__main__":
+	sys.exit(main())
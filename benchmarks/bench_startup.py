@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Startup check for TubeToWell: imports TubeToWell and constructs it in a fresh interpreter with startup
+profiling enabled, prints the timing breakdown, and fails if pandas was imported along the way
+(pandas should only be loaded when a template file is read).
+
+usage (from the repository root): python benchmarks/bench_startup.py
+"""
+
+import os, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import sys, traceback
+
+importer = []
+
+class WatchPandas:
+	def find_spec(self, name, path=None, target=None):
+		if name == "pandas" and not importer:
+			importer.append("".join(traceback.format_stack(limit=12)[:-1]))
+		return None
+
+sys.meta_path.insert(0, WatchPandas())
+
+from TubeToWell import TubeToWell, printStartupProfile
+TubeToWell()
+printStartupProfile()
+
+if "pandas" in sys.modules:
+	print("FAIL: pandas was imported during startup by:\n" + importer[0])
+	sys.exit(1)
+print("OK: pandas was not imported during startup")
+"""
+
+
+def main():
+	env = dict(os.environ, TTW_PROFILE_STARTUP="1")
+	env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+	result = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=env)
+	return result.returncode
+
+
+if __name__ == "__main__":
+	sys.exit(main())
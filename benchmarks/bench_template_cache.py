@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Times loading a template and starting a new plate with it, with the template and protocol caches of
+TemplateCache.py cold (cleared before every load) and warm, for the templates in templates/ and for
+each plate size.
+
+usage (from the repository root): python benchmarks/bench_template_cache.py [--sizes 96 384] [--repeat 50]
+"""
+
+import argparse, glob, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import TemplateCache
+from TubeToWellCLI import build_ttw
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+
+def load_and_start(ttw, template, repeat, cold):
+	"""Returns the mean seconds of loadWellConfigurationCSV followed by reset (a fresh plate)."""
+	durations = []
+	for _ in range(repeat):
+		if cold:
+			TemplateCache.clear_caches()
+		start = time.perf_counter()
+		ttw.loadWellConfigurationCSV(template)
+		ttw.reset()
+		durations.append(time.perf_counter() - start)
+	return sum(durations) / len(durations)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384])
+	parser.add_argument("--repeat", type=int, default=50)
+	parser.add_argument("--templates", nargs="+", default=sorted(glob.glob(os.path.join(TEMPLATES_DIR, "*.csv"))))
+	args = parser.parse_args(argv)
+
+	print("{:<28}{:>8}{:>12}{:>12}{:>10}".format("template", "wells", "cold (ms)", "warm (ms)", "speedup"))
+	with tempfile.TemporaryDirectory() as records_dir:
+		ttw = build_ttw(records_dir=records_dir)
+		for num_wells in args.sizes:
+			ttw.num_wells = str(num_wells)
+			for template in args.templates:
+				try:
+					cold = load_and_start(ttw, template, args.repeat, cold=True)
+				except Exception as error:
+					# e.g. a template with wells that don't exist on this plate size
+					print("{:<28}{:>8}  {}".format(os.path.basename(template), num_wells, type(error).__name__))
+					continue
+				warm = load_and_start(ttw, template, args.repeat, cold=False)
+				print(
+					"{:<28}{:>8}{:>12.3f}{:>12.3f}{:>9.0f}x".format(
+						os.path.basename(template), num_wells, cold * 1000, warm * 1000, cold / warm
+					)
+				)
+	stats = TemplateCache.cache_stats()
+	for name in ("templates", "protocols"):
+		print("%s cache: %s" % (name, ", ".join("%s %s" % item for item in stats[name].items())))
+
+
+if __name__ == "__main__":
+	main()
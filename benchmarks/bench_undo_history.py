@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Times multi-level undo and redo (TubeToWell.undoSteps / redoSteps, see ProtocolHistory.py) on synthetic
+96, 384 and 1536 well plates: each plate is half filled tube by tube, then the last --steps actions are
+taken back one at a time and made again one at a time. The cost of a step should not grow with the
+plate. Also checks that undoing and redoing everything leaves the plate exactly as it was.
+
+usage (from the repository root): python benchmarks/bench_undo_history.py [--sizes 96 384 1536] [--steps 40]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TubeToWellCLI import ScanDriver, build_ttw
+
+
+def plate_state(ttw):
+	tp = ttw.tp
+	return (
+		list(tp.tf_seq),
+		tp._current_idx,
+		tp.canUndo,
+		ttw.scanned_out,
+		[(t["source_tube"], t["dest_well"], t["status"], t["timestamp"]) for t in tp.orderedTransfers()],
+		tp.allocator.nextFree(),
+	)
+
+
+def percentile(durations, fraction):
+	durations = sorted(durations)
+	return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", nargs="+", type=int, default=[96, 384, 1536])
+	parser.add_argument("--steps", type=int, default=40)
+	args = parser.parse_args(argv)
+
+	print("{:<8}{:>8}{:>16}{:>16}{:>8}".format("wells", "steps", "undo p50 (ms)", "redo p50 (ms)", "match"))
+	with tempfile.TemporaryDirectory() as records_dir:
+		for num_wells in args.sizes:
+			ttw = build_ttw(records_dir=tempfile.mkdtemp(dir=records_dir))
+			ttw.num_wells = str(num_wells)
+			ttw.reset()
+			driver = ScanDriver(ttw, user="bench")
+			driver.startPlate("UNDO%s" % num_wells)
+			for i in range(num_wells // 2):
+				ttw.next("TUBE%06d" % i)
+				if ttw.enable_scan_out:
+					ttw.next("TUBE%06d" % i)
+			ttw.writeTransferRecordFiles()
+			expected = plate_state(ttw)
+
+			steps = min(args.steps, len(ttw.tp.undo_history.undo_steps))
+			undo_times, redo_times = [], []
+			for _ in range(steps):
+				start = time.perf_counter()
+				ttw.undoSteps()
+				undo_times.append(time.perf_counter() - start)
+			for _ in range(steps):
+				start = time.perf_counter()
+				ttw.redoSteps()
+				redo_times.append(time.perf_counter() - start)
+			ttw.record_writer.flush()
+			match = plate_state(ttw) == expected
+			ttw.endSession()
+			print(
+				"{:<8}{:>8}{:>16.3f}{:>16.3f}{:>8}".format(
+					num_wells,
+					steps,
+					percentile(undo_times, 0.5) * 1000,
+					percentile(redo_times, 0.5) * 1000,
+					"yes" if match else "NO",
+				)
+			)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,39 @@
+import os, sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def make_ttw(tmp_path, monkeypatch):
+	"""
+	Returns a function creating a TubeToWell on the default configuration (from the repository folder, like
+	the GUI) with a plate started and its records written to a temporary folder.
+	"""
+	monkeypatch.chdir(ROOT)
+	from TubeToWellCLI import build_ttw
+
+	started = []
+
+	def make(template=None, num_wells=None, plate="TEST"):
+		ttw = build_ttw(records_dir=str(tmp_path / ("records%s" % len(started))))
+		if num_wells is not None:
+			ttw.num_wells = str(num_wells)
+			ttw.reset()
+		if template is not None:
+			ttw.loadWellConfigurationCSV(template)
+		ttw.setMetaData(plate_barcode=plate, user="test")
+		started.append(ttw)
+		return ttw
+
+	yield make
+	for ttw in started:
+		ttw.record_writer.flush()
+		ttw.endSession()
+
+
+@pytest.fixture
+def ttw(make_ttw):
+	return make_ttw()
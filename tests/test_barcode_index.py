@@ -0,0 +1,108 @@
+"""The barcode index of previous plates (BarcodeIndex.py): lookups, backfill and TubeToWell's check_previous_plates."""
+
+import os
+
+import pytest
+from WellLit.Transfer import TError
+
+from BarcodeIndex import BarcodeIndex, backfill, index_path, open_index
+from conftest import ROOT
+
+
+@pytest.fixture(autouse=True)
+def in_repository(monkeypatch):
+	# TubeToWell reads the default configuration from the repository folder, like the GUI
+	monkeypatch.chdir(ROOT)
+
+
+def write_plate(records_dir, plate, tubes, check_previous_plates=False):
+	"""Scans tubes (in and out) into a new plate and finishes it, returning the TubeToWell."""
+	from TubeToWellCLI import build_ttw
+
+	ttw = build_ttw(records_dir=str(records_dir))
+	ttw.check_previous_plates = check_previous_plates
+	ttw.setMetaData(plate_barcode=plate, user="test")
+	for tube in tubes:
+		ttw.next(tube)
+		if ttw.enable_scan_out:
+			ttw.next(tube)
+	ttw.compactTransferRecordFiles()
+	ttw.endSession()
+	return ttw
+
+
+@pytest.fixture
+def index(tmp_path):
+	index = BarcodeIndex(str(tmp_path / "index.sqlite"))
+	yield index
+	index.close()
+
+
+def test_lookup(index):
+	index.update("R1", "PLATE1", [["2025-01-01 10:00:00", "T1", "A1", "completed"], ["2025-01-01 10:00:01", "T2", "B1", "discarded"]])
+	index.update("R2", "PLATE2", [["2025-01-02 10:00:00", "T1", "C1", "started"]])
+	assert index.lookup("T1") == ("PLATE2", "C1", "2025-01-02 10:00:00", "R2")
+	assert index.lookup("T1", exclude_record="R2") == ("PLATE1", "A1", "2025-01-01 10:00:00", "R1")
+	# a discarded tube is kept for reference but is not in a well
+	assert index.lookup("T2") is None
+	assert index.lookup("T3") is None
+	assert index.lookupMany(["T1", "T2", "T3", "T1"], exclude_record="R2") == {"T1": ("PLATE1", "A1", "2025-01-01 10:00:00", "R1")}
+
+
+def test_undone_well_leaves_the_index(index):
+	index.update("R1", "PLATE1", [["2025-01-01 10:00:00", "T1", "A1", "completed"]])
+	index.update("R1", "PLATE1", [["2025-01-01 10:00:00", "T1", "A1", "uncompleted"]])
+	assert index.lookup("T1") is None
+	assert len(index) == 0
+
+
+def test_rollback_journal(index):
+	# WAL mode does not work on the network shares records directories are kept on
+	assert index.connection().execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+
+def test_backfill(tmp_path):
+	records = tmp_path / "records"
+	write_plate(records, "PLATE1", ["T1", "T2"])
+	write_plate(records, "PLATE2", ["T3"])
+	index = BarcodeIndex(index_path(str(records)))
+	assert backfill(str(records), index) == 2
+	assert index.lookup("T2")[:2] == ("PLATE1", "B1")
+	assert index.lookup("T3")[:2] == ("PLATE2", "A1")
+	# records that didn't change since they were indexed are skipped
+	assert backfill(str(records), index) == 0
+	write_plate(records, "PLATE3", ["T4"])
+	assert backfill(str(records), index, workers=1) == 1
+	assert len(index) == 4
+	index.close()
+
+
+def test_new_index_is_backfilled_in_the_background(tmp_path):
+	records = tmp_path / "records"
+	write_plate(records, "PLATE1", ["T1"])
+	index = open_index(str(records))
+	assert index.waitForBackfill(timeout=30)
+	assert index.lookup("T1")[:2] == ("PLATE1", "A1")
+	index.close()
+	# an existing index is opened as it is
+	assert not open_index(str(records)).backfilling()
+
+
+def test_previous_plates_are_checked(tmp_path):
+	records = tmp_path / "records"
+	first = write_plate(records, "PLATE1", ["T1", "T2"], check_previous_plates=True)
+	first.record_writer.flush()
+	second = write_plate(records, "PLATE2", ["T3"], check_previous_plates=True)
+	second.setMetaData(plate_barcode="PLATE3", user="test")
+	with pytest.raises(TError, match="T2.*well B1 of plate PLATE1"):
+		second.next("T2")
+	second.next("T4")
+	second.endSession()
+
+
+def test_previous_plates_are_not_checked_when_turned_off(tmp_path):
+	records = tmp_path / "records"
+	write_plate(records, "PLATE1", ["T1"], check_previous_plates=True).record_writer.flush()
+	second = write_plate(records, "PLATE2", ["T1"])
+	assert second.history is None
+	assert os.path.exists(index_path(str(records)))
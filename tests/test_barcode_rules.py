@@ -0,0 +1,179 @@
+"""Barcode rules (BarcodeRules.py): the check characters and picking the rules from the configuration."""
+
+import json, os
+
+import pytest
+from WellLit.Transfer import TError
+
+from conftest import ROOT
+import BarcodeRules
+from BarcodeRules import compile_rules, luhn_valid, mod103_valid
+from Configuration import ConfigError, load_config
+
+
+@pytest.mark.parametrize("barcode", ["79927398713", "4539148803436467", "1234567812345670", "0000000000", "18"])
+def test_luhn_accepts(barcode):
+	assert luhn_valid(barcode)
+
+
+@pytest.mark.parametrize(
+	"barcode",
+	[
+		"79927398710",
+		"1234567812345678",
+		# two digits swapped
+		"4539148803436476",
+		"19",
+		"7",
+		"",
+		"7992739871a",
+		# digits, but not ASCII ones
+		"٩١",
+	],
+)
+def test_luhn_rejects(barcode):
+	assert not luhn_valid(barcode)
+
+
+@pytest.mark.parametrize(
+	"barcode",
+	[
+		"FG12345w",
+		"FG12340T",
+		"FG00001)",
+		"TUBE0001)",
+		# the highest check value with a character of its own
+		"FG12346~",
+		# check value 101, a function character: the scanner sends the data alone
+		"FG12347",
+	],
+)
+def test_mod103_accepts(barcode):
+	assert mod103_valid(barcode)
+
+
+@pytest.mark.parametrize(
+	"barcode",
+	[
+		"FG12345x",
+		"FG12345W",
+		# the check character stripped by the scanner
+		"FG12345",
+		"FG12340",
+		# a function character check value has no character to send
+		"FG12347~",
+		"FG1234éw",
+		"FG12345\x7f",
+		"A",
+		"",
+	],
+)
+def test_mod103_rejects(barcode):
+	assert not mod103_valid(barcode)
+
+
+TUBE_RULES = {
+	"min_length": 6,
+	"reject_doubled": True,
+	"vendors": {
+		"Azenta": {"prefixes": ["FR", "FD"], "length": 10},
+		"Thermo": {"prefixes": ["FG"], "checksum": "mod103", "check_character_sent": True},
+		"Thermo Luhn": {"prefixes": ["FGL"], "pattern": "FGL[0-9]+", "length": 9},
+	},
+}
+
+
+def test_vendor_rules_are_picked_by_prefix():
+	tube = compile_rules({"tube": TUBE_RULES}).tube
+	assert tube.accepts("FR12345678") and tube.accepts("FD00000000")
+	assert tube.explain("FR1234567") == "must be 10 characters long (Azenta)"
+	assert tube.accepts("FG12345w")
+	assert tube.explain("FG12345x") == "mod103 check character is wrong (Thermo)"
+	# the longest prefix wins: FGL tubes don't need a Code 128 check character
+	assert tube.accepts("FGL123456")
+	assert tube.explain("FGL12345x") == "does not match FGL[0-9]+ (Thermo Luhn)"
+	assert tube.explain("XX12345678") == "does not start with a known vendor prefix"
+	# the rules of the kind come before the vendor's
+	assert tube.explain("FR1") == "must be at least 6 characters long"
+	assert tube.explain("FR1234FR1234") == "looks like the same barcode scanned twice"
+
+
+def test_kinds_without_rules_accept_everything():
+	rules = compile_rules({"plate": {"pattern": "P[0-9]{6}", "checksum": "luhn"}})
+	assert not rules.tube and rules.tube.accepts("anything at all")
+	assert rules.name.accepts("")
+	assert rules.plate.explain("P123456") == "luhn check character is wrong"
+	assert rules.plate.accepts("P123455") is False
+	assert rules.plate.accepts("") is False
+	assert not compile_rules(None).plate
+
+
+def test_rejections_are_counted():
+	BarcodeRules.rejections.clear()
+	plate = compile_rules({"plate": {"length": 4}}).plate
+	for barcode in ["P1", "P12", "P123", "P12345"]:
+		plate.accepts(barcode)
+	assert BarcodeRules.rejections == {("plate", "length"): 3}
+	assert BarcodeRules.metric_samples() == [
+		("plate_barcode_rejected_length_total", "counter", "Plate barcodes rejected by the length rule.", 3)
+	]
+	BarcodeRules.rejections.clear()
+
+
+@pytest.mark.parametrize(
+	"spec, problem",
+	[
+		({"tube": {"checksum": "mod103"}}, 'barcode_rules.tube: mod103 needs "check_character_sent": true'),
+		(
+			{"tube": {"vendors": {"Thermo": {"prefixes": ["FG"], "checksum": "mod103", "check_character_sent": False}}}},
+			"barcode_rules.tube.vendors.Thermo: mod103 needs",
+		),
+		({"tube": {"checksum": "crc32"}}, "unknown checksum 'crc32'"),
+		({"tube": {"min_length": 9, "max_length": 8}}, "min_length 9 is more than max_length 8"),
+		({"tube": {"pattern": "[A-"}}, "invalid pattern"),
+		({"tube": {"vendors": {"A": {"prefixes": ["X"]}, "B": {"prefixes": ["X"]}}}}, "belongs to two vendors"),
+		({"tube": {"vendors": {"A": {"length": 3}}}}, "needs a list of prefixes"),
+		({"tube": {"lenght": 3}}, "unknown entries lenght"),
+		({"box": {"length": 3}}, "unknown entries box"),
+	],
+)
+def test_invalid_rules(spec, problem):
+	with pytest.raises(ValueError, match=problem.replace("(", r"\(").replace("[", r"\[")):
+		compile_rules(spec)
+
+
+def config_file(tmp_path, **entries):
+	with open(os.path.join(ROOT, "configs", "DEFAULT_CONFIG.json")) as default:
+		config = json.load(default)
+	config.update(entries)
+	path = tmp_path / "config.json"
+	path.write_text(json.dumps(config))
+	return str(path)
+
+
+def test_rules_from_the_configuration(tmp_path, monkeypatch):
+	monkeypatch.chdir(ROOT)
+	from TubeToWellCLI import build_ttw
+
+	config = config_file(tmp_path, barcode_rules={"tube": TUBE_RULES, "plate": {"pattern": "P[0-9]{6}"}})
+	assert load_config(config).barcode_rules.tube.accepts("FG12345w")
+	ttw = build_ttw(config=config, records_dir=str(tmp_path / "records"))
+	assert not ttw.isPlate("BAD") and ttw.isPlate("P000001")
+	ttw.setMetaData(plate_barcode="P000001", user="test")
+	ttw.enable_scan_out = False
+	try:
+		ttw.next("FG12345w")
+		with pytest.raises(TError, match="FG12345 is not a valid barcode: mod103 check character is wrong"):
+			ttw.next("FG12345")
+		assert ttw.tp.findTransferByBarcode("FG12345w")["dest_well"] == "A1"
+		assert ttw.tp.findTransferByBarcode("FG12345") is None
+	finally:
+		ttw.record_writer.flush()
+		ttw.endSession()
+
+
+def test_mod103_without_check_character_sent_is_a_config_error(tmp_path):
+	config = config_file(tmp_path, barcode_rules={"tube": {"checksum": "mod103"}})
+	with pytest.raises(ConfigError) as error:
+		load_config(config)
+	assert 'mod103 needs "check_character_sent": true' in str(error.value)
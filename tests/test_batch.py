@@ -0,0 +1,141 @@
+"""Placing a rack of tubes at once (TubeToWell.preassignBatch, validateBatch and stepBatch)."""
+
+import csv, os
+
+import pytest
+from WellLit.Transfer import TError
+
+from TubeToWellCLI import ScanDriver
+
+TEMPLATE = "templates/example_template.csv"
+
+
+def write_rack(path, barcodes):
+	with open(path, "w", newline="") as rack:
+		writer = csv.writer(rack)
+		writer.writerow(["Tube"])
+		writer.writerows([barcode] for barcode in barcodes)
+	return str(path)
+
+
+def write_samples(path, barcodes):
+	return write_rack(path, barcodes)
+
+
+def plate_state(ttw):
+	ttw.record_writer.flush()
+	path = str(ttw.recordPaths()[0]) + ".journal"
+	record = None
+	if os.path.exists(path):
+		with open(path) as journal:
+			record = journal.read()
+	return {
+		"transfers": [(tf["source_tube"], tf["dest_well"], tf["status"], tf["timestamp"]) for tf in ttw.tp.orderedTransfers()],
+		"tf_seq": list(ttw.tp.tf_seq),
+		"current": ttw.tp._current_idx,
+		"can_undo": ttw.tp.canUndo,
+		"scanned_out": ttw.scanned_out,
+		"record": record,
+	}
+
+
+def placed(ttw):
+	"""(tube, well, status) of every transfer a tube went into, in fill order."""
+	return [
+		(tf["source_tube"], tf["dest_well"], tf["status"]) for tf in ttw.tp.orderedTransfers() if tf["status"] != "uncompleted"
+	]
+
+
+def test_bad_rows_place_nothing(make_ttw, tmp_path):
+	ttw = make_ttw(template=TEMPLATE)
+	ttw.loadCSV(write_samples(tmp_path / "samples.csv", ["T%s" % i for i in range(1, 9)] + ["3"]))
+	driver = ScanDriver(ttw, user="test")
+	for line in ["T1", "T1", "3", "3"]:
+		driver.execute(line)
+	before = plate_state(ttw)
+
+	rack = write_rack(tmp_path / "rack.csv", ["T2", "T3", "T2", "T1", "EMPTY", "3", "T9", "T4"])
+	with pytest.raises(TError) as error:
+		ttw.loadRackCSV(rack)
+	message = str(error.value)
+	assert "The rack has 5 problem(s), no tubes were placed" in message
+	problems = [
+		(3, "T2", "Repeated in the rack (tube 1)"),
+		(4, "T1", "Already scanned into well A1"),
+		(5, "EMPTY", "Not a valid tube barcode"),
+		# its reserved well is used
+		(6, "3", "Already scanned into well A3"),
+		(7, "T9", "Not in the sample list"),
+	]
+	assert [(entry["position"], entry["barcode"], entry["error"]) for entry in ttw.batch_errors] == problems
+	for position, barcode, problem in problems:
+		assert "Tube %s (%s): %s" % (position, barcode, problem) in message
+	assert plate_state(ttw) == before
+	assert ttw.batch is None
+
+	# the fixed rack goes in
+	ttw.loadRackCSV(write_rack(tmp_path / "fixed.csv", ["T2", "T3", "T4"]))
+	assert ttw.batch_errors == []
+	assert placed(ttw)[-3:] == [("T2", "B1", "completed"), ("T3", "C1", "completed"), ("T4", "D1", "completed")]
+
+
+def test_rack_larger_than_the_plate(make_ttw, tmp_path):
+	ttw = make_ttw()
+	before = plate_state(ttw)
+	with pytest.raises(TError, match="97 tubes need a free well but only 96 are left on the plate"):
+		ttw.loadRackCSV(write_rack(tmp_path / "rack.csv", ["T%s" % i for i in range(97)]))
+	assert ttw.batch_errors == [
+		{"position": None, "barcode": None, "error": "97 tubes need a free well but only 96 are left on the plate"}
+	]
+	assert plate_state(ttw) == before
+
+
+def test_tube_not_scanned_out_first(make_ttw):
+	ttw = make_ttw()
+	ttw.next("T1")
+	with pytest.raises(TError, match="Scan out the current tube"):
+		ttw.preassignBatch(["T2"])
+	with pytest.raises(TError, match="no tubes"):
+		ttw.preassignBatch([])
+	assert ttw.validateBatch(["T1", "T2"]) == [{"position": 1, "barcode": "T1", "error": "Already scanned into well A1"}]
+
+
+@pytest.mark.parametrize("scan_out", [True, False], ids=["scan out", "no scan out"])
+def test_batch_is_the_same_as_scanning_one_by_one(make_ttw, scan_out):
+	tubes = ["T1", "3", "T2", "T3", "T4", "T5"]
+	batched = make_ttw(template=TEMPLATE, plate="BATCH")
+	scanned = make_ttw(template=TEMPLATE, plate="SCANNED")
+	for ttw in (batched, scanned):
+		ttw.enable_scan_out = scan_out
+		# an undone tube and a discarded well before the rack
+		ttw.next("T0")
+		if scan_out:
+			ttw.next("T0")
+		ttw.discardSpecificWell("A1")
+	wells = [well for _, well in batched.preassignBatch(tubes)]
+	for tube in tubes:
+		scanned.next(tube)
+		if scan_out:
+			scanned.next(tube)
+	assert placed(batched) == placed(scanned)
+	assert wells == ["B1", "A3", "C1", "D1", "E1", "F1"]
+	assert batched.scanned_out == scanned.scanned_out
+	# one undo step for the whole rack
+	batched.undoSteps(1)
+	assert placed(batched) == [("T0", "A1", "discarded")]
+
+
+def test_step_through_the_batch(make_ttw, tmp_path):
+	ttw = make_ttw(template=TEMPLATE)
+	assert ttw.stepBatch() is None
+	driver = ScanDriver(ttw, user="test")
+	driver.execute("!rack %s" % write_rack(tmp_path / "rack.csv", ["T1", "3", "T2"]))
+	steps = []
+	for _ in range(3):
+		steps.append(ttw.stepBatch())
+		assert ttw.tp.lightup_well == steps[-1][1]
+	assert steps == [("T1", "A1"), ("3", "A3"), ("T2", "B1")]
+	assert ttw.msg == "Tube 3 of 3: T2 -> B1"
+	assert driver.execute("!step")[3] == "No more tubes in the rack"
+	assert ttw.batch is None and ttw.tp.lightup_well is None
+	assert ttw.stepBatch() is None
@@ -0,0 +1,37 @@
+"""The headless driver, TubeToWellCLI.py."""
+
+import json, os
+
+from conftest import ROOT
+import TubeToWellCLI
+
+
+def config_file(tmp_path, **entries):
+	with open(os.path.join(ROOT, "configs", "DEFAULT_CONFIG.json")) as default:
+		config = json.load(default)
+	config.update(entries)
+	path = tmp_path / "config.json"
+	path.write_text(json.dumps(config))
+	return str(path)
+
+
+def test_scans_from_a_file(tmp_path, monkeypatch, capsys):
+	monkeypatch.chdir(ROOT)
+	scans = tmp_path / "scans.txt"
+	scans.write_text("TUBE1\nTUBE1\nTUBE2\n!undo\n")
+	status = TubeToWellCLI.main(["--records-dir", str(tmp_path / "records"), str(scans)])
+	out = capsys.readouterr().out
+	assert status == 0
+	assert "TUBE1 -> A1" in out
+	# only the operation lines and the timing summary, nothing else
+	assert "TUBE1\n" not in out
+
+
+def test_invalid_plate_barcode_fails_setup(tmp_path, monkeypatch, capsys):
+	monkeypatch.chdir(ROOT)
+	config = config_file(tmp_path, barcode_rules={"plate": {"pattern": "P[0-9]{6}"}})
+	status = TubeToWellCLI.main(
+		["--config", config, "--records-dir", str(tmp_path / "records"), "--plate", "BAD", os.devnull]
+	)
+	assert status == 2
+	assert "Setup failed" in capsys.readouterr().err
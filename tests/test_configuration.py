@@ -0,0 +1,207 @@
+"""Configuration files (Configuration.py): validation, migration to a new release and watching for edits."""
+
+import copy, glob, json, os, time
+
+import pytest
+
+from conftest import ROOT
+import Configuration
+from Configuration import CONFIG_VERSION, ConfigError, ConfigWatcher, load_config, migrate_config, parse_config
+
+SHIPPED = sorted(glob.glob(os.path.join(ROOT, "configs", "*.json")))
+# entries the shipped files gained after the first release
+ADDED_SINCE = ("fill_order", "check_previous_plates")
+
+
+def read_json(path):
+	with open(path) as json_file:
+		return json.load(json_file)
+
+
+def default_config():
+	return read_json(os.path.join(ROOT, "configs", "DEFAULT_CONFIG.json"))
+
+
+def compare_dict_and_update(dict_new, dict_old):
+	"""The merge update.py did before migrate_config, as it was written."""
+	keys = dict_new.keys()
+	for key in keys:
+		if key in dict_old:
+			if isinstance(dict_new[key], dict) and isinstance(dict_old[key], dict):
+				compare_dict_and_update(dict_new[key], dict_old[key])
+			elif isinstance(dict_new[key], dict) and not isinstance(dict_old[key], dict):
+				dict_old[key] = dict_new[key]
+			elif not isinstance(dict_new[key], dict) and isinstance(dict_old[key], dict):
+				dict_old[key] = dict_new[key]
+		else:
+			dict_old[key] = dict_new[key]
+
+
+def first_release(config):
+	"""A configuration file as the first release wrote it."""
+	config = copy.deepcopy(config)
+	for key in ADDED_SINCE + ("config_version",):
+		config.pop(key, None)
+	return config
+
+
+@pytest.mark.parametrize("path", SHIPPED, ids=os.path.basename)
+@pytest.mark.parametrize("release", ["first release", "current"])
+def test_migration_matches_the_old_merge(path, release):
+	defaults = default_config()
+	config = read_json(path)
+	if release == "first release":
+		config = first_release(config)
+	# the user's own values are kept
+	config["records_dir"] = "D:\\Records\\"
+	config["96"]["well_spacing"] = 0.05
+	config["384"] = "not a block"
+	original = copy.deepcopy(config)
+
+	expected = copy.deepcopy(config)
+	compare_dict_and_update(copy.deepcopy(defaults), expected)
+	expected["config_version"] = CONFIG_VERSION
+	migrated, notes = migrate_config(config, defaults)
+	assert migrated == expected
+	assert config == original
+	assert parse_config(migrated).num_wells == str(config["num_wells"])
+	if release == "first release":
+		assert "added fill_order, check_previous_plates" in notes
+	else:
+		assert notes == []
+
+
+def test_migration_fixes_older_files():
+	config = first_release(default_config())
+	config["controls"] = ""
+	config["num_wells"] = 384
+	migrated, notes = migrate_config(config, default_config())
+	assert (migrated["controls"], migrated["num_wells"]) == ([], "384")
+	assert notes[:2] == ['controls "" -> []', "num_wells written as text"]
+	# files already at the current version are left alone
+	config["config_version"] = CONFIG_VERSION
+	migrated, notes = migrate_config(config, default_config())
+	assert (migrated["controls"], migrated["num_wells"]) == ("", 384)
+
+
+def test_every_problem_is_reported():
+	data = default_config()
+	data.update(
+		{
+			"config_version": 99,
+			"controls": "A1",
+			"enable_scan_out": "yes",
+			"fill_order": "diagonal",
+			"custom_layout": {"rows": 0, "columns": 12},
+			"metrics_port": 70000,
+			"barcode_rules": {"box": {}},
+			"scanner_input": ["serial:COM3"],
+			"records_dir": 5,
+		}
+	)
+	del data["num_wells"]
+	data["96"] = {"A1_X_dest": "left"}
+	with pytest.raises(ConfigError) as error:
+		parse_config(data, "bad.json")
+	problems = error.value.problems
+	for problem in [
+		"config_version 99 is not supported",
+		"num_wells is missing",
+		"records_dir must be a folder path",
+		"controls must be a list of well names",
+		"enable_scan_out must be true or false",
+		"fill_order must be one of",
+		"custom_layout must give whole numbers of rows and columns",
+		"metrics_port must be a port number",
+		"barcode_rules: unknown entries box",
+		"serial:COM3",
+		"96",
+	]:
+		assert sum(problem in found for found in problems) == 1, problem
+	assert len(problems) == 11
+	assert str(error.value).startswith("bad.json: ")
+
+
+def test_suspicious_entries_are_warnings():
+	data = default_config()
+	data["colour"] = "blue"
+	data["num_wells"] = 100
+	config = parse_config(data)
+	assert config.warnings == ["num_wells 100 is not a standard plate, using 96 wells", "unknown entry colour"]
+	with pytest.raises(ConfigError, match="the file must contain a json object"):
+		parse_config([])
+
+
+def write_config(path, data):
+	with open(path, "w") as config_file:
+		json.dump(data, config_file)
+	# a new modification time even on coarse clocks
+	stamp = time.time() + write_config.edits
+	write_config.edits += 1
+	os.utime(path, (stamp, stamp))
+
+
+write_config.edits = 1
+
+
+def test_watcher_picks_up_changes_and_skips_bad_edits(tmp_path, caplog):
+	path = str(tmp_path / "config.json")
+	data = default_config()
+	write_config(path, data)
+	seen = []
+	watcher = ConfigWatcher(path, seen.append, interval=0.01)
+	assert watcher.poll() is None
+
+	data["enable_scan_out"] = False
+	write_config(path, data)
+	config = watcher.poll()
+	assert config is not None and not config.enable_scan_out
+	assert seen == [config]
+	assert watcher.poll() is None
+
+	# caught half way through being saved
+	text = json.dumps(dict(data, fill_order="row"))
+	with open(path, "w") as config_file:
+		config_file.write(text[: len(text) // 2])
+	assert watcher.poll() is None
+	# saved with a mistake
+	write_config(path, dict(data, fill_order="diagonal"))
+	assert watcher.poll() is None
+	assert seen == [config]
+	assert "not valid json" in caplog.text and "fill_order must be one of" in caplog.text
+
+	# a missing file (e.g. while an editor replaces it) is not a change either
+	os.remove(path)
+	assert watcher.poll() is None
+	write_config(path, dict(data, fill_order="row"))
+	assert watcher.poll().fill_order == "row"
+	assert [config.fill_order for config in seen] == ["column", "row"]
+
+
+def test_watcher_thread(tmp_path):
+	path = str(tmp_path / "config.json")
+	data = default_config()
+	write_config(path, data)
+	seen = []
+	watcher = ConfigWatcher(path, seen.append, interval=0.01).start()
+	try:
+		write_config(path, dict(data, num_wells="384"))
+		deadline = time.time() + 10
+		while not seen and time.time() < deadline:
+			time.sleep(0.01)
+	finally:
+		watcher.stop()
+	assert [config.num_wells for config in seen] == ["384"]
+	assert not watcher.thread.is_alive()
+
+
+def test_unchanged_file_is_not_parsed_again(tmp_path, monkeypatch):
+	path = str(tmp_path / "config.json")
+	write_config(path, default_config())
+	config = load_config(path)
+	parsed = []
+	monkeypatch.setattr(Configuration, "parse_config", lambda data, path=None: parsed.append(path) or config)
+	assert load_config(path) is config and parsed == []
+	Configuration.clear_config_cache()
+	load_config(path)
+	assert parsed == [path]
@@ -0,0 +1,105 @@
+"""IncrementalLighting updates a WellLit-style plate lighting layer well by well (IncrementalLighting.py)."""
+
+import logging, os, sys
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+from conftest import ROOT
+
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from bench_lighting import BenchPlate, BenchWell
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle
+
+from IncrementalLighting import IncrementalLighting
+
+
+class NoSingleWellPlate:
+	"""A layer that can only empty every well at once."""
+
+	def __init__(self):
+		self.calls = []
+
+	def emptyWells(self):
+		self.calls.append("emptyWells")
+
+	def markTarget(self, well):
+		self.calls.append(("markTarget", well))
+
+	def markFilled(self, well):
+		self.calls.append(("markFilled", well))
+
+	def show(self):
+		self.calls.append("show")
+
+
+def test_welllit_layer_is_updated_well_by_well(ttw):
+	lighting = IncrementalLighting(BenchPlate(96))
+	assert lighting.layer.incremental
+	lighting.update(ttw)
+	ttw.next("TUBE1")
+	lighting.update(ttw)
+	ttw.next("TUBE1")
+	lighting.update(ttw)
+	assert (lighting.full_redraws, lighting.partial_redraws) == (1, 2)
+	assert lighting.rendered == {"A1": "filled"}
+	ttw.undoSteps(2)
+	lighting.update(ttw)
+	assert lighting.rendered == {}
+	assert lighting.pl.wells["A1"].marker.get_facecolor() == matplotlib.colors.to_rgba("white")
+
+
+def test_layer_without_single_well_updates_warns_and_redraws(ttw, caplog):
+	plate = NoSingleWellPlate()
+	with caplog.at_level(logging.WARNING):
+		lighting = IncrementalLighting(plate)
+	assert not lighting.layer.incremental
+	assert "markEmpty" in caplog.text
+	lighting.update(ttw)
+	ttw.next("TUBE1")
+	lighting.update(ttw)
+	assert lighting.full_redraws == 2
+	assert plate.calls[-3:] == ["emptyWells", ("markTarget", "A1"), "show"]
+
+
+class StaleWell(BenchWell):
+	"""A Well whose markEmpty leaves its patch as it was."""
+
+	def markEmpty(self):
+		pass
+
+
+def test_layer_is_checked_before_updating_well_by_well(ttw, caplog):
+	plate = BenchPlate(96)
+	lighting = IncrementalLighting(plate)
+	assert not lighting.layer.verified
+	lighting.update(ttw)
+	assert lighting.layer.verified and lighting.layer.incremental
+
+	# a Well.markEmpty that doesn't empty the well's patch
+	plate = BenchPlate(96)
+	plate.wells = {name: StaleWell(well.marker) for name, well in plate.wells.items()}
+	lighting = IncrementalLighting(plate)
+	assert lighting.layer.incremental
+	with caplog.at_level(logging.WARNING):
+		lighting.update(ttw)
+	assert not lighting.layer.incremental
+	assert "single well updates" in caplog.text
+	ttw.next("TUBE1")
+	lighting.update(ttw)
+	assert (lighting.full_redraws, lighting.partial_redraws) == (2, 0)
+
+
+def test_patches_on_another_figure_are_not_blitted(ttw, caplog):
+	plate = BenchPlate(96)
+	other = Figure().add_subplot(111)
+	for well in plate.wells.values():
+		well.marker = other.add_patch(Circle((0, 0), 0.4))
+	with caplog.at_level(logging.WARNING):
+		lighting = IncrementalLighting(plate)
+	assert not lighting.layer.incremental
+	assert "Well.marker" in caplog.text
+	lighting.update(ttw)
+	assert lighting.full_redraws == 1
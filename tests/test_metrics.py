@@ -0,0 +1,160 @@
+"""Per-operation metrics (Metrics.py): counters and histograms, the JSON-lines file and the Prometheus text."""
+
+import json, os, re, socket, time, urllib.error, urllib.request
+
+import pytest
+from WellLit.Transfer import TError
+
+from Metrics import BUCKETS, METRICS, EventWriter, instrument
+
+
+@pytest.fixture
+def metrics():
+	METRICS.close()
+	METRICS.reset()
+	yield METRICS
+	METRICS.close()
+	METRICS.reset()
+
+
+@instrument("square")
+def square(x):
+	if x is None:
+		raise TError("no number")
+	return x * x
+
+
+def call_square(*values):
+	for value in values:
+		try:
+			square(value)
+		except TError:
+			pass
+
+
+def free_port():
+	with socket.socket() as probe:
+		probe.bind(("127.0.0.1", 0))
+		return probe.getsockname()[1]
+
+
+def test_nothing_is_recorded_while_disabled(metrics):
+	call_square(1, None)
+	assert metrics.snapshot() == {}
+	metrics.configure(counters=True)
+	metrics.configure()
+	assert not metrics.enabled
+	call_square(2)
+	assert metrics.snapshot() == {}
+
+
+def test_counts_and_histogram(metrics):
+	metrics.configure(counters=True)
+	assert square(3) == 9
+	call_square(4, None)
+	stats = metrics.snapshot()["square"]
+	assert stats["count"] == 3
+	assert stats["outcomes"] == {"ok": 2, "TError": 1}
+	assert sum(stats["buckets"]) == 3 and len(stats["buckets"]) == len(BUCKETS) + 1
+	assert stats["total_s"] > 0 and stats["last_call"] is not None
+
+	metrics.observe("fixed", 0.0003)
+	metrics.observe("fixed", 0.001)
+	metrics.observe("fixed", 10.0, "ValueError")
+	fixed = metrics.snapshot()["fixed"]
+	# a duration lands in the first bucket whose upper bound it doesn't exceed
+	assert [i for i, count in enumerate(fixed["buckets"]) for _ in range(count)] == [2, 3, len(BUCKETS)]
+	assert fixed["total_s"] == pytest.approx(10.0013)
+
+
+def test_scans_are_counted(metrics, ttw):
+	metrics.configure(counters=True)
+	ttw.next("T1")
+	with pytest.raises(TError):
+		ttw.next("")
+	operations = metrics.snapshot()
+	assert operations["next"]["outcomes"] == {"ok": 1, "TError": 1}
+	assert operations["TTWTransferProtocol.next"]["outcomes"]["ok"] == 1
+
+
+def test_json_lines(metrics, tmp_path):
+	path = str(tmp_path / "metrics.jsonl")
+	metrics.configure(metrics_file=path)
+	assert metrics.enabled
+	call_square(5, None, 6)
+	metrics.closeFile()
+	with open(path, encoding="utf-8") as lines:
+		events = [json.loads(line) for line in lines]
+	assert [(event["op"], event["outcome"]) for event in events] == [("square", "ok"), ("square", "TError"), ("square", "ok")]
+	for event in events:
+		assert set(event) == {"ts", "op", "ms", "outcome"}
+		assert event["ms"] >= 0 and event["ts"] > 0
+
+
+def test_json_lines_are_rotated(tmp_path):
+	path = str(tmp_path / "metrics.jsonl")
+	writer = EventWriter(path, max_bytes=200, backups=2)
+
+	def written():
+		ops = []
+		for name in (path + ".2", path + ".1", path):
+			if os.path.exists(name):
+				with open(name, encoding="utf-8") as lines:
+					ops += [json.loads(line)["op"] for line in lines]
+		return ops
+
+	for i in range(20):
+		writer.put((1700000000.0 + i, "op%s" % i, 0.001, "ok"))
+		# one write per event, as when scans come in one at a time
+		deadline = time.time() + 10
+		while written()[-1:] != ["op%s" % i] and time.time() < deadline:
+			time.sleep(0.001)
+	writer.close()
+	ops = written()
+	assert os.path.exists(path + ".2")
+	assert 2 < len(ops) < 20 and ops == ["op%s" % i for i in range(20 - len(ops), 20)]
+	assert not os.path.exists(path + ".3")
+
+
+def test_prometheus_text(metrics):
+	port = free_port()
+	metrics.configure(port=port)
+	assert metrics.enabled and metrics.port == port
+	call_square(1, 2, None)
+	metrics.addCollector(lambda: [("test_gauge", "gauge", "A test gauge.", 7)])
+	try:
+		with urllib.request.urlopen("http://127.0.0.1:%s/metrics" % port, timeout=10) as response:
+			assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+			text = response.read().decode("utf-8")
+		with pytest.raises(urllib.error.HTTPError):
+			urllib.request.urlopen("http://127.0.0.1:%s/other" % port, timeout=10)
+	finally:
+		metrics.collectors.pop()
+
+	assert text.endswith("\n")
+	samples = {}
+	types = {}
+	for line in text.splitlines():
+		if line.startswith("# TYPE "):
+			_, _, name, kind = line.split(" ")
+			assert name not in types
+			types[name] = kind
+		elif not line.startswith("# HELP "):
+			name, value = line.rsplit(" ", 1)
+			assert re.fullmatch(r'[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})?', name), line
+			samples[name] = float(value)
+	assert types["ttw_operation_calls_total"] == "counter"
+	assert types["ttw_operation_duration_seconds"] == "histogram"
+	assert types["ttw_operation_last_call_timestamp_seconds"] == "gauge"
+	assert types["ttw_test_gauge"] == "gauge" and samples["ttw_test_gauge"] == 7
+	assert samples['ttw_operation_calls_total{operation="square",outcome="ok"}'] == 2
+	assert samples['ttw_operation_calls_total{operation="square",outcome="TError"}'] == 1
+	buckets = [samples['ttw_operation_duration_seconds_bucket{operation="square",le="%s"}' % bound] for bound in BUCKETS + ("+Inf",)]
+	assert buckets == sorted(buckets) and buckets[-1] == 3
+	assert samples['ttw_operation_duration_seconds_count{operation="square"}'] == 3
+	assert samples['ttw_operation_duration_seconds_sum{operation="square"}'] > 0
+
+	metrics.configure()
+	assert metrics.server is None
+	with pytest.raises(OSError):
+		urllib.request.urlopen("http://127.0.0.1:%s/metrics" % port, timeout=2)
@@ -0,0 +1,112 @@
+"""Several plates in progress at once (PlateSessions.py): the tube index across plates, switching and finishing."""
+
+import pytest
+from WellLit.Transfer import TError
+
+from conftest import ROOT
+from PlateSessions import PlateSessionManager
+
+
+@pytest.fixture
+def plates(tmp_path, monkeypatch):
+	monkeypatch.chdir(ROOT)
+	from TubeToWellCLI import build_ttw
+
+	ttw = build_ttw(records_dir=str(tmp_path / "records"))
+	ttw.enable_scan_out = False
+	manager = PlateSessionManager(ttw)
+	yield manager
+	ttw.record_writer.flush()
+	for plate_barcode in list(manager.plates):
+		manager.switchPlate(plate_barcode)
+		ttw.endSession()
+
+
+def well_of(ttw, barcode):
+	return ttw.tp.findTransferByBarcode(barcode)["dest_well"]
+
+
+def test_tube_on_another_open_plate_is_rejected(plates):
+	ttw = plates.ttw
+	plates.startPlate("P1", "test")
+	ttw.next("T1")
+	plates.startPlate("P2", "test")
+	with pytest.raises(TError, match="T1.*well A1 of plate P1"):
+		ttw.next("T1")
+	assert ttw.tp.findTransferByBarcode("T1") is None
+	ttw.next("T2")
+	assert plates.tubes.platesWith("T1") == {"P1": "A1"}
+	assert plates.tubes.platesWith("T2") == {"P2": "A1"}
+	# and the other way round
+	plates.switchPlate("P1")
+	with pytest.raises(TError, match="plate P2"):
+		ttw.next("T2")
+
+
+def test_same_plate_twice_is_rejected(plates):
+	plates.startPlate("P1", "test")
+	with pytest.raises(TError, match="already in progress"):
+		plates.startPlate("P1", "test")
+	with pytest.raises(TError, match="not in progress"):
+		plates.switchPlate("P2")
+
+
+def test_switching_keeps_each_plate(plates):
+	ttw = plates.ttw
+	plates.startPlate("P1", "test")
+	ttw.next("T1")
+	ttw.next("T2")
+	p1 = ttw.tp
+	plates.startPlate("P2", "test")
+	assert ttw.tp is not p1 and ttw.plate_barcode == "P2"
+	ttw.next("T3")
+	plates.switchPlate("P1")
+	assert ttw.tp is p1 and ttw.plate_barcode == "P1"
+	ttw.next("T4")
+	assert [well_of(ttw, tube) for tube in ("T1", "T2", "T4")] == ["A1", "B1", "C1"]
+	plates.switchPlate("P2")
+	assert well_of(ttw, "T3") == "A1"
+	ttw.tp.checkInvariants()
+
+
+def test_finishing_falls_back_to_the_last_plate_started(plates):
+	ttw = plates.ttw
+	for plate_barcode, tube in [("P1", "T1"), ("P2", "T2"), ("P3", "T3")]:
+		plates.startPlate(plate_barcode, "test")
+		ttw.next(tube)
+	plates.switchPlate("P1")
+	assert plates.finishPlate() == "P3"
+	assert ttw.plate_barcode == "P3" and well_of(ttw, "T3") == "A1"
+	# a finished plate's tubes can go into another plate
+	assert plates.tubes.platesWith("T1") == {}
+	assert plates.finishPlate("P2") == "P3"
+	assert list(plates.plates) == ["P3"]
+	ttw.next("T2")
+	assert plates.finishPlate() is None
+	assert len(plates) == 0 and ttw.plate_barcode == ""
+
+
+def test_tube_index_after_undo(plates):
+	ttw = plates.ttw
+	plates.startPlate("P1", "test")
+	ttw.next("T1")
+	ttw.undo()
+	assert plates.tubes.platesWith("T1") == {}
+	plates.startPlate("P2", "test")
+	ttw.next("T1")
+	assert plates.tubes.platesWith("T1") == {"P2": "A1"}
+
+
+def test_tube_index_after_discard(plates):
+	ttw = plates.ttw
+	plates.startPlate("P1", "test")
+	ttw.next("T1")
+	ttw.next("T2")
+	ttw.discardSpecificWell("A1")
+	assert plates.tubes.platesWith("T1") == {}
+	assert plates.tubes.platesWith("T2") == {"P1": "B1"}
+	plates.startPlate("P2", "test")
+	ttw.next("T1")
+	with pytest.raises(TError, match="plate P1"):
+		ttw.next("T2")
+	assert plates.tubes.platesWith("T1") == {"P2": "A1"}
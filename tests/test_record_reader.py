@@ -0,0 +1,127 @@
+"""Reading records directories (RecordReader.py): the row conventions and the process pool."""
+
+import csv, datetime, gzip, random
+
+import pytest
+
+from conftest import ROOT
+import RecordReader
+from RecordReader import RecordRow, export_records, read_record_file, read_warning_file, stream_records
+from TransferRecords import record_metadata
+
+METADATA = record_metadata("20250101-100000", "test", "P1")
+
+
+def write_csv(path, rows):
+	with open(path, "w", newline="") as csv_file:
+		csv.writer(csv_file).writerows(rows)
+	return str(path)
+
+
+def row(timestamp, tube, well, status):
+	plate_timestamp = datetime.datetime(2025, 1, 1, 10, 0, 0)
+	return RecordRow(
+		"record", "20250101-100000_P1_tube_to_plate", "P1", "test", plate_timestamp, timestamp, tube, well, status, None
+	)
+
+
+def test_discarded_and_empty_rows(tmp_path):
+	path = write_csv(
+		tmp_path / "20250101-100000_P1_tube_to_plate.csv",
+		METADATA
+		+ [
+			["2025-01-01 10:00:01", "T1", "A1"],
+			["2025-01-01 10:00:02", "T2-discarded", "B1"],
+			["2025-01-01 10:00:03", "EMPTY", "C1"],
+			["2025-01-01 10:00:04", "EMPTY-discarded", "D1"],
+			["", "", "E1"],
+			["too short"],
+		],
+	)
+	at = lambda second: datetime.datetime(2025, 1, 1, 10, 0, second)
+	assert read_record_file(path) == [
+		row(at(1), "T1", "A1", "completed"),
+		row(at(2), "T2", "B1", "discarded"),
+		row(at(3), None, "C1", "empty"),
+		row(at(4), None, "D1", "empty"),
+		row(None, None, "E1", "completed"),
+	]
+
+
+def test_plate_in_progress_is_read_from_its_journal(tmp_path):
+	path = str(tmp_path / "20250101-100000_P1_tube_to_plate.csv")
+	write_csv(
+		path + ".journal",
+		METADATA
+		+ [
+			["2025-01-01 10:00:01", "T1", "A1", "completed"],
+			["2025-01-01 10:00:02", "T2", "B1", "started"],
+			["2025-01-01 10:00:03", "EMPTY", "C1", "discarded"],
+			["", "", "A1", "uncompleted"],
+		],
+	)
+	rows = read_record_file(path)
+	assert [(r.tube, r.well, r.status) for r in rows] == [("T2", "B1", "started"), (None, "C1", "empty")]
+
+
+def test_warning_rows(tmp_path):
+	path = write_csv(
+		tmp_path / "20250101-100000_P1_tube_to_plate_WARNING.csv",
+		METADATA
+		+ [
+			["Timestamp", "Source Tube", "Plate", "Well", "Status"],
+			["2025-01-01 10:00:01", "T1", "P1", "A1", "started", " Marked Undone at 20250101-100005"],
+			["2025-01-01 10:00:02", "T2-discarded", "P1", "B1", "completed", " Marked Undone at 20250101-100006"],
+		],
+	)
+	rows = read_warning_file(path)
+	assert [(r.kind, r.tube, r.well, r.status) for r in rows] == [
+		("warning", "T1", "A1", "started"),
+		("warning", "T2", "B1", "discarded"),
+	]
+	assert rows[0].undone_at == datetime.datetime(2025, 1, 1, 10, 0, 5)
+
+
+def test_other_csvs_are_not_records(tmp_path):
+	path = write_csv(tmp_path / "samples_tube_to_plate.csv", [["Sample"], ["T1"]])
+	assert read_record_file(path) == []
+
+
+@pytest.fixture
+def records_dir(tmp_path, monkeypatch):
+	"""A records directory of finished and unfinished plates with undone tubes, more than PARALLEL_THRESHOLD files."""
+	from TubeToWellCLI import ScanDriver, build_ttw
+
+	monkeypatch.chdir(ROOT)
+	directory = str(tmp_path / "records")
+	rnd = random.Random(1)
+	ttw = build_ttw(records_dir=directory)
+	driver = ScanDriver(ttw, user="test")
+	for plate in range(RecordReader.PARALLEL_THRESHOLD + 4):
+		driver.execute("!plate P%03d" % plate)
+		for _ in range(rnd.randint(3, 40)):
+			driver.execute(rnd.choice(["T%04d" % rnd.randint(0, 9999)] * 6 + ["!undo", "!skip", "!discard-last"]))
+		if plate % 3:
+			driver.execute("!finish")
+	ttw.record_writer.flush()
+	return directory
+
+
+def test_process_pool_reads_what_the_serial_path_reads(records_dir):
+	paths = RecordReader.find_record_files(records_dir)
+	assert len(paths) >= RecordReader.PARALLEL_THRESHOLD
+	assert any(path.endswith("_WARNING.csv") for path in paths)
+	serial = list(stream_records(records_dir, workers=1))
+	assert {row.status for row in serial} >= {"completed", "started", "discarded", "empty"}
+	assert list(stream_records(records_dir, workers=2)) == serial
+	assert list(stream_records(records_dir, warnings=False, workers=2)) == [row for row in serial if row.kind == "record"]
+
+
+def test_export_csv(records_dir, tmp_path):
+	rows = list(stream_records(records_dir, workers=1))
+	output = str(tmp_path / "all.csv.gz")
+	assert export_records(iter(rows), output) == len(rows)
+	with gzip.open(output, "rt", newline="") as exported:
+		table = list(csv.reader(exported))
+	assert tuple(table[0]) == RecordReader.RECORD_FIELDS
+	assert len(table) == len(rows) + 1
@@ -0,0 +1,92 @@
+"""Loading sample lists through the memory-mapped index cache (SampleManifest.py)."""
+
+import os
+
+import pytest
+from WellLit.Transfer import TError, TConfirm
+import SampleManifest
+from SampleManifest import MappedSampleIndex, index_path, load_sample_index
+
+
+def write_samples(path, samples):
+	path.write_text("sampleList\n" + "".join("%s\n" % sample for sample in samples))
+
+
+def load(ttw, path):
+	try:
+		ttw.loadCSV(str(path))
+	except TConfirm:
+		pass
+	return ttw.sample_list
+
+
+def test_reloading_closes_the_previous_index(ttw, tmp_path):
+	ttw.cache_dir = str(tmp_path / "cache")
+	samples = tmp_path / "samples.csv"
+	write_samples(samples, ["S1", "S2"])
+	first = load(ttw, samples)
+	assert isinstance(first, MappedSampleIndex)
+
+	# an edited list rebuilds the cached index in place of the one still loaded
+	write_samples(samples, ["S1", "S2", "S3"])
+	second = load(ttw, samples)
+	assert first._mmap.closed
+	assert isinstance(second, MappedSampleIndex)
+	assert "S3" in second and len(second) == 3
+
+
+def test_reset_closes_the_index(ttw, tmp_path):
+	ttw.cache_dir = str(tmp_path / "cache")
+	samples = tmp_path / "samples.csv"
+	write_samples(samples, ["S1"])
+	index = load(ttw, samples)
+	ttw.reset()
+	assert ttw.sample_list is None
+	assert index._mmap.closed
+
+
+def test_failed_load_leaves_no_sample_list(ttw, tmp_path):
+	ttw.cache_dir = str(tmp_path / "cache")
+	samples = tmp_path / "samples.csv"
+	write_samples(samples, ["S1"])
+	load(ttw, samples)
+	with pytest.raises(TError):
+		ttw.loadCSV(str(tmp_path / "missing.csv"))
+	assert ttw.sample_list is None
+
+
+def test_touched_manifest_is_hashed_once(tmp_path, monkeypatch):
+	cache_dir = str(tmp_path / "cache")
+	samples = tmp_path / "samples.csv"
+	write_samples(samples, ["S%05d" % i for i in range(1000)])
+	load_sample_index(str(samples), cache_dir).close()
+
+	hashed = []
+	file_sha256 = SampleManifest.file_sha256
+	monkeypatch.setattr(SampleManifest, "file_sha256", lambda filename: hashed.append(filename) or file_sha256(filename))
+	rebuilt = []
+	load_sample_manifest = SampleManifest.load_sample_manifest
+	monkeypatch.setattr(
+		SampleManifest, "load_sample_manifest", lambda filename: rebuilt.append(filename) or load_sample_manifest(filename)
+	)
+	# saved again without changes
+	stamp = os.stat(samples).st_mtime_ns + 5 * 10**9
+	os.utime(samples, ns=(stamp, stamp))
+	for _ in range(3):
+		index = load_sample_index(str(samples), cache_dir)
+		assert isinstance(index, MappedSampleIndex)
+		assert index.source_mtime == stamp and "S00999" in index and "S01000" not in index
+		index.close()
+	# the index header was updated in place, nothing was rebuilt
+	assert hashed == [str(samples)] and rebuilt == []
+	on_disk = MappedSampleIndex(index_path(str(samples), cache_dir))
+	assert on_disk.source_mtime == stamp
+	on_disk.close()
+
+	# same size and a new mtime, different contents: rebuilt
+	write_samples(samples, ["T%05d" % i for i in range(1000)])
+	os.utime(samples, ns=(stamp + 10**9, stamp + 10**9))
+	index = load_sample_index(str(samples), cache_dir)
+	assert "T00000" in index and "S00000" not in index
+	assert rebuilt == [str(samples)]
+	index.close()
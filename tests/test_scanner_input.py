@@ -0,0 +1,117 @@
+"""The scanner input service (ScannerInput.py): line splitting, sources, error handling and a 50 scans/sec stress run."""
+
+import logging, os, socket, sys, time
+
+import pytest
+
+from conftest import ROOT
+from ScannerInput import LineSplitter, ScannerInput, SocketSource, ThreadedSource, parse_source
+
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from bench_scanner_input import stress
+
+SOURCES = [
+	pytest.param("fifo", marks=pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="no named pipes")),
+	"tcp",
+	pytest.param("unix", marks=pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")),
+]
+
+
+def wait_for(condition, timeout=10.0):
+	deadline = time.time() + timeout
+	while not condition() and time.time() < deadline:
+		time.sleep(0.01)
+	return condition()
+
+
+def test_line_ends():
+	splitter = LineSplitter()
+	assert splitter.feed(b"TUBE1\rTUBE2\nTUBE3\r\nTUBE4\n") == ["TUBE1", "TUBE2", "TUBE3", "TUBE4"]
+	assert splitter.partial == b""
+
+
+def test_partial_lines_are_kept_across_reads():
+	splitter = LineSplitter()
+	assert splitter.feed(b"TU") == []
+	assert splitter.feed(b"BE1") == []
+	assert splitter.feed(b"\r\nTUBE2\r") == ["TUBE1", "TUBE2"]
+	# the LF of a CRLF split over two reads is not another scan
+	assert splitter.feed(b"\nTUBE3") == []
+	assert splitter.flush() == ["TUBE3"]
+	assert splitter.flush() == []
+
+
+def test_blank_lines_and_bad_bytes():
+	splitter = LineSplitter()
+	assert splitter.feed(b"\r\n\n  TUBE1 \r\n\xffTUBE2\n") == ["TUBE1", "�TUBE2"]
+
+
+def test_parse_sources():
+	tcp = parse_source("tcp:5555")
+	assert isinstance(tcp, SocketSource) and (tcp.host, tcp.port, tcp.path) == ("127.0.0.1", 5555, None)
+	tcp = parse_source("tcp:0.0.0.0:5556")
+	assert (tcp.host, tcp.port) == ("0.0.0.0", 5556)
+	device = parse_source("device:/dev/ttyACM0")
+	assert isinstance(device, ThreadedSource) and (device.path, device.baudrate) == ("/dev/ttyACM0", None)
+	device = parse_source("device:COM3@9600")
+	assert (device.path, device.baudrate) == ("COM3", 9600)
+	for spec in ("stdin", "-"):
+		stdin = parse_source(spec)
+		assert isinstance(stdin, ThreadedSource) and stdin.path is None
+	if hasattr(socket, "AF_UNIX"):
+		assert parse_source("unix:/tmp/scanner.sock").path == "/tmp/scanner.sock"
+
+
+@pytest.mark.parametrize(
+	"spec", ["tcp:", "tcp:scanner", "tcp:70000", "unix:", "device:", "device:COM3@fast", "serial:COM3", "", 5555]
+)
+def test_invalid_sources(spec):
+	with pytest.raises(ValueError):
+		parse_source(spec)
+
+
+def test_failing_handler_does_not_stop_delivery(caplog):
+	delivered = []
+
+	def handler(scan):
+		if scan.barcode == "BAD":
+			raise ValueError("not a tube")
+		delivered.append((scan.sequence, scan.barcode))
+
+	service = ScannerInput(handler, ["tcp:0"]).start()
+	client = socket.create_connection(("127.0.0.1", service.sources[0].port))
+	with caplog.at_level(logging.ERROR):
+		client.sendall(b"TUBE1\nBAD\r\nTUBE2")
+		client.close()
+		assert wait_for(lambda: len(delivered) == 2)
+		service.stop()
+	assert delivered == [(1, "TUBE1"), (3, "TUBE2")]
+	assert service.stats()["failed"] == 1
+	assert service.stats()["delivered"] == 2
+	assert "Scan BAD" in caplog.text and "not a tube" in caplog.text
+
+
+def test_source_that_cannot_be_read(tmp_path, caplog):
+	service = ScannerInput(lambda scan: None, ["device:%s" % (tmp_path / "missing")])
+	with caplog.at_level(logging.ERROR):
+		service.start()
+		service.thread.join(10)
+	assert not service.thread.is_alive()
+	assert "Scanner source device:" in caplog.text
+
+
+def test_source_that_cannot_be_opened():
+	with socket.socket() as taken:
+		taken.bind(("127.0.0.1", 0))
+		taken.listen()
+		with pytest.raises(OSError):
+			ScannerInput(lambda scan: None, ["tcp:%s" % taken.getsockname()[1]]).start()
+
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_no_scan_lost_at_50_per_second(tmp_path, monkeypatch, source):
+	monkeypatch.chdir(ROOT)
+	run = stress(str(tmp_path), rate=50, seconds=3, source=source)
+	assert run["delivered"] == run["lines"]
+	assert run["stats"]["failed"] == 0 and run["stats"]["dropped"] == 0
+	assert run["completed"] >= set(run["lines"])
@@ -0,0 +1,175 @@
+"""Resuming an unfinished plate from its session journal (SessionJournal.py, TubeToWell.resumeSession)."""
+
+import os, random, shutil
+
+import pytest
+from WellLit.Transfer import TError
+
+from SessionJournal import read_session, session_path
+from TransferRecords import read_transfer_journal
+from TubeToWellCLI import ScanDriver, build_ttw
+
+TEMPLATE = "templates/example_template.csv"
+
+
+def random_lines(seed, count=150):
+	"""Scans and control commands in the form ScanDriver.execute takes them."""
+	rnd = random.Random(seed)
+	lines = []
+	for _ in range(count):
+		r = rnd.random()
+		if r < 0.65:
+			lines.append("T%04d" % rnd.randint(0, 200))
+		elif r < 0.75:
+			lines.append("!undo")
+		elif r < 0.8:
+			lines.append("!undo-scan")
+		elif r < 0.85:
+			lines.append("!skip")
+		elif r < 0.9:
+			lines.append("!discard-last")
+		else:
+			lines.append(rnd.choice(["!rollback %d" % rnd.randint(1, 4), "!redo %d" % rnd.randint(1, 3)]))
+	return lines
+
+
+def plate_state(ttw):
+	tp = ttw.tp
+	return {
+		"tf_seq": list(tp.tf_seq),
+		"current": tp._current_idx,
+		"scanned_out": ttw.scanned_out,
+		"can_undo": tp.canUndo,
+		"lightup_well": tp.lightup_well,
+		# an uncompleted well's timestamp isn't recorded anywhere
+		"transfers": [
+			(tf["source_tube"], tf["dest_well"], tf["status"], tf["timestamp"] if tf["status"] != "uncompleted" else None)
+			for tf in tp.orderedTransfers()
+		],
+		"lists": {status: sorted(ids) for status, ids in tp.lists.items()},
+	}
+
+
+def recorded_rows(ttw):
+	"""The record rows on disk, by well."""
+	metadata, rows = read_transfer_journal(ttw.recordPaths()[0])
+	return metadata, {row[2]: row for row in rows}
+
+
+def transfer_rows(ttw):
+	"""The record rows the plate's transfers should have, by well."""
+	keys = ["timestamp", "source_tube", "dest_well", "status"]
+	return {
+		tf["dest_well"]: [tf[key] or "" for key in keys] for tf in ttw.tp.orderedTransfers() if tf["status"] != "uncompleted"
+	}
+
+
+def drop(ttw):
+	"""Leaves the plate unfinished, as if the app had died once the queued record writes were on disk."""
+	ttw.record_writer.flush()
+	state = plate_state(ttw)
+	state["rows"] = transfer_rows(ttw)
+	state["metadata"] = recorded_rows(ttw)[0]
+	path = session_path(ttw.records_dir, ttw.csv)
+	ttw.session.close()
+	ttw.session = None
+	return path, state
+
+
+def check_resumed(resumed, expected):
+	assert plate_state(resumed) == {key: value for key, value in expected.items() if key not in ("rows", "metadata")}
+	# the record is brought up to date with the rebuilt plate, e.g. a scan out not written yet
+	assert recorded_rows(resumed) == (expected["metadata"], expected["rows"])
+	resumed.tp.checkInvariants()
+
+
+def resume(path, num_wells="96"):
+	resumed = build_ttw(records_dir=os.path.dirname(path))
+	resumed.num_wells = num_wells
+	resumed.resumeSession(path)
+	resumed.record_writer.flush()
+	return resumed
+
+
+@pytest.mark.parametrize("template", [None, TEMPLATE], ids=["no template", "template"])
+@pytest.mark.parametrize("seed", range(5))
+def test_resume_rebuilds_the_plate(make_ttw, seed, template):
+	num_wells = 384 if seed == 4 else 96
+	ttw = make_ttw(template=template, num_wells=num_wells)
+	if seed == 3:
+		# the session header keeps the setting the plate was started with
+		ttw.enable_scan_out = False
+		ttw.startSession()
+	driver = ScanDriver(ttw, user="test")
+	for line in random_lines(seed):
+		driver.execute(line)
+	path, expected = drop(ttw)
+
+	resumed = resume(path, str(num_wells))
+	check_resumed(resumed, expected)
+	resumed.endSession()
+
+
+def test_truncated_last_line_is_ignored(make_ttw):
+	ttw = make_ttw()
+	for tube in ["T1", "T1", "T2", "T2"]:
+		ttw.next(tube)
+	path, expected = drop(ttw)
+	# a crash while the next action was being written
+	with open(path, "a", encoding="utf-8") as session:
+		session.write('{"op": "next", "args": ["T3"], "ti')
+	assert len(read_session(path)[1]) == 4
+
+	resumed = resume(path)
+	check_resumed(resumed, expected)
+	resumed.next("T3")
+	assert resumed.tp.findTransferByBarcode("T3")["dest_well"] == "C1"
+	resumed.endSession()
+	assert not os.path.exists(path)
+
+
+def test_different_plate_layout_is_refused(make_ttw):
+	ttw = make_ttw()
+	ttw.next("T1")
+	path, _ = drop(ttw)
+	other = build_ttw(records_dir=ttw.records_dir)
+	other.num_wells = "384"
+	with pytest.raises(TError, match="96 well plate.*384 well plate"):
+		other.resumeSession(path)
+	assert other.csv == "" and other.tp.lists["started"] == []
+	other.fill_order = "row"
+	other.num_wells = "96"
+	with pytest.raises(TError, match="fill order"):
+		other.resumeSession(path)
+	assert other.findResumableSession() is None
+
+
+def test_changed_template_is_refused(make_ttw, tmp_path):
+	template = str(tmp_path / "template.csv")
+	shutil.copy(TEMPLATE, template)
+	ttw = make_ttw()
+	ttw.loadWellConfigurationCSV(template)
+	ttw.next("T1")
+	path, expected = drop(ttw)
+	assert resume(path).tp.findTransferByBarcode("T1") is not None
+
+	with open(template, "a") as changed:
+		changed.write("H12,Not Available,\n")
+	with pytest.raises(TError, match="changed since it was loaded"):
+		resume(path)
+	os.remove(template)
+	with pytest.raises(TError, match="can't be read"):
+		resume(path)
+
+
+def test_template_wells_not_on_the_plate_are_refused(make_ttw):
+	ttw = make_ttw()
+	ttw.next("T1")
+	path, _ = drop(ttw)
+	with open(path, encoding="utf-8") as session:
+		lines = session.read().split("\n")
+	lines[0] = lines[0].replace('"barcode_to_well": {}', '"barcode_to_well": {"T9": "Q30"}')
+	with open(path, "w", encoding="utf-8") as session:
+		session.write("\n".join(lines))
+	with pytest.raises(TError, match="not on the plate: Q30"):
+		resume(path)
@@ -0,0 +1,34 @@
+"""
+Starting TubeToWell must not import pandas, which is only needed to read a template file, and the shipped
+configuration must not build the barcode index of previous plates when a plate is started.
+"""
+
+import os, subprocess, sys
+
+from BarcodeIndex import INDEX_FILENAME
+from conftest import ROOT
+
+CHILD = """
+import sys
+import TubeToWell
+imported = "pandas" in sys.modules
+TubeToWell.TubeToWell()
+print(imported, "pandas" in sys.modules)
+"""
+
+
+def test_startup_does_not_import_pandas():
+	env = dict(os.environ)
+	env.pop("TTW_PROFILE_STARTUP", None)
+	env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+	result = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=env, capture_output=True, text=True)
+	assert result.returncode == 0, result.stderr
+	after_import, after_init = result.stdout.split()[-2:]
+	assert after_import == "False", "import TubeToWell loaded pandas"
+	assert after_init == "False", "TubeToWell() loaded pandas"
+
+
+def test_default_configuration_does_not_index_previous_plates(ttw):
+	ttw.next("TUBE1")
+	assert ttw.history is None
+	assert not os.path.exists(os.path.join(ttw.records_dir, INDEX_FILENAME))
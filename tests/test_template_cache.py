@@ -0,0 +1,135 @@
+"""The template and protocol caches (TemplateCache.py) and the protocols cloned from them."""
+
+import copy, shutil
+
+import pytest
+from WellLit.Transfer import TError
+
+import TemplateCache
+from TemplateCache import LRUCache
+from TubeToWellCLI import ScanDriver
+
+TEMPLATE = "templates/example_template.csv"
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+	TemplateCache.clear_caches()
+	for cache in (TemplateCache.templates, TemplateCache.protocols):
+		cache.hits = cache.misses = cache.evictions = 0
+	yield
+	TemplateCache.clear_caches()
+
+
+def test_lru_counts_and_eviction():
+	cache = LRUCache(2)
+	assert cache.get("a") is None
+	cache.put("a", 1)
+	cache.put("b", 2)
+	assert cache.get("a") == 1
+	# b is now the least recently used
+	cache.put("c", 3)
+	assert cache.get("b") is None
+	assert (cache.get("a"), cache.get("c")) == (1, 3)
+	assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 2, "evictions": 1}
+	cache.put("a", 4)
+	cache.put("d", 5)
+	assert list(cache.entries) == ["a", "d"]
+	assert cache.evictions == 2
+
+
+def test_template_loaded_again_is_a_hit(make_ttw):
+	ttw = make_ttw()
+	assert TemplateCache.protocols.stats()["misses"] == 1
+	ttw.loadWellConfigurationCSV(TEMPLATE)
+	parsed = (list(ttw.controls), dict(ttw.barcode_to_well))
+	assert TemplateCache.templates.stats()["misses"] == 1
+	other = make_ttw()
+	other.loadWellConfigurationCSV(TEMPLATE)
+	assert (other.controls, other.barcode_to_well) == parsed
+	assert TemplateCache.cache_stats()["templates"] == {"size": 1, "maxsize": 32, "hits": 1, "misses": 1, "evictions": 0}
+	# one skeleton for the default layout, one for the template, each built once
+	protocols = TemplateCache.protocols.stats()
+	assert (protocols["size"], protocols["misses"]) == (2, 2)
+	assert protocols["hits"] >= 2
+	# the same template on another plate type is parsed again
+	other.num_wells = "384"
+	other.reset()
+	other.loadWellConfigurationCSV(TEMPLATE)
+	assert TemplateCache.templates.stats()["misses"] == 2
+
+
+def test_template_with_errors_is_not_cached(make_ttw, tmp_path):
+	ttw = make_ttw()
+	template = str(tmp_path / "template.csv")
+	shutil.copy(TEMPLATE, template)
+	with open(template, "a") as bad:
+		bad.write("Q30,Not Available,\n")
+	for _ in range(2):
+		with pytest.raises(TError, match="error"):
+			ttw.loadWellConfigurationCSV(template)
+	assert TemplateCache.templates.stats()["size"] == 0
+	assert TemplateCache.templates.stats()["misses"] == 2
+
+
+def protocol_state(tp):
+	return copy.deepcopy(
+		{
+			"transfers": [(tf["source_tube"], tf["dest_well"], tf["status"], tf["timestamp"]) for tf in tp.orderedTransfers()],
+			"tf_seq": tp.tf_seq,
+			"current": tp._current_idx,
+			"lists": {status: list(ids) for status, ids in tp.lists.items()},
+			"barcode_index": tp.barcode_index,
+			"changed": tp.changed_transfers,
+			"controls": tp.controls,
+			"barcode_to_well": tp.barcode_to_well,
+			"valid_wells": tp.valid_wells,
+			"well_transfers": tp.well_transfers,
+			"reserved_barcodes": tp.reserved_barcodes,
+		}
+	)
+
+
+def shared_containers(a, b):
+	"""The attributes two protocols share the same list, dict, set or per-plate object for."""
+	return sorted(
+		name
+		for name, value in vars(a).items()
+		if name not in ("geometry", "tube_rule") and value is vars(b).get(name) and not isinstance(value, (str, int, float, bool, tuple, type(None)))
+	)
+
+
+def run_plate(ttw):
+	driver = ScanDriver(ttw, user="test")
+	for line in ["T1", "T1", "3", "3", "T2", "!skip", "T4", "!discard A1", "T5", "T5", "!undo", "!undo-scan"]:
+		driver.execute(line)
+
+
+@pytest.mark.parametrize("template", [None, TEMPLATE], ids=["no template", "template"])
+def test_clone_shares_no_state_with_the_skeleton(make_ttw, template):
+	ttw = make_ttw(template=template)
+	skeleton = TemplateCache.protocols.get(ttw.protocolKey())
+	assert skeleton is not None and skeleton is not ttw.tp
+	assert shared_containers(ttw.tp, skeleton) == []
+	assert ttw.tp.plate.well_names is not skeleton.plate.well_names
+	assert ttw.tp.allocator.reserved_barcodes is not skeleton.allocator.reserved_barcodes
+	unused = protocol_state(skeleton)
+
+	run_plate(ttw)
+	ttw.tp.controls.append("H12")
+	ttw.tp.barcode_to_well["T9"] = "H11"
+	ttw.tp.well_transfers["A2"] = []
+	assert protocol_state(skeleton) == unused
+	skeleton.checkInvariants()
+
+	# and the other way round: a plate started from the skeleton isn't changed by it
+	other = make_ttw(template=template, plate="OTHER")
+	started = protocol_state(other.tp)
+	skeleton.controls.append("H10")
+	skeleton.barcode_to_well["T8"] = "H9"
+	skeleton.plate.setStatus(skeleton.tf_seq[0], "started")
+	skeleton.tf_seq.reverse()
+	assert protocol_state(other.tp) == started
+	other.next("T1")
+	assert other.tp.findTransferByBarcode("T1")["dest_well"] == "A1"
+	other.tp.checkInvariants()
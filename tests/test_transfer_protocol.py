@@ -0,0 +1,145 @@
+"""The lookup indexes of TTWTransferProtocol stay in sync through every status transition (checkInvariants)."""
+
+import pytest
+from WellLit.Transfer import TError, TStatus
+
+TEMPLATE = "templates/example_template.csv"
+
+
+def statuses(ttw):
+	return {tf["dest_well"]: tf["status"] for tf in ttw.tp.orderedTransfers() if tf["status"] != "uncompleted"}
+
+
+def test_scan_in_and_out(ttw):
+	tp = ttw.tp
+	tp.checkInvariants()
+	ttw.next("TUBE1")
+	tp.checkInvariants()
+	assert statuses(ttw) == {"A1": "started"}
+	ttw.next("TUBE1")
+	tp.checkInvariants()
+	assert statuses(ttw) == {"A1": "completed"}
+	ttw.next("TUBE2")
+	tp.checkInvariants()
+	assert tp.transfersWithBarcode("TUBE2") == {tp.findTransferByBarcode("TUBE2").id: "started"}
+
+
+def test_rescan_is_rejected(ttw):
+	ttw.next("TUBE1")
+	ttw.next("TUBE1")
+	with pytest.raises(TError):
+		ttw.next("TUBE1")
+	ttw.tp.checkInvariants()
+	assert ttw.tp.lightup_well == "A1"
+
+
+def test_undo_and_cancel(ttw):
+	tp = ttw.tp
+	for barcode in ("TUBE1", "TUBE1", "TUBE2", "TUBE2"):
+		ttw.next(barcode)
+	ttw.undo()
+	tp.checkInvariants()
+	ttw.next("TUBE3")
+	tp.checkInvariants()
+	ttw.undoCurrentScan()
+	tp.checkInvariants()
+	assert tp.transfersWithBarcode("TUBE3") == {}
+	ttw.next("TUBE4")
+	tp.checkInvariants()
+
+
+def test_skip_and_discard(ttw):
+	tp = ttw.tp
+	ttw.next("TUBE1")
+	ttw.next("TUBE1")
+	ttw.skipNextWell()
+	tp.checkInvariants()
+	assert statuses(ttw)["B1"] == "discarded"
+	ttw.discardSpecificWell("A1")
+	tp.checkInvariants()
+	assert statuses(ttw)["A1"] == "discarded"
+	# a discarded tube can go into another well
+	ttw.next("TUBE1")
+	tp.checkInvariants()
+	assert tp.findTransferByBarcode("TUBE1")["dest_well"] == "C1"
+
+
+def test_skip_and_failed(ttw):
+	tp = ttw.tp
+	ttw.skip()
+	tp.checkInvariants()
+	ttw.failed()
+	tp.checkInvariants()
+	assert sorted(statuses(ttw).values()) == ["failed", "skipped"]
+
+
+def test_undo_and_redo_steps(ttw):
+	tp = ttw.tp
+	for barcode in ("TUBE1", "TUBE1", "TUBE2", "TUBE2", "TUBE3"):
+		ttw.next(barcode)
+	ttw.undoSteps(3)
+	tp.checkInvariants()
+	ttw.redoSteps(2)
+	tp.checkInvariants()
+	ttw.next("TUBE5")
+	tp.checkInvariants()
+
+
+def test_reserved_wells(make_ttw):
+	ttw = make_ttw(template=TEMPLATE)
+	tp = ttw.tp
+	tp.checkInvariants()
+	reserved = {barcode: well for barcode, well in ttw.barcode_to_well.items()}
+	barcode, well = next(iter(reserved.items()))
+	ttw.next(barcode)
+	tp.checkInvariants()
+	assert tp.findTransferByBarcode(barcode)["dest_well"] == well
+	ttw.next(barcode)
+	ttw.discardSpecificWell(well)
+	tp.checkInvariants()
+	ttw.next("TUBE1")
+	tp.checkInvariants()
+
+
+def test_reserved_tube_takes_its_first_transfer_in_fill_order(make_ttw):
+	ttw = make_ttw(template=TEMPLATE)
+	tp = ttw.tp
+	reserved_id = tp.findTransferByBarcode("3").id
+	# a second transfer holding the reserved tube, earlier in the sequence but indexed after the reserved well
+	earlier_id = tp.tf_seq[5]
+	tp.transfers[earlier_id]["source_tube"] = "3"
+	assert list(tp.transfersWithBarcode("3")) == [reserved_id, earlier_id]
+	assert tp.tf_seq.index(earlier_id) < tp.tf_seq.index(reserved_id)
+	ttw.next("3")
+	assert tp.transfers[earlier_id]["status"] == "started"
+	assert tp.transfers[reserved_id]["status"] == "uncompleted"
+
+
+def test_full_plate(ttw):
+	tp = ttw.tp
+	for i in range(len(tp.tf_seq)):
+		ttw.next("TUBE%s" % i)
+		ttw.next("TUBE%s" % i)
+	tp.checkInvariants()
+	assert tp.plateComplete()
+	with pytest.raises(TError):
+		ttw.next("ONE MORE")
+	tp.checkInvariants()
+
+
+def test_row_view_status_changes(ttw, monkeypatch):
+	tp = ttw.tp
+	tf = tp.transfers[tp.tf_seq[0]]
+	tf["source_tube"] = "TUBE1"
+	monkeypatch.setattr("time.strftime", lambda format: "2025-01-01 10:00:00" if format == "%Y-%m-%d %H:%M:%S" else "")
+	tf.updateStatus(TStatus.started)
+	assert (tf["status"], tf.status, tf["timestamp"]) == ("started", TStatus.started, "2025-01-01 10:00:00")
+	assert tp.transfersWithBarcode("TUBE1") == {tf.id: "started"}
+	assert tf.id in tp.lists["started"]
+	tp.checkInvariants()
+
+	tf.resetTransfer()
+	assert (tf["status"], tf["timestamp"], tf["source_tube"]) == ("uncompleted", None, None)
+	assert tp.transfersWithBarcode("TUBE1") == {}
+	assert tf.id not in tp.lists["started"]
+	tp.checkInvariants()
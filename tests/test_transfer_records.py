@@ -0,0 +1,114 @@
+"""Record journals left behind by a plate that isn't resumed become the record csv the live writer writes."""
+
+import os, random
+
+import pytest
+
+from TransferRecords import JOURNAL_EXTENSION, compact_transfer_journal, read_transfer_journal
+from TubeToWellCLI import ScanDriver, build_ttw
+from SessionJournal import session_path
+
+TEMPLATE = "templates/example_template.csv"
+
+
+def random_lines(seed, count=120):
+	"""Scans and control commands in the form ScanDriver.execute takes them."""
+	rnd = random.Random(seed)
+	lines = []
+	for _ in range(count):
+		r = rnd.random()
+		if r < 0.7:
+			lines.append("T%04d" % rnd.randint(0, 200))
+		elif r < 0.8:
+			lines.append("!undo")
+		elif r < 0.85:
+			lines.append("!undo-scan")
+		elif r < 0.9:
+			lines.append("!skip")
+		elif r < 0.95:
+			lines.append("!discard-last")
+		else:
+			lines.append("!rollback %d" % rnd.randint(1, 4))
+	return lines
+
+
+def leave_unfinished(ttw):
+	"""
+	Returns the record csv finishing the plate writes, then puts the record journal back as if the app had
+	stopped before the plate was finished.
+	"""
+	ttw.record_writer.flush()
+	record_path = str(ttw.recordPaths()[0])
+	with open(record_path + JOURNAL_EXTENSION, "rb") as journal:
+		saved = journal.read()
+	ttw.compactTransferRecordFiles()
+	with open(record_path) as record:
+		expected = record.read()
+	os.remove(record_path)
+	with open(record_path + JOURNAL_EXTENSION, "wb") as journal:
+		journal.write(saved)
+	return record_path, expected
+
+
+@pytest.mark.parametrize("template", [None, TEMPLATE], ids=["no template", "template"])
+@pytest.mark.parametrize("seed", range(6))
+def test_declined_plate_gets_the_live_record(make_ttw, seed, template):
+	ttw = make_ttw(template=template)
+	driver = ScanDriver(ttw, user="test")
+	for line in random_lines(seed):
+		driver.execute(line)
+	record_path, expected = leave_unfinished(ttw)
+	path = session_path(ttw.records_dir, ttw.csv)
+
+	assert ttw.abandonSession(path)
+	with open(record_path) as record:
+		assert record.read() == expected
+	assert not os.path.exists(record_path + JOURNAL_EXTENSION)
+	assert not os.path.exists(path)
+
+
+def test_leftover_journal_gets_the_live_record(make_ttw):
+	ttw = make_ttw()
+	for tube in ["T1", "T1", "T2", "T2", "T3"]:
+		ttw.next(tube)
+	ttw.discardSpecificWell("B1")
+	ttw.next("T3")
+	ttw.skipNextWell()
+	ttw.next("T4")
+	ttw.undoCurrentScan()
+	record_path, expected = leave_unfinished(ttw)
+	# the session journal is gone, e.g. the app died as the plate was finished
+	ttw.endSession()
+
+	other = build_ttw(records_dir=ttw.records_dir)
+	assert other.compactLeftoverJournals() == [record_path]
+	with open(record_path) as record:
+		assert record.read() == expected
+	assert not os.path.exists(record_path + JOURNAL_EXTENSION)
+
+
+def test_resumable_journal_is_left_alone(make_ttw):
+	ttw = make_ttw()
+	ttw.next("T1")
+	ttw.record_writer.flush()
+	record_path = str(ttw.recordPaths()[0])
+	assert build_ttw(records_dir=ttw.records_dir).compactLeftoverJournals() == []
+	assert os.path.exists(record_path + JOURNAL_EXTENSION)
+	assert not os.path.exists(record_path)
+
+
+def test_compact_torn_journal(tmp_path):
+	record_path = str(tmp_path / "plate.csv")
+	with open(record_path + JOURNAL_EXTENSION, "w", newline="") as journal:
+		journal.write(
+			"%Plate Timestamp: ,20250101-100000\r\n%Username: ,test\r\n%Plate Barcode: ,P1\r\n"
+			"%Timestamp,Tube Barcode,Location\r\n"
+			"2025-01-01 10:00:00,T1,A1,completed\r\n2025-01-01 10:00:01,T2,B1,discarded\r\n2025-01-01 10:0"
+		)
+	compact_transfer_journal(record_path)
+	with open(record_path) as record:
+		assert record.read().splitlines()[4:] == ["2025-01-01 10:00:00,T1,A1", "2025-01-01 10:00:01,T2-discarded,B1"]
+	assert read_transfer_journal(record_path)[1] == [
+		["2025-01-01 10:00:00", "T1", "A1", "completed"],
+		["2025-01-01 10:00:01", "T2", "B1", "discarded"],
+	]
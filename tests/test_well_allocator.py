@@ -0,0 +1,124 @@
+"""
+FreeWellAllocator (WellAllocator.py) assigns exactly the wells the original linear search did.
+
+Each test replays a random sequence of GUI actions (new tubes, scan outs, rescans, tubes reserved by the
+template, undo, cancel scan, skip next well, discard) on two plates side by side: one as it is, and
+one whose protocol picks and moves wells with the original code (first free non-reserved transfer in
+tf_seq, then insert/pop). After every action both must have the same transfer sequence, statuses,
+tubes, cursor and outcome, and checkInvariants must pass.
+"""
+
+import random
+
+import pytest
+from WellLit.Transfer import TError, TConfirm
+
+TEMPLATE = "templates/example_template.csv"
+STEPS = 150
+
+
+def linear_next_free(tp):
+	"""The original search for the well of a tube that isn't reserved."""
+	for tf_id in tp.tf_seq:
+		tf = tp.transfers[tf_id]
+		if tf["source_tube"] not in tp.barcode_to_well.keys() and tf["status"] not in ["started", "completed", "discarded"]:
+			return tf_id
+	return None
+
+
+def use_linear_allocation(tp):
+	def nextFree():
+		return linear_next_free(tp)
+
+	def moveToCurrent(tf_id):
+		i = tp.tf_seq.index(tf_id)
+		current = tp._current_idx
+		if tp.plate.undo_history is not None:
+			tp.plate.undo_history.noteSeq(min(i, current), max(i, current) + 1)
+		tp.tf_seq.insert(current, tf_id)
+		tp.tf_seq.pop(i + 1)
+
+	tp.allocator.nextFree = nextFree
+	tp.moveToCurrent = moveToCurrent
+
+
+def plate_state(ttw):
+	tp = ttw.tp
+	return (
+		list(tp.tf_seq),
+		[(tf["dest_well"], tf["status"], tf["source_tube"]) for tf in tp.orderedTransfers()],
+		tp._current_idx,
+		tp.canUndo,
+		tp.lightup_well,
+		ttw.scanned_out,
+	)
+
+
+def run(ttw, action, argument):
+	try:
+		if action == "next":
+			ttw.next(argument)
+		elif action == "discard":
+			ttw.discardSpecificWell(argument)
+		else:
+			getattr(ttw, action)()
+	except (TError, TConfirm) as outcome:
+		return type(outcome).__name__, str(outcome)
+	return "ok", ""
+
+
+def choose_action(rnd, ttw, used, counter):
+	tp = ttw.tp
+	r = rnd.random()
+	started = [tp.transfers[tf_id]["source_tube"] for tf_id in tp.lists["started"]]
+	if r < 0.35:
+		return "next", "TUBE%04d" % next(counter)
+	if r < 0.55 and started:
+		# scan the current tube out again
+		return "next", rnd.choice(started)
+	if r < 0.62 and used:
+		return "next", rnd.choice(sorted(used))
+	if r < 0.7 and ttw.barcode_to_well:
+		return "next", rnd.choice(sorted(ttw.barcode_to_well))
+	if r < 0.77:
+		return "undo", None
+	if r < 0.84:
+		return "undoCurrentScan", None
+	if r < 0.9:
+		return "skipNextWell", None
+	# a well the GUI lets you discard: a used well filled in sequence, or a reserved one
+	wells = [
+		tf["dest_well"]
+		for tf in tp.orderedTransfers()
+		if (tp.isAvailableWell(tf["dest_well"]) and tp.isWellUsed(tf["dest_well"]))
+		or tp.reservedBarcode(tf["dest_well"]) is not None
+	]
+	if wells:
+		return "discard", rnd.choice(wells)
+	return "next", "TUBE%04d" % next(counter)
+
+
+@pytest.mark.parametrize("template", [None, TEMPLATE], ids=["no template", "template"])
+@pytest.mark.parametrize("scan_out", [True, False], ids=["scan out", "no scan out"])
+@pytest.mark.parametrize("seed", range(12))
+def test_same_wells_as_linear_search(make_ttw, seed, scan_out, template):
+	rnd = random.Random(seed)
+	num_wells = 384 if seed % 4 == 3 else 96
+	plates = [make_ttw(template=template, num_wells=num_wells, plate="P%s" % i) for i in range(2)]
+	ttw, legacy = plates
+	for plate in plates:
+		plate.enable_scan_out = scan_out
+	use_linear_allocation(legacy.tp)
+
+	used = set()
+	counter = iter(range(10 ** 6))
+	for step in range(STEPS):
+		action, argument = choose_action(rnd, ttw, used, counter)
+		outcome = run(ttw, action, argument)
+		expected = run(legacy, action, argument)
+		where = "seed %s step %s: %s %s" % (seed, step, action, argument or "")
+		assert outcome == expected, where
+		assert plate_state(ttw) == plate_state(legacy), where
+		ttw.tp.checkInvariants()
+		if action == "next":
+			used.add(argument)
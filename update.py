@@ -8,20 +8,10 @@ CONFIG_DIR = "configs/"
 DEFAULT_CONFIG = os.path.join(CONFIG_DIR, "DEFAULT_CONFIG.json")
 backup_folder = "configs_backup/"
 
-def compare_dict_and_update(dict_new, dict_old):
-    keys = dict_new.keys()
-    for key in keys:
-        if key in dict_old:
-            if isinstance(dict_new[key], dict) and isinstance(dict_old[key], dict):
-                compare_dict_and_update(dict_new[key], dict_old[key])
-            elif isinstance(dict_new[key], dict) and not isinstance(dict_old[key], dict):
-                dict_old[key] = dict_new[key]
-            elif not isinstance(dict_new[key], dict) and isinstance(dict_old[key], dict):
-                dict_old[key] = dict_new[key]
-        else:
-            dict_old[key] = dict_new[key]
-
 def test_cases():
+    # the merge of the old configuration files with the new defaults, see Configuration.merge_defaults
+    from Configuration import merge_defaults as compare_dict_and_update
+
     new = {0: 1, 1: 1, 2: 2}
     old = {0: 2, 1: 2, 2: 3}
     compare_dict_and_update(new, old)
@@ -69,16 +59,25 @@ def backup_and_update():
     with open(DEFAULT_CONFIG) as json_file:
         new_default_config = json.load(json_file)
 
-    # 5. Go through 
+    # 5. Bring every backed up configuration up to date with the new defaults (imported after the pull,
+    # so the migrations of the new release are used) and check it
+    from Configuration import ConfigError, migrate_config, parse_config
+
     for filepath in os.listdir(backup_folder):
         if ".json" in filepath:
             new_path = os.path.join(CONFIG_DIR, filepath)
             filepath = os.path.join(backup_folder, filepath)
             with open(filepath) as json_file:
                 old_template = json.load(json_file)
-            compare_dict_and_update(new_default_config, old_template)
+            migrated, notes = migrate_config(old_template, new_default_config)
+            if notes:
+                print(f"{filepath}: {'; '.join(notes)}")
+            try:
+                parse_config(migrated, new_path)
+            except ConfigError as e:
+                print(f"Check {new_path} before using it: {'; '.join(e.problems)}")
             with open(new_path, 'w') as outfile:
-                json.dump(old_template, outfile, indent=4)
+                json.dump(migrated, outfile, indent=4)
 
 if __name__ == "__main__":
     # test_cases()